@@ -0,0 +1,134 @@
+'''
+主動通知 (ReminderScheduler) 的吞吐量測試。
+在 memory session store 中放入 --users 位使用者: 一半回答到一半就超時、一半在 --rescreen-after 秒前完成預測
+(完成紀錄寫進暫存目錄中的 CompletionStore)，
+掃描一輪後以 multicast 通知，假的 LINE API 每 --reject-every 次呼叫回應一次 429 (重試的退避設為 0)。
+回報送出與失敗的人數、multicast 呼叫次數與耗時，以及同一輪改用 push 逐一送出時需要的呼叫次數。
+
+    python bench/broadcast.py --users 20000 --rate 10 --burst 10 --reject-every 7
+'''
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_servers import FakeLineApi, FakePredictionApi, configure_bot_environment
+
+os.environ.setdefault("FLOW_CACHE_PATH", "")
+
+
+class RateLimitedLineApi(FakeLineApi):
+    '''
+    每 reject_every 次 multicast 回應一次 429
+    '''
+    def __init__(self, reject_every: int, latency: float = 0.0) -> None:
+        super().__init__(latency=latency)
+        self._reject_every = reject_every
+        self._multicasts = 0
+        self.recipients = 0
+
+    def respond(self, path: str, payload: dict) -> tuple[int, dict]:
+        if path != "/v2/bot/message/multicast":
+            return super().respond(path, payload)
+        with self._lock:
+            self._multicasts += 1
+            rejected = self._reject_every > 0 and self._multicasts % self._reject_every == 0
+            if not rejected:
+                self.recipients += len(payload["to"])
+        if rejected:
+            return 429, {"message": "The API rate limit has been exceeded. Try again later."}
+        return 200, {}
+
+
+def populate(board, completions, users: int, timeout: float, rescreen_after: float) -> None:
+    from models import User
+
+    now = time.time()
+    for index in range(users):
+        if index % 2 == 0:
+            # 回答到一半就超時
+            state = [User.STATE_VERSION, "diabetes", 2, [0, 40, None, None, None], 0b111, now - timeout - 1, False, None]
+        else:
+            # 完成糖尿病預測
+            completed_at = now - rescreen_after - 1
+            state = [User.STATE_VERSION, "diabetes", 4, [0, 40, 22.5, 5.5, 100], 0b11111, completed_at, True, completed_at]
+            completions.record(f"U{index:032x}", completed_at)
+        board.save_user(f"U{index:032x}", User.from_state(json.dumps(state).encode(), timeout=timeout))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20000)
+    parser.add_argument("--rate", type=float, default=10, help="multicast calls per second")
+    parser.add_argument("--burst", type=int, default=10)
+    parser.add_argument("--reject-every", type=int, default=7, help="respond 429 to every Nth multicast (0 never)")
+    parser.add_argument("--latency-ms", type=float, default=20)
+    parser.add_argument("--page-size", type=int, default=500)
+    args = parser.parse_args()
+
+    line_api = RateLimitedLineApi(args.reject_every, latency=args.latency_ms / 1000).start()
+    prediction_api = FakePredictionApi().start()
+    configure_bot_environment(line_api, prediction_api, "bench-secret")
+
+    from linebot import LineBotApi
+    from models import UserBoard, MemorySessionStore, CompletionStore, ReminderScheduler, text_message
+    from services import MulticastSender, PooledRequestsHttpClient, TokenBucket
+
+    timeout, rescreen_after = 300, 60
+    store = MemorySessionStore(timeout=timeout, max_sessions=args.users * 2)
+    board = UserBoard(store=store)
+    completions = CompletionStore(os.path.join(tempfile.mkdtemp(), "completions.sqlite3"))
+
+    line_bot_api = LineBotApi("bench-token", endpoint=line_api.url, http_client=PooledRequestsHttpClient)
+    sender = MulticastSender(line_bot_api, TokenBucket(args.rate, args.burst), backoff=0)
+    scheduler = ReminderScheduler(board, sender, nudge_messages=[text_message("您已超時"), text_message("請重新來過")],
+                                  rescreen_messages=[text_message("要不要再做一次健康風險評估呢?")],
+                                  rescreen_after=rescreen_after, completions=completions, page_size=args.page_size)
+    # 與 bot.install_reminders 相同，sweep 先移除的超時使用者交給 scheduler
+    board.set_expire_listener(scheduler.expired)
+    populate(board, completions, args.users, timeout, rescreen_after)
+
+    # 通知進行中，處理事件的執行緒仍能取得使用者的鎖
+    lock_waits: list[float] = []
+    done = threading.Event()
+
+    def handle_events() -> None:
+        index = 1
+        while not done.is_set():
+            start = time.perf_counter()
+            with board.session(f"U{index % args.users:032x}"):
+                pass
+            lock_waits.append(time.perf_counter() - start)
+            index += 2
+            time.sleep(0.001)
+
+    events = threading.Thread(target=handle_events, daemon=True)
+    events.start()
+    start = time.perf_counter()
+    result = scheduler.run_round()
+    elapsed = time.perf_counter() - start
+    done.set()
+    events.join()
+
+    lock_waits.sort()
+    print(json.dumps({
+        "users": args.users,
+        "round": result,
+        "seconds": round(elapsed, 3),
+        "multicast": sender.stats,
+        "recipients_received": line_api.recipients,
+        "push_calls_needed": result["sent"]["timeout_nudge"] + result["sent"]["rescreen"],
+        "event_lock_wait_p99_ms": round(lock_waits[int(len(lock_waits) * 0.99)] * 1000, 3) if lock_waits else None,
+        "remaining_sessions": store.count(),
+    }, indent=2, ensure_ascii=False))
+    line_api.stop()
+    prediction_api.stop()
+
+
+if __name__ == "__main__":
+    main()
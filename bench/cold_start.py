@@ -0,0 +1,108 @@
+'''
+量測冷啟動: 每次都啟動一個新的 python process，import app (或 asgi) 後
+立即送出一位使用者的完整流程，回報從 process 啟動到第一個 webhook 處理完的秒數、
+走完整個流程的秒數，以及最慢的 import。
+假的 LINE API 與預測 API 對每條新連線等待 --connect-latency 秒，模擬 TLS 握手。
+
+    python bench/cold_start.py --runs 5 --connect-latency 0.1
+    python bench/cold_start.py --target asgi
+'''
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_servers import FakeLineApi, FakePredictionApi, configure_bot_environment
+
+SECRET = "bench-secret"
+
+CHILD = r'''
+import json, os, sys, time
+sys.path.insert(0, os.environ["BENCH_DIR"])
+from webhooks import text_event, postback_event, signed_request
+
+script = [text_event("Ucold", "hi"), postback_event("Ucold", "1"), postback_event("Ucold", "1"), postback_event("Ucold", "0"),
+          text_event("Ucold", "40"), text_event("Ucold", "22.5"), text_event("Ucold", "6.1"), text_event("Ucold", "120")]
+requests = [signed_request([event], os.environ["LINE_SECRET"]) for event in script]
+
+if os.environ["BENCH_TARGET"] == "flask":
+    import app
+    from utils.startup import startup_report
+    client = app.app.test_client()
+    def post(body, signature):
+        return client.post("/", data=body, headers={"X-Line-Signature": signature}).status_code
+    def finish():
+        pass
+else:
+    import asyncio
+    import asgi
+    from utils.startup import startup_report
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(asgi.startup())
+    def post(body, signature):
+        async def call():
+            before = set(asgi.pending_tasks)
+            status = await asgi.webhook(body, signature)
+            handlers = asgi.pending_tasks - before
+            if handlers:
+                await asyncio.wait(handlers)
+            return status
+        return loop.run_until_complete(call())
+    def finish():
+        loop.run_until_complete(asgi.shutdown())
+
+started = time.perf_counter()
+statuses = [post(body, signature) for body, signature in requests]
+flow_seconds = time.perf_counter() - started
+finish()
+report = startup_report.as_dict()
+report["flow_seconds"] = flow_seconds
+report["statuses"] = statuses
+print(json.dumps(report))
+'''
+
+
+def run_once(target: str, env: dict) -> dict:
+    src = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+    output = subprocess.run([sys.executable, "-c", CHILD], cwd=src, env=env, capture_output=True, text=True, check=True)
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--target", choices=["flask", "asgi"], default="flask")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--connect-latency", type=float, default=0.1)
+    parser.add_argument("--latency", type=float, default=0.0)
+    args = parser.parse_args()
+
+    line_api = FakeLineApi(latency=args.latency, connect_latency=args.connect_latency).start()
+    prediction_api = FakePredictionApi(latency=args.latency, connect_latency=args.connect_latency).start()
+    configure_bot_environment(line_api, prediction_api, SECRET)
+
+    results = {}
+    for warm_up in ("0", "1"):
+        env = dict(os.environ, BENCH_DIR=os.path.dirname(os.path.abspath(__file__)), BENCH_TARGET=args.target,
+                   STARTUP_REPORT="1", STARTUP_WARM_UP=warm_up, PREDICT_CACHE_SIZE="0")
+        runs = [run_once(args.target, env) for _ in range(args.runs)]
+        first_webhook = statistics.median(run["milestones"]["first_webhook"] for run in runs)
+        imports = statistics.median(run["milestones"]["imports"] for run in runs)
+        flow = statistics.median(run["flow_seconds"] for run in runs)
+        results[f"warm_up={warm_up}"] = {
+            "imports_done_seconds": round(imports, 4),
+            "first_webhook_seconds": round(first_webhook, 4),
+            "full_flow_seconds": round(flow, 4),
+            "slowest_imports": runs[-1]["imports"][:8],
+        }
+
+    line_api.stop()
+    prediction_api.stop()
+    print(json.dumps({"target": args.target, "connect_latency": args.connect_latency, "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+'''
+比較 Flask (同步 LineBotApi) 與 ASGI (AsyncLineBotApi) 兩種服務方式的吞吐量。
+兩者都對本機假的 LINE API 回覆，假 API 每次回應前等待 --line-latency 秒。
+
+    python bench/compare_serving.py --events 500 --line-latency 0.05
+'''
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_servers import FakeLineApi, FakePredictionApi, configure_bot_environment
+from webhooks import text_event, signed_request
+
+SECRET = "bench-secret"
+
+
+def run_flask(requests: list[tuple[bytes, str]]) -> float:
+    import app as flask_app
+
+    client = flask_app.app.test_client()
+    start = time.perf_counter()
+    for body, signature in requests:
+        response = client.post("/", data=body, headers={"X-Line-Signature": signature})
+        assert response.status_code == 200, response.status_code
+    return time.perf_counter() - start
+
+
+def run_asgi(requests: list[tuple[bytes, str]]) -> float:
+    import asgi
+
+    async def call(body: bytes, signature: str) -> int:
+        received = False
+        status = 0
+
+        async def receive():
+            nonlocal received
+            if received:
+                await asyncio.sleep(3600)
+            received = True
+            return {"type": "http.request", "body": body, "more_body": False}
+
+        async def send(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+
+        scope = {"type": "http", "method": "POST", "path": "/", "headers": [(b"x-line-signature", signature.encode())]}
+        await asgi.app(scope, receive, send)
+        return status
+
+    async def main() -> float:
+        await asgi.startup()
+        start = time.perf_counter()
+        statuses = await asyncio.gather(*(call(body, signature) for body, signature in requests))
+        assert all(status == 200 for status in statuses), statuses
+        while asgi.pending_tasks:
+            await asyncio.wait(list(asgi.pending_tasks))
+        elapsed = time.perf_counter() - start
+        await asgi.shutdown()
+        return elapsed
+
+    return asyncio.run(main())
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--events", type=int, default=300)
+    parser.add_argument("--line-latency", type=float, default=0.05)
+    args = parser.parse_args()
+
+    line_api = FakeLineApi(latency=args.line_latency).start()
+    prediction_api = FakePredictionApi().start()
+    configure_bot_environment(line_api, prediction_api, SECRET)
+
+    for name, run in (("flask", run_flask), ("asgi", run_asgi)):
+        requests = [signed_request([text_event(f"U{name}{i}", "hi")], SECRET) for i in range(args.events)]
+        before = line_api.requests
+        elapsed = run(requests)
+        replies = line_api.requests - before
+        print(f"{name:6s} events={args.events} replies={replies} elapsed={elapsed:.3f}s throughput={args.events / elapsed:.1f} events/s")
+
+    line_api.stop()
+    prediction_api.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import json
+import os
+import sys
+import threading
+import time
+
+'''
+本機假的 LINE Messaging API 與預測 API，回應前會等待 latency 秒，
+用來在不連外的情況下量測機器人的吞吐量。
+'''
+
+
+class FakeServer(object):
+    '''
+    latency: 每個請求回應前等待的秒數
+    connect_latency: 每條新連線開始處理前等待的秒數，模擬 TCP 與 TLS 握手
+    '''
+    def __init__(self, port: int = 0, latency: float = 0.0, connect_latency: float = 0.0) -> None:
+        self._latency = latency
+        self._connect_latency = connect_latency
+        self._requests = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), self._make_handler())
+        self._server.daemon_threads = True
+        # 用戶端關閉 keep-alive 連線時的錯誤不需要輸出
+        self._server.handle_error = lambda request, client_address: None
+        self._server.request_queue_size = 1024
+        self._thread: threading.Thread | None = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def requests(self) -> int:
+        return self._requests
+
+    def start(self) -> "FakeServer":
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def respond(self, path: str, payload: dict) -> tuple[int, dict]:
+        return 200, {}
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # 標頭與內容分兩次寫出，不關閉 Nagle 會與 delayed ACK 互相等待 40ms
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                if server._connect_latency > 0:
+                    time.sleep(server._connect_latency)
+                super().setup()
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                raw = self.rfile.read(length) if length else b""
+                payload = json.loads(raw) if raw else {}
+                with server._lock:
+                    server._requests += 1
+                if server._latency > 0:
+                    time.sleep(server._latency)
+                status, body = server.respond(self.path, payload)
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_HEAD(self):
+                self.send_response(200)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+class FakeLineApi(FakeServer):
+    '''
+    接受 /v2/bot/message/reply 與 /v2/bot/message/push
+    '''
+    def respond(self, path: str, payload: dict) -> tuple[int, dict]:
+        if path.startswith("/v2/bot/message/"):
+            return 200, {}
+        return 404, {"message": "Not found"}
+
+
+class FakePredictionApi(FakeServer):
+    '''
+    接受 /predict/{disease}，回傳固定格式的預測結果
+    '''
+    def respond(self, path: str, payload: dict) -> tuple[int, dict]:
+        if not path.startswith("/predict/"):
+            return 404, {}
+        disease = path.removeprefix("/predict/")
+        return 200, {f"have_{disease}": False, f"{disease}_percentage": 12.5}
+
+
+def configure_bot_environment(line_api: FakeLineApi, prediction_api: FakePredictionApi, secret: str) -> None:
+    '''
+    讓機器人改連假的 API，必須在 import app / asgi 之前呼叫
+    '''
+    os.environ["LINE_ACCESS_TOKEN"] = "bench-token"
+    os.environ["LINE_SECRET"] = secret
+    os.environ["LINE_API_ENDPOINT"] = line_api.url
+    os.environ["BASE_API_URL"] = prediction_api.url
+    src = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+    if src not in sys.path:
+        sys.path.insert(0, src)
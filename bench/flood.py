@@ -0,0 +1,78 @@
+'''
+一位使用者不斷送出訊息時，其他正常使用者的延遲。
+spammer 執行緒以每秒 --spam-rate 個事件的速度送出同一位使用者的事件，
+同時 --users 位使用者各自走完整個流程，回報正常使用者的延遲分佈與 LINE API 呼叫次數。
+以 RATE_LIMIT_* 環境變數開啟並調整流量控制 (預設不限制)，不設定時即為對照組。
+
+    RATE_LIMIT_USER_RATE=2 python bench/flood.py --users 100 --line-latency 0.02
+    python bench/flood.py --users 100 --line-latency 0.02
+'''
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_servers import FakeLineApi, FakePredictionApi, configure_bot_environment
+from run import SECRET, InProcessTarget, build_requests, run_load
+from webhooks import text_event, signed_request
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--spam-concurrency", type=int, default=4)
+    parser.add_argument("--spam-rate", type=float, default=200, help="spammer 每秒送出的事件總數")
+    parser.add_argument("--line-latency", type=float, default=0.02)
+    parser.add_argument("--seed", type=int, default=1234)
+    args = parser.parse_args()
+
+    line_api = FakeLineApi(latency=args.line_latency).start()
+    prediction_api = FakePredictionApi().start()
+    configure_bot_environment(line_api, prediction_api, SECRET)
+    os.environ.setdefault("PREDICT_CACHE_SIZE", "0")
+
+    target = InProcessTarget()
+    stop = threading.Event()
+    spam_sent = 0
+    lock = threading.Lock()
+
+    interval = args.spam_concurrency / args.spam_rate
+
+    def spam() -> None:
+        nonlocal spam_sent
+        count = 0
+        next_at = time.monotonic()
+        while not stop.is_set():
+            body, signature = signed_request([text_event("Uspammer", f"spam {count}")], SECRET)
+            target.post(body, signature)
+            count += 1
+            next_at += interval
+            stop.wait(max(0.0, next_at - time.monotonic()))
+        with lock:
+            spam_sent += count
+
+    spammers = [threading.Thread(target=spam, daemon=True) for _ in range(args.spam_concurrency)]
+    for thread in spammers:
+        thread.start()
+    result = run_load(target, build_requests(args.users, args.seed, "legit"), args.concurrency)
+    stop.set()
+    for thread in spammers:
+        thread.join()
+
+    result.update({
+        "spam_events": spam_sent,
+        "line_api_calls": line_api.requests,
+        "rate_limit_user_rate": os.getenv("RATE_LIMIT_USER_RATE", "0"),
+    })
+    line_api.stop()
+    prediction_api.stop()
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,249 @@
+'''
+機器人的負載測試與效能基準。
+N 個模擬使用者各自走完 Initial -> Choose -> Diabetes 的完整流程，
+LINE API 與預測 API 由本機假伺服器代替，延遲可調整。
+
+    python bench/run.py --users 200 --concurrency 8
+    python bench/run.py --mode http --users 200 --concurrency 16
+    python bench/run.py --url http://127.0.0.1:8080/ ...   # 對外部啟動的 gunicorn 施壓
+    python bench/run.py --output result.json
+    python bench/run.py --baseline result.json --max-regression 0.15   # 退步超過 15% 時 exit code 為 1
+
+回報 requests/sec、p50/p95/p99 延遲、每個 session 的記憶體與配置數量。
+'''
+import argparse
+import gc
+import json
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_servers import FakeLineApi, FakePredictionApi, configure_bot_environment
+from webhooks import text_event, postback_event, signed_request
+
+SECRET = "bench-secret"
+
+
+def user_script(user_id: str, rng: random.Random) -> list[dict]:
+    '''
+    一位使用者從打招呼到取得糖尿病預測結果的所有事件
+    '''
+    return [
+        text_event(user_id, "hi"),
+        postback_event(user_id, "1"),
+        postback_event(user_id, "1"),
+        postback_event(user_id, rng.choice(["0", "1"])),
+        text_event(user_id, str(rng.randint(20, 80))),
+        text_event(user_id, f"{rng.uniform(17, 35):.1f}"),
+        text_event(user_id, f"{rng.uniform(4, 9):.1f}"),
+        text_event(user_id, str(rng.randint(70, 200))),
+    ]
+
+
+def build_requests(users: int, seed: int, prefix: str) -> list[list[tuple[bytes, str]]]:
+    rng = random.Random(seed)
+    return [[signed_request([event], SECRET) for event in user_script(f"U{prefix}{i:06d}", rng)] for i in range(users)]
+
+
+class InProcessTarget(object):
+    '''
+    直接以 Flask test client 呼叫 webhook()，不經過網路
+    '''
+    def __init__(self) -> None:
+        import app as flask_app
+        self._app = flask_app.app
+        self._local = threading.local()
+
+    def post(self, body: bytes, signature: str) -> int:
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._local.client = self._app.test_client()
+        return client.post("/", data=body, headers={"X-Line-Signature": signature}).status_code
+
+    def close(self) -> None:
+        pass
+
+
+class HttpTarget(object):
+    '''
+    透過 HTTP 呼叫 webhook；沒有指定 url 時在本機以 werkzeug 啟動 app
+    '''
+    def __init__(self, url: str | None = None) -> None:
+        import requests
+        self._requests = requests
+        self._server = None
+        if url is None:
+            from werkzeug.serving import make_server
+            import app as flask_app
+            self._server = make_server("127.0.0.1", 0, flask_app.app, threaded=True)
+            threading.Thread(target=self._server.serve_forever, daemon=True).start()
+            url = f"http://127.0.0.1:{self._server.server_port}/"
+        self._url = url
+        self._local = threading.local()
+
+    def post(self, body: bytes, signature: str) -> int:
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = self._requests.Session()
+        response = session.post(self._url, data=body, headers={"X-Line-Signature": signature, "Content-Type": "application/json"})
+        return response.status_code
+
+    def close(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+
+
+def percentile(sorted_values: list[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(q * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def run_load(target, scripts: list[list[tuple[bytes, str]]], concurrency: int) -> dict:
+    latencies: list[float] = []
+    errors = 0
+    lock = threading.Lock()
+
+    def walk(script: list[tuple[bytes, str]]) -> None:
+        nonlocal errors
+        local_latencies = []
+        local_errors = 0
+        for body, signature in script:
+            start = time.perf_counter()
+            status = target.post(body, signature)
+            local_latencies.append(time.perf_counter() - start)
+            if status != 200:
+                local_errors += 1
+        with lock:
+            latencies.extend(local_latencies)
+            errors += local_errors
+
+    gc_before = sum(stat["collections"] for stat in gc.get_stats())
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(walk, scripts))
+    elapsed = time.perf_counter() - start
+    gc_after = sum(stat["collections"] for stat in gc.get_stats())
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "elapsed_seconds": elapsed,
+        "requests_per_second": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "mean_ms": statistics.fmean(latencies) * 1000 if latencies else 0.0,
+        "gc_collections": gc_after - gc_before,
+    }
+
+
+def measure_sessions(target, scripts: list[list[tuple[bytes, str]]], steps: int) -> dict:
+    '''
+    讓每位使用者只走前 steps 步 (停在流程中間)，
+    以 tracemalloc 量測留在記憶體中的 session 大小與配置數量。
+    '''
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for script in scripts:
+        for body, signature in script[:steps]:
+            target.post(body, signature)
+    gc.collect()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    diff = after.compare_to(before, "filename")
+    size = sum(stat.size_diff for stat in diff)
+    blocks = sum(stat.count_diff for stat in diff)
+    return {
+        "sessions": len(scripts),
+        "bytes_per_session": size / len(scripts),
+        "blocks_per_session": blocks / len(scripts),
+    }
+
+
+def compare(result: dict, baseline: dict, max_regression: float) -> list[str]:
+    failures = []
+    if result["requests_per_second"] < baseline["requests_per_second"] * (1 - max_regression):
+        failures.append(f"requests_per_second {result['requests_per_second']:.1f} < baseline {baseline['requests_per_second']:.1f}")
+    for key in ("p50_ms", "p95_ms", "p99_ms", "bytes_per_session"):
+        if key in baseline and key in result and result[key] > baseline[key] * (1 + max_regression):
+            failures.append(f"{key} {result[key]:.2f} > baseline {baseline[key]:.2f}")
+    return failures
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=["inprocess", "http"], default="inprocess")
+    parser.add_argument("--url", default=None, help="外部 webhook 網址 (只用於 http 模式)")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--line-latency", type=float, default=0.0)
+    parser.add_argument("--predict-latency", type=float, default=0.0)
+    parser.add_argument("--memory-sessions", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=3, help="重複次數，取 requests/sec 的中位數那一次")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--output", default=None)
+    parser.add_argument("--baseline", default=None)
+    parser.add_argument("--max-regression", type=float, default=0.15)
+    args = parser.parse_args()
+
+    line_api = FakeLineApi(latency=args.line_latency).start()
+    prediction_api = FakePredictionApi(latency=args.predict_latency).start()
+    configure_bot_environment(line_api, prediction_api, SECRET)
+    # 每次執行都要打到預測 API，結果才有可比性
+    os.environ.setdefault("PREDICT_CACHE_SIZE", "0")
+
+    target = InProcessTarget() if args.mode == "inprocess" else HttpTarget(args.url)
+
+    # 暖機，讓 import、連線與第一次建立的物件不影響結果
+    run_load(target, build_requests(min(args.users, 20), args.seed, "warm"), args.concurrency)
+
+    runs = []
+    for i in range(args.repeat):
+        runs.append(run_load(target, build_requests(args.users, args.seed, f"r{i}"), args.concurrency))
+    runs.sort(key=lambda run: run["requests_per_second"])
+    result = dict(runs[len(runs) // 2])
+    result.update({
+        "mode": args.mode,
+        "users": args.users,
+        "concurrency": args.concurrency,
+        "line_latency": args.line_latency,
+        "predict_latency": args.predict_latency,
+        "line_api_calls": line_api.requests,
+        "prediction_api_calls": prediction_api.requests,
+    })
+    if args.mode == "inprocess" and args.memory_sessions > 0:
+        result.update(measure_sessions(target, build_requests(args.memory_sessions, args.seed, "mem"), steps=5))
+
+    target.close()
+    line_api.stop()
+    prediction_api.stop()
+
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        failures = compare(result, baseline, args.max_regression)
+        for failure in failures:
+            print("REGRESSION:", failure, file=sys.stderr)
+        if failures:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+'''
+UserBoard 在多執行緒下的競爭測試 (例如 gunicorn gthread worker)。
+每個事件在 UserBoard.session 中讀出使用者、等待 --io-ms 毫秒 (模擬呼叫 LINE 或預測 API)、前進一題後寫回。
+
+distinct: 每個執行緒處理各自的使用者，回報各執行緒數下的吞吐量，
+          與整個處理過程共用一把全域鎖的做法比較
+shared: 所有執行緒同時處理同一位使用者的事件，檢查是否有更新遺失，
+        並與不加鎖、直接 get_user / save_user 的做法比較
+
+    python bench/user_board.py --threads 1 2 4 8 16 --events 200 --io-ms 2
+'''
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+os.environ.setdefault("LINE_ACCESS_TOKEN", "bench-token")
+os.environ.setdefault("LINE_SECRET", "bench-secret")
+os.environ.setdefault("BASE_API_URL", "http://127.0.0.1:9")
+os.environ.setdefault("FLOW_CACHE_PATH", "")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+from models import UserBoard, MemorySessionStore
+
+
+def new_board(stripes: int) -> UserBoard:
+    return UserBoard(store=MemorySessionStore(timeout=300, max_sessions=1000000), stripes=stripes)
+
+
+def handle(board: UserBoard, user_id: str, io: float) -> None:
+    with board.session(user_id) as session:
+        user = session.get_or_create()
+        time.sleep(io)
+        user._index += 1
+
+
+def handle_unlocked(board: UserBoard, user_id: str, io: float) -> None:
+    user = board.get_user(user_id)
+    if user is None:
+        user = board.add_user(user_id)
+    index = user._index
+    time.sleep(io)
+    user._index = index + 1
+    board.save_user(user_id, user)
+
+
+def run_threads(threads: int, work) -> float:
+    barrier = threading.Barrier(threads + 1)
+
+    def worker(index: int) -> None:
+        barrier.wait()
+        work(index)
+
+    pool = [threading.Thread(target=worker, args=(index,)) for index in range(threads)]
+    for thread in pool:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in pool:
+        thread.join()
+    return time.perf_counter() - start
+
+
+def distinct(threads: int, events: int, users: int, io: float, stripes: int, global_lock: bool) -> dict:
+    board = new_board(stripes)
+    lock = threading.Lock()
+
+    @contextmanager
+    def guard():
+        if global_lock:
+            with lock:
+                yield
+        else:
+            yield
+
+    def work(index: int) -> None:
+        for i in range(events):
+            with guard():
+                handle(board, f"U{index}-{i % users}", io)
+
+    elapsed = run_threads(threads, work)
+    return {"events_per_second": round(threads * events / elapsed, 1), "lock_waits": board.stats["lock_waits"]}
+
+
+def shared(threads: int, events: int, io: float, stripes: int, locked: bool) -> dict:
+    board = new_board(stripes)
+    handler = handle if locked else handle_unlocked
+
+    def work(index: int) -> None:
+        for _ in range(events):
+            handler(board, "Ushared", io)
+
+    run_threads(threads, work)
+    return {"expected": threads * events, "actual": board.get_user("Ushared")._index}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    parser.add_argument("--events", type=int, default=200, help="每個執行緒處理的事件數")
+    parser.add_argument("--users", type=int, default=20, help="distinct 模式下每個執行緒的使用者數")
+    parser.add_argument("--io-ms", type=float, default=2)
+    parser.add_argument("--stripes", type=int, default=64)
+    args = parser.parse_args()
+    io = args.io_ms / 1000
+
+    result = {"distinct": {}, "shared": {}}
+    base = None
+    for threads in args.threads:
+        striped = distinct(threads, args.events, args.users, io, args.stripes, global_lock=False)
+        single = distinct(threads, args.events, args.users, io, args.stripes, global_lock=True)
+        base = base or striped["events_per_second"]
+        striped["scaling"] = round(striped["events_per_second"] / base, 2)
+        result["distinct"][threads] = {"striped": striped, "global_lock": single}
+    threads = max(args.threads)
+    result["shared"] = {
+        "session": shared(threads, args.events // 4, io, args.stripes, locked=True),
+        "unlocked": shared(threads, args.events // 4, io, args.stripes, locked=False),
+    }
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+import base64
+import hashlib
+import hmac
+import json
+import time
+import uuid
+
+'''
+產生帶有正確 X-Line-Signature 的 webhook 請求內容
+'''
+
+
+def sign(body: bytes, secret: str) -> str:
+    return base64.b64encode(hmac.new(secret.encode("utf-8"), body, hashlib.sha256).digest()).decode("ascii")
+
+
+def _base_event(event_type: str, user_id: str) -> dict:
+    return {
+        "type": event_type,
+        "mode": "active",
+        "timestamp": int(time.time() * 1000),
+        "source": {"type": "user", "userId": user_id},
+        "replyToken": uuid.uuid4().hex,
+        "webhookEventId": uuid.uuid4().hex.upper(),
+        "deliveryContext": {"isRedelivery": False},
+    }
+
+
+def text_event(user_id: str, text: str) -> dict:
+    event = _base_event("message", user_id)
+    event["message"] = {"id": uuid.uuid4().hex[:18], "type": "text", "quoteToken": uuid.uuid4().hex, "text": text}
+    return event
+
+
+def postback_event(user_id: str, data: str) -> dict:
+    event = _base_event("postback", user_id)
+    event["postback"] = {"data": data}
+    return event
+
+
+def webhook_body(events: list[dict], destination: str = "Ubench") -> bytes:
+    return json.dumps({"destination": destination, "events": events}, ensure_ascii=False).encode("utf-8")
+
+
+def signed_request(events: list[dict], secret: str) -> tuple[bytes, str]:
+    body = webhook_body(events)
+    return body, sign(body, secret)
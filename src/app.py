@@ -1,165 +1,167 @@
-from flask import Flask, request, abort
-from dotenv import load_dotenv
-from linebot import WebhookHandler, LineBotApi
-from linebot.exceptions import InvalidSignatureError
-from linebot.models import MessageEvent, TextMessage, TextSendMessage, PostbackEvent
+# 必須最先 import，才能量測其他 import 花的時間
+from utils.startup import startup_report, report_enabled
 
-import os
+from linebot import LineBotApi
 
-from models import UserBoard, TextQuestion, ButtonQuestion
-from vars import access_token, secret
+import atexit
+import logging
+import threading
+import time
 
-# 载入 .env 文件
-load_dotenv()
+from services import EventDispatcher, PooledRequestsHttpClient, WebhookIngestor, WebhookEvent, WebhookError
+from services import metrics_registry, stage_seconds
+from vars import access_token, secret, line_api_endpoint, startup_warm_up, webhook_max_body_bytes
+from vars import dispatch_mode, dispatch_workers, dispatch_queue_size, dispatch_enqueue_timeout
+
+line_bot_api = LineBotApi(access_token, endpoint=line_api_endpoint, http_client=PooledRequestsHttpClient)  # token 確認
+ingestor = WebhookIngestor(secret, max_body_bytes=webhook_max_body_bytes)      # secret 確認
+metrics_registry.register_stats("linebot_webhook", "Webhook request parsing", lambda: ingestor.stats)
+
+
+def warm_up_line_api() -> None:
+    line_bot_api.http_client.warm_up(line_api_endpoint)
+    startup_report.mark("line_api_warm_up")
+
+
+def warm_up_prediction_api() -> None:
+    bot.warm_up()
+    startup_report.mark("prediction_api_warm_up")
+
+
+# 冷啟動時先在背景連上 LINE API，TLS 握手與後面 flask 及對話邏輯的 import 同時進行，
+# 第一則回覆就能直接使用連線池中的連線
+if startup_warm_up:
+    threading.Thread(target=warm_up_line_api, name="warm-up-line", daemon=True).start()
+
+from flask import Flask, Response, request, abort
+
+import bot
+from models import ReplyCollector
+
+startup_report.mark("imports")
 
 app = Flask(__name__)
+# Content-Length 超過上限的請求在讀取內容之前就以 413 拒絕
+app.config["MAX_CONTENT_LENGTH"] = webhook_max_body_bytes
+
+
+def mark_first_webhook() -> None:
+    if startup_report.mark("first_webhook") and report_enabled:
+        startup_report.remove_import_hook()
+        startup_report.log()
 
-base_api_url = os.getenv("BASE_API_URL").removesuffix("/")
 
-line_bot_api = LineBotApi(access_token)  # token 確認
-handler = WebhookHandler(secret)      # secret 確認
+def dispatch_event(event: WebhookEvent) -> None:
+    '''
+    依事件種類呼叫對應的處理函數，不處理的事件在解析時就已略過。
+    同步、佇列與 coalesce 三種路徑都經過這裡，失敗時保留 claim (見 bot.handling_event)
+    '''
+    with bot.handling_event(event):
+        if event.kind == WebhookEvent.TEXT:
+            handle_text_message(event)
+        elif event.kind == WebhookEvent.POSTBACK:
+            handle_postback(event)
 
-user_board = UserBoard()
+
+event_dispatcher = None
+if dispatch_mode == "async":
+    event_dispatcher = EventDispatcher(handle=dispatch_event, workers=dispatch_workers, queue_size=dispatch_queue_size,
+                                       enqueue_timeout=dispatch_enqueue_timeout)
+    atexit.register(event_dispatcher.stop, 5)
+    metrics_registry.register_stats("linebot_dispatcher", "Async event dispatcher", lambda: event_dispatcher.stats)
+
+
+def dispatch_deferred(user_id: str, event) -> None:
+    '''
+    coalesce 模式下被擱置、稍後才輪到的事件
+    '''
+    if event_dispatcher is None:
+        dispatch_event(event)
+    elif not event_dispatcher.submit(user_id, event):
+        logging.warning("Event queue is full, deferred event of %s is dropped", user_id)
+
+
+flood_control = bot.create_flood_control(handle=dispatch_deferred)
+
+# 讀回上次部署結束前的使用者狀態，結束時再寫入新的快照
+bot.install_session_snapshot()
+startup_report.mark("session_restore")
+
+# 超時與再次篩檢的主動通知在背景執行緒送出，不佔用處理 webhook 的執行緒
+bot.install_reminders()
+
+if startup_warm_up:
+    threading.Thread(target=warm_up_prediction_api, name="warm-up-prediction", daemon=True).start()
+startup_report.mark("app_ready")
 
 """
 接收並處理來自 Line 平台的 Webhook 請求。
-獲取並驗證請求的簽名。
+以原始 bytes 驗證請求的簽名，只解析會處理的事件。
 調用相應的處理函數處理請求數據。
-在簽名驗證失敗時返回 400 錯誤碼。
+在簽名缺少或驗證失敗、內容格式錯誤時返回 400 錯誤碼，內容過大時返回 413。
+已處理過的 event ID (LINE 重送) 會被略過，處理失敗 (例如回覆送不出去) 的事件也不會再處理一次。
+async 模式下事件只會被放進佇列，佇列已滿時返回 503 讓 LINE 重送。
 """
 @app.route("/", methods=['POST'])
 def webhook():
-    body = request.get_data(as_text=True)
-    signature = request.headers['X-Line-Signature']
+    body = request.get_data(cache=False)
+    signature = request.headers.get('X-Line-Signature')
+    start = time.perf_counter()
     try:
-        handler.handle(body, signature)
-    except InvalidSignatureError:
-        abort(400)
+        events = ingestor.parse(body, signature)
+    except WebhookError as e:
+        abort(e.status_code)
+    finally:
+        stage_seconds.observe(time.perf_counter() - start, "signature")
+
+    # LINE 重送已處理過的事件時直接略過，不會重複回答問題或呼叫預測 API
+    events = [event for event in events if bot.claim_event(event)]
+    # 超過流量限制的事件不交給處理函數，也不會建立新的使用者
+    if flood_control is not None:
+        events = [event for event in events if flood_control.admit(event.user_id, event)]
+
+    if event_dispatcher is None:
+        for event in events:
+            dispatch_event(event)
+        mark_first_webhook()
+        return 'OK'
+
+    all_enqueued = True
+    for event in events:
+        if not event_dispatcher.submit(event.user_id, event):
+            bot.release_event(event)
+            all_enqueued = False
+    if not all_enqueued:
+        logging.warning("Event queue is full: %s", event_dispatcher.stats)
+        abort(503)
+    mark_first_webhook()
     return 'OK'
-    
-# 用戶傳送訊息的時候做出的回覆
-@handler.add(MessageEvent, message=TextMessage)
-def handle_text_message(event):
-    user_id = str(event.source.user_id)
-    msg = str(event.message.text)
-    reply_token = str(event.reply_token)
-
-    if msg == 'exit' and user_board.is_user_exist(user_id):
-        user_board.remove_user(user_id)
-        return None
-    
-    #使用者不存在時，新增一名使用者。
-    if not user_board.is_user_exist(user_id):
-        user_board.add_user(user_id)
-        
-    user = user_board.get_user(user_id)
-
-    #使用者回答問題的間隔過長或已結束一次預測時，重設使用者狀態。
-    if user.is_timeout and not user.is_end:
-        user.reset()
-        line_bot_api.reply_message(reply_token=reply_token, messages=[TextSendMessage(text="您已超時"), TextSendMessage(text="請重新來過")])
-        return None
-    
-    if user.is_end:
-        user.reset()
-    
 
-    '''
-    如果使用者當前的問題尚未被問出
-    讓機器人先問問題
-    待下一次使用者回應時
-    再對該問題進行回覆
-    '''
-    if not user.current_question.is_asked:
-        user.current_question.ask(line_bot_api=line_bot_api, reply_token=reply_token)
-        return None
-
-    if isinstance(user.current_question, ButtonQuestion):
-        # 按鈕問題不應該輸入文字回答
-        line_bot_api.reply_message(reply_token, TextSendMessage(text="請選擇按鈕選項"))
-        return None
-    
-    ans_is_valid = user.current_question.answer(line_bot_api=line_bot_api, reply_token=reply_token, ans=msg)
-    if not ans_is_valid:
-        return None
-    
-    if not user.arrived_at_last_question:
-        user.goto_next_question()
-    else:
-        user.finalize(line_bot_api=line_bot_api, reply_token=reply_token)
 
+@app.route("/metrics", methods=['GET'])
+def metrics():
     '''
-    user.finalize()後
-    user不一定會進入end狀態
-    因為可能會讀入下一個問題集
-    此時必須問出剛讀進來的問題
+    Prometheus 文字格式的 metrics，各執行緒的計數在這裡才加總
     '''
-    if not user.is_end:
-        user.current_question.ask(line_bot_api=line_bot_api, reply_token=reply_token)
-        return None
-   
-# 按鈕按下之後的回應
-@handler.add(PostbackEvent)
-def handle_postback(event: PostbackEvent):
-    # 獲取使用者與回傳的按鈕資訊
-    postback_data = str(event.postback.data)
-    user_id = str(event.source.user_id)
-    reply_token = str(event.reply_token)
-
-    if postback_data == 'exit' and user_board.is_user_exist(user_id):
-        user_board.remove_user(user_id)
-        return None
-    
-    if not user_board.is_user_exist(user_id):
-        return None
-        
-    user = user_board.get_user(user_id)
-
-    #使用者回答問題的間隔過長或已結束一次預測時，重設使用者狀態。
-    if user.is_timeout and not user.is_end:
-        user.reset()
-        line_bot_api.reply_message(reply_token=reply_token, messages=[TextSendMessage(text="您已超時"), TextSendMessage(text="請重新來過")])
-        return None
-    
-    if user.is_end:
-        user.reset()
+    return Response(metrics_registry.render(), mimetype="text/plain; version=0.0.4")
 
-    '''
-    如果使用者當前的問題尚未被問出
-    讓機器人先問問題
-    待下一次使用者回應時
-    再對該問題進行回覆
-    '''
 
-    if not user.current_question.is_asked:
-        user.current_question.ask(line_bot_api=line_bot_api, reply_token=reply_token)
-        return None
-
-    if isinstance(user.current_question, TextQuestion):
-        # 文字問題不應該按按鈕回答
-        line_bot_api.reply_message(reply_token, TextSendMessage(text="請輸入文字"))
-        return None
-    
-    ans_is_valid = user.current_question.answer(line_bot_api=line_bot_api, reply_token=reply_token, ans=postback_data)
-    if not ans_is_valid:
-        return None
-    
-    if not user.arrived_at_last_question:
-        user.goto_next_question()
-    else:
-        user.finalize(line_bot_api=line_bot_api, reply_token=reply_token)
+# 用戶傳送訊息的時候做出的回覆
+def handle_text_message(event: WebhookEvent):
+    # 所有回覆先收集起來，處理完後只呼叫一次 reply_message
+    with bot.tracer.event(event.kind):
+        reply = ReplyCollector(line_bot_api=line_bot_api, reply_token=event.reply_token, user_id=event.user_id)
+        bot.handle_text_message(user_id=event.user_id, msg=event.text, reply=reply)
+        reply.flush()
+
 
-    '''
-    user.finalize()後
-    user不一定會進入end狀態
-    因為可能會讀入下一個問題集
-    此時必須問出剛讀進來的問題
-    '''
-    if not user.is_end: 
-        user.current_question.ask(line_bot_api=line_bot_api, reply_token=reply_token)
-        return None
+# 按鈕按下之後的回應
+def handle_postback(event: WebhookEvent):
+    with bot.tracer.event(event.kind):
+        reply = ReplyCollector(line_bot_api=line_bot_api, reply_token=event.reply_token, user_id=event.user_id)
+        bot.handle_postback(user_id=event.user_id, postback_data=event.postback_data, reply=reply)
+        reply.flush()
 
-    
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=8080)
\ No newline at end of file
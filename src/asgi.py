@@ -0,0 +1,254 @@
+from utils.startup import startup_report, report_enabled
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import partial
+
+from linebot import AsyncLineBotApi
+from linebot.aiohttp_async_http_client import AiohttpAsyncHttpClient
+
+import asyncio
+import logging
+import time
+
+import aiohttp
+
+import bot
+from models import ReplyCollector
+from services import WebhookIngestor, WebhookEvent, WebhookError, Trace, metrics_registry, stage_seconds
+from vars import access_token, secret, line_api_endpoint, webhook_max_body_bytes
+from vars import async_line_pool_size, async_handler_threads, startup_warm_up
+
+'''
+ASGI 服務模式，與 app.py 的 Flask 服務共用 bot.py 的對話邏輯。
+可用任何 ASGI server 啟動，例如:
+    uvicorn asgi:app --host 0.0.0.0 --port 8080
+    gunicorn -k uvicorn.workers.UvicornWorker -b 0.0.0.0:8080 asgi:app
+
+webhook 驗證簽名後立即回應，每個事件各自成為一個 coroutine。
+對 LINE 的回覆透過 AsyncLineBotApi 與共用的 aiohttp 連線池送出，
+大量回覆同時等待 LINE 回應時不需要佔用執行緒。
+對話邏輯本身 (含預測 API 呼叫) 是同步程式，交給有上限的執行緒池執行。
+同一使用者的事件以 asyncio.Lock 依序處理。
+'''
+
+ingestor = WebhookIngestor(secret, max_body_bytes=webhook_max_body_bytes)
+metrics_registry.register_stats("linebot_webhook", "Webhook request parsing", lambda: ingestor.stats)
+handler_executor = ThreadPoolExecutor(max_workers=async_handler_threads, thread_name_prefix="asgi-handler")
+
+http_session: aiohttp.ClientSession | None = None
+event_loop: asyncio.AbstractEventLoop | None = None
+line_bot_api: AsyncLineBotApi | None = None
+pending_tasks: set[asyncio.Task] = set()
+
+
+class UserLocks(object):
+    '''
+    每個使用者一把 asyncio.Lock，沒有人等待時就移除
+    '''
+    def __init__(self) -> None:
+        self._locks: dict[str, tuple[asyncio.Lock, int]] = {}
+
+    @asynccontextmanager
+    async def hold(self, user_id: str):
+        lock, waiters = self._locks.get(user_id, (None, 0))
+        if lock is None:
+            lock = asyncio.Lock()
+        self._locks[user_id] = (lock, waiters + 1)
+        try:
+            async with lock:
+                yield
+        finally:
+            lock, waiters = self._locks[user_id]
+            if waiters <= 1:
+                del self._locks[user_id]
+            else:
+                self._locks[user_id] = (lock, waiters - 1)
+
+
+user_locks = UserLocks()
+startup_report.mark("imports")
+
+
+async def startup() -> None:
+    global http_session, line_bot_api, event_loop
+    if http_session is not None:
+        return
+    event_loop = asyncio.get_running_loop()
+    connector = aiohttp.TCPConnector(limit=async_line_pool_size, keepalive_timeout=60)
+    http_session = aiohttp.ClientSession(connector=connector)
+    line_bot_api = AsyncLineBotApi(access_token, AiohttpAsyncHttpClient(http_session), endpoint=line_api_endpoint)
+    if startup_warm_up:
+        track(asyncio.create_task(warm_up()))
+    startup_report.mark("app_ready")
+
+
+async def warm_up() -> None:
+    '''
+    預先連上 LINE API 與預測 API，連線留在各自的連線池中
+    '''
+    loop = asyncio.get_running_loop()
+    prediction = loop.run_in_executor(handler_executor, bot.warm_up)
+    try:
+        async with http_session.head(line_api_endpoint) as response:
+            await response.read()
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logging.warning("Unable to warm up LINE API connection: %s", e)
+    startup_report.mark("line_api_warm_up")
+    await prediction
+    startup_report.mark("prediction_api_warm_up")
+
+
+def dispatch_deferred(user_id: str, event) -> None:
+    '''
+    coalesce 模式下被擱置的事件由流量控制的執行緒呼叫，轉回 event loop 處理
+    '''
+    if event_loop is not None:
+        event_loop.call_soon_threadsafe(lambda: track(asyncio.create_task(handle_event(event))))
+
+
+flood_control = bot.create_flood_control(handle=dispatch_deferred)
+
+bot.install_session_snapshot()
+startup_report.mark("session_restore")
+
+# 超時與再次篩檢的主動通知在背景執行緒送出，不佔用處理 webhook 的執行緒
+bot.install_reminders()
+
+
+def track(task: asyncio.Task) -> None:
+    pending_tasks.add(task)
+    task.add_done_callback(pending_tasks.discard)
+
+
+async def shutdown() -> None:
+    global http_session, line_bot_api
+    if pending_tasks:
+        await asyncio.wait(pending_tasks, timeout=5)
+    if http_session is not None:
+        await http_session.close()
+    http_session = None
+    line_bot_api = None
+
+
+async def handle_event(event: WebhookEvent) -> None:
+    reply = ReplyCollector(line_bot_api=line_bot_api, reply_token=event.reply_token, user_id=event.user_id)
+    if event.kind == WebhookEvent.TEXT:
+        handle = partial(bot.handle_text_message, user_id=event.user_id, msg=event.text, reply=reply)
+    elif event.kind == WebhookEvent.POSTBACK:
+        handle = partial(bot.handle_postback, user_id=event.user_id, postback_data=event.postback_data, reply=reply)
+    else:
+        return
+
+    # 對話邏輯在執行緒池中執行，追蹤時在該執行緒上記錄階段與 call stack；
+    # 回覆在 event loop 上送出，只記錄耗時
+    trace = bot.tracer.start(event.kind)
+    loop = asyncio.get_running_loop()
+    async with user_locks.hold(event.user_id):
+        # 與 Flask 相同，處理失敗時保留 claim
+        with bot.handling_event(event):
+            await loop.run_in_executor(handler_executor, run_traced, trace, handle)
+            start = time.perf_counter()
+            await reply.flush_async()
+            if trace is not None:
+                trace.add_span("reply_message", time.perf_counter() - start)
+    if trace is not None:
+        await loop.run_in_executor(handler_executor, bot.tracer.finish, trace)
+
+
+def run_traced(trace: Trace | None, handle) -> None:
+    with bot.tracer.attached(trace):
+        handle()
+
+
+async def webhook(body: bytes, signature: str | None) -> int:
+    '''
+    Return the HTTP status code of the webhook response
+    '''
+    start = time.perf_counter()
+    try:
+        events = ingestor.parse(body, signature)
+    except WebhookError as e:
+        return e.status_code
+    finally:
+        stage_seconds.observe(time.perf_counter() - start, "signature")
+
+    for event in events:
+        if not bot.claim_event(event):
+            continue
+        if flood_control is not None and not flood_control.admit(event.user_id, event):
+            continue
+        track(asyncio.create_task(handle_event(event)))
+    if startup_report.mark("first_webhook") and report_enabled:
+        startup_report.remove_import_hook()
+        startup_report.log()
+    return 200
+
+
+async def read_body(receive, limit: int) -> bytes | None:
+    '''
+    Return None as soon as the body exceeds limit bytes
+    '''
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        chunk = message.get("body", b"")
+        size += len(chunk)
+        if size > limit:
+            return None
+        chunks.append(chunk)
+        if not message.get("more_body", False):
+            return b"".join(chunks)
+
+
+async def send_response(send, status: int, body: bytes, content_type: bytes = b"text/plain; charset=utf-8") -> None:
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", content_type), (b"content-length", str(len(body)).encode())],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def app(scope, receive, send) -> None:
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await startup()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    if scope["type"] != "http":
+        return
+
+    # 沒有 lifespan 支援的 server 在第一個請求時才建立連線池
+    await startup()
+
+    if scope["path"] == "/metrics" and scope["method"] == "GET":
+        await send_response(send, 200, metrics_registry.render().encode(), content_type=b"text/plain; version=0.0.4; charset=utf-8")
+        return
+    if scope["path"] != "/":
+        await send_response(send, 404, b"Not Found")
+        return
+    if scope["method"] != "POST":
+        await send_response(send, 405, b"Method Not Allowed")
+        return
+
+    headers = dict(scope["headers"])
+    signature = headers.get(b"x-line-signature")
+    # Content-Length 超過上限時不需要讀取內容
+    content_length = headers.get(b"content-length")
+    if content_length is not None and content_length.isdigit() and int(content_length) > webhook_max_body_bytes:
+        body = None
+    else:
+        body = await read_body(receive, webhook_max_body_bytes)
+    if body is None:
+        await send_response(send, 413, b"Payload Too Large")
+        return
+    status = await webhook(body, signature.decode("latin-1") if signature is not None else None)
+    await send_response(send, status, b"OK" if status == 200 else b"Bad Request")
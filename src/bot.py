@@ -0,0 +1,337 @@
+from models import UserBoard, User, ReplyCollector, TextQuestion, ButtonQuestion
+from models import get_prediction_client, text_message, CompletionStore
+from models import MemorySessionStore, SqliteSessionStore, SessionConflict, UserSession, ReminderScheduler
+from services import metrics_registry, stage_seconds, session_timeouts, duplicate_events, failed_events
+from services import FloodControl, KeyedRateLimiter, TokenBucket, WebhookEvent, EventTracer
+from services import MulticastSender, PooledRequestsHttpClient
+from vars import access_token, line_api_endpoint
+from vars import session_store_backend, session_store_path, user_timeout, max_sessions, session_snapshot_path
+from vars import event_dedup_window, event_dedup_size
+from vars import rate_limit_user_rate, rate_limit_user_burst, rate_limit_global_rate, rate_limit_global_burst, rate_limit_policy
+from vars import trace_sample_rate, trace_slow_threshold, trace_dir, trace_ring_size, trace_profile_interval
+from vars import reminder_interval, reminder_rate, reminder_burst, reminder_max_retries, reminder_retry_backoff
+from vars import reminder_page_size, reminder_timeout_nudge, reminder_rescreen_after, reminder_rescreen_text, reminder_store_path
+
+from linebot import LineBotApi
+
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator
+
+import atexit
+import logging
+import signal
+import threading
+
+'''
+機器人的對話邏輯，Flask (app.py) 與 ASGI (asgi.py) 兩種服務方式共用。
+處理函數只把要回覆的訊息放進 ReplyCollector，實際送出由呼叫端負責。
+'''
+
+if session_store_backend == "sqlite":
+    session_store = SqliteSessionStore(timeout=user_timeout, path=session_store_path, max_sessions=max_sessions,
+                                       event_window=event_dedup_window, max_events=event_dedup_size)
+else:
+    session_store = MemorySessionStore(timeout=user_timeout, max_sessions=max_sessions,
+                                       event_window=event_dedup_window, max_events=event_dedup_size)
+user_board = UserBoard(store=session_store)
+
+# 只有 memory 模式需要快照，sqlite 的狀態本來就存在檔案中
+snapshot_path = session_snapshot_path if session_store_backend != "sqlite" else ""
+
+metrics_registry.gauge("linebot_live_sessions", "Sessions currently kept in the session store", session_store.count)
+metrics_registry.register_stats("linebot_session_store", "Session store", lambda: user_board.stats)
+metrics_registry.register_histogram("linebot_reply_flush_seconds", "Time to send all replies of one event", ReplyCollector.latency)
+
+# 抽樣追蹤事件，階段耗時由 stage_seconds 轉記到正在追蹤的事件上
+tracer = EventTracer(sample_rate=trace_sample_rate, threshold=trace_slow_threshold, directory=trace_dir,
+                     ring_size=trace_ring_size, interval=trace_profile_interval)
+if tracer.enabled:
+    stage_seconds.set_listener(tracer.record_stage)
+    metrics_registry.register_stats("linebot_tracer", "Sampled event tracing", lambda: tracer.stats)
+
+TIMEOUT_MESSAGES = [text_message("您已超時"), text_message("請重新來過")]
+# sqlite 模式下同一位使用者的事件同時在不同 worker 處理時，最多重新處理幾次
+SESSION_CONFLICT_ATTEMPTS = 3
+CHOOSE_BUTTON_MESSAGE = text_message("請選擇按鈕選項")
+ENTER_TEXT_MESSAGE = text_message("請輸入文字")
+
+# 開啟 rescreen 通知時記住完成預測的使用者 (見 install_reminders)
+completion_store: CompletionStore | None = None
+
+
+def claim_event(event: WebhookEvent) -> bool:
+    '''
+    Return False if the webhook event was already handled (LINE redelivered it) and must be skipped
+    '''
+    event_id = event.webhook_event_id
+    if not event_id:
+        return True
+    if session_store.claim_event(event_id):
+        return True
+    duplicate_events.inc()
+    return False
+
+
+def release_event(event: WebhookEvent) -> None:
+    '''
+    只用於處理函數從未執行的事件 (例如佇列已滿)，讓 LINE 重送時能再處理；
+    處理函數執行過後，即使失敗也不能 release，否則重送的事件會再回答一次同一個問題
+    '''
+    event_id = event.webhook_event_id
+    if event_id:
+        session_store.release_event(event_id)
+
+
+@contextmanager
+def handling_event(event: WebhookEvent) -> Iterator[None]:
+    '''
+    包住已 claim 事件的處理 (對話邏輯與送出回覆)，Flask 與 ASGI 都經過這裡。
+    處理函數開始執行後不論成功與否都不 release_event: 使用者狀態可能已經寫回，
+    LINE 重送時再處理一次會重複回答同一個問題。失敗 (通常是回覆送不出去) 只記錄，webhook 仍回傳 200
+    '''
+    try:
+        yield
+    except Exception:
+        failed_events.inc(event.kind)
+        logging.exception("Failed to handle %s event of %s", event.kind, event.user_id)
+
+
+def create_flood_control(handle: Callable[[str, Any], None]) -> FloodControl | None:
+    '''
+    依環境變數建立流量控制，兩種限制都關閉時回傳 None。
+    handle 用於 coalesce 模式，處理稍後才輪到的事件
+    '''
+    user_limiter = KeyedRateLimiter(rate_limit_user_rate, rate_limit_user_burst) if rate_limit_user_rate > 0 else None
+    global_limiter = TokenBucket(rate_limit_global_rate, rate_limit_global_burst) if rate_limit_global_rate > 0 else None
+    if user_limiter is None and global_limiter is None:
+        return None
+    flood_control = FloodControl(user_limiter=user_limiter, global_limiter=global_limiter, policy=rate_limit_policy, handle=handle)
+    metrics_registry.register_stats("linebot_flood_control", "Per-user and global rate limiting", lambda: flood_control.stats)
+    return flood_control
+
+
+def save_sessions() -> None:
+    try:
+        user_board.snapshot(snapshot_path)
+    except OSError:
+        logging.exception("Unable to write session snapshot to %s", snapshot_path)
+
+
+def install_session_snapshot() -> None:
+    '''
+    啟動時讀回上次結束前的快照，並在 process 結束時寫入新的快照。
+    gunicorn 與 uvicorn 收到 SIGTERM 時會先處理完進行中的請求再正常結束，atexit 在那之後才執行，
+    寫快照時不會有請求同時修改使用者狀態；
+    其餘情況 (例如直接執行 app.py) SIGTERM 預設會直接終止 process，改為丟出 SystemExit 讓 atexit 有機會執行
+    '''
+    if not snapshot_path:
+        return
+    restored = user_board.restore(snapshot_path)
+    metrics_registry.register_stats("linebot_session_restore", "Sessions restored from the snapshot at startup", lambda: restored)
+    atexit.register(save_sessions)
+    if threading.current_thread() is threading.main_thread() and signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+        signal.signal(signal.SIGTERM, _exit_on_sigterm)
+
+
+def _exit_on_sigterm(signum, frame) -> None:
+    raise SystemExit(128 + signum)
+
+
+def install_reminders() -> ReminderScheduler | None:
+    '''
+    依環境變數啟動背景的主動通知，REMINDER_INTERVAL 為 0 或兩種通知都關閉時回傳 None。
+    multicast 使用專用的 LineBotApi (SDK 會把 retry key 留在 instance 上)，不與回覆共用
+    '''
+    global completion_store
+    nudge_messages = TIMEOUT_MESSAGES if reminder_timeout_nudge else None
+    rescreen_messages = [text_message(reminder_rescreen_text)] if reminder_rescreen_after > 0 else None
+    if reminder_interval <= 0 or (nudge_messages is None and rescreen_messages is None):
+        return None
+    if rescreen_messages is not None:
+        completion_store = CompletionStore(reminder_store_path)
+        metrics_registry.register_stats("linebot_completions", "Completed users waiting for a rescreen reminder",
+                                        lambda: completion_store.stats)
+
+    line_bot_api = LineBotApi(access_token, endpoint=line_api_endpoint, http_client=PooledRequestsHttpClient)
+    sender = MulticastSender(line_bot_api, TokenBucket(reminder_rate, reminder_burst), max_retries=reminder_max_retries,
+                             backoff=reminder_retry_backoff)
+    scheduler = ReminderScheduler(user_board, sender, nudge_messages=nudge_messages, rescreen_messages=rescreen_messages,
+                                  rescreen_after=reminder_rescreen_after, completions=completion_store,
+                                  interval=reminder_interval, page_size=reminder_page_size)
+    if nudge_messages is not None:
+        # sweep 在掃描之前就移除的超時使用者
+        user_board.set_expire_listener(scheduler.expired)
+    metrics_registry.register_stats("linebot_reminders", "Background reminders", lambda: scheduler.stats)
+    metrics_registry.register_stats("linebot_multicast", "Batched multicast to LINE", lambda: sender.stats)
+    atexit.register(scheduler.stop, 5)
+    scheduler.start()
+    return scheduler
+
+
+def warm_up() -> None:
+    '''
+    建立預測 API client 並預先連線，
+    讓第一位使用者的預測不需要等待連線建立
+    '''
+    get_prediction_client().warm_up()
+
+
+def in_session(user_id: str, reply: ReplyCollector, handle: Callable[[UserSession], None]) -> None:
+    '''
+    同一使用者的事件在 session 中依序處理，離開時 (不論從哪裡返回) 把使用者狀態寫回 session store。
+    寫回時發現其他 worker 已修改了這位使用者 (SessionConflict)，捨棄這次加入的回覆，以最新的狀態重新處理。
+    成功寫回後，這次事件完成了預測的使用者記進 completion_store
+    '''
+    count = len(reply.messages)
+    for attempt in range(SESSION_CONFLICT_ATTEMPTS):
+        try:
+            with user_board.session(user_id) as session:
+                completed_at = session.user.completed_at if session.user is not None else None
+                handle(session)
+                user = session.user
+        except SessionConflict:
+            if attempt == SESSION_CONFLICT_ATTEMPTS - 1:
+                raise
+            reply.truncate(count)
+            continue
+        if completion_store is not None and user is not None and user.completed_at != completed_at:
+            completion_store.record(user_id, user.completed_at)
+        return None
+
+
+# 用戶傳送訊息的時候做出的回覆
+def handle_text_message(user_id: str, msg: str, reply: ReplyCollector):
+    def handle(session: UserSession):
+        if msg == 'exit' and session.user is not None:
+            session.remove()
+            return None
+
+        if session.take_timed_out():
+            reply_timed_out(session, reply)
+            return None
+
+        #使用者不存在時，新增一名使用者。
+        user = session.get_or_create()
+        process_text_message(user=user, msg=msg, reply=reply)
+
+    in_session(user_id, reply, handle)
+
+
+def reply_timed_out(session: UserSession, reply: ReplyCollector):
+    '''
+    回答到一半就超時、已被 sweep 移除的使用者，與還在 session store 中的超時使用者一樣從頭開始並回覆超時訊息
+    '''
+    session.get_or_create()
+    session_timeouts.inc()
+    reply.add(TIMEOUT_MESSAGES)
+
+
+def process_text_message(user: User, msg: str, reply: ReplyCollector):
+    #使用者回答問題的間隔過長或已結束一次預測時，重設使用者狀態。
+    if user.is_timeout and not user.is_end:
+        user.reset()
+        session_timeouts.inc()
+        reply.add(TIMEOUT_MESSAGES)
+        return None
+    
+    if user.is_end:
+        user.reset()
+    
+
+    '''
+    如果使用者當前的問題尚未被問出
+    讓機器人先問問題
+    待下一次使用者回應時
+    再對該問題進行回覆
+    '''
+    if not user.current_question_is_asked:
+        user.ask_current_question(reply=reply)
+        return None
+
+    if isinstance(user.current_question, ButtonQuestion):
+        # 按鈕問題不應該輸入文字回答
+        reply.add(CHOOSE_BUTTON_MESSAGE)
+        return None
+    
+    ans_is_valid = user.answer_current_question(reply=reply, ans=msg)
+    if not ans_is_valid:
+        return None
+    
+    if not user.arrived_at_last_question:
+        user.goto_next_question()
+    else:
+        user.finalize(reply=reply)
+
+    '''
+    user.finalize()後
+    user不一定會進入end狀態
+    因為可能會讀入下一個問題集
+    此時必須問出剛讀進來的問題
+    '''
+    if not user.is_end:
+        user.ask_current_question(reply=reply)
+        return None
+   
+# 按鈕按下之後的回應
+def handle_postback(user_id: str, postback_data: str, reply: ReplyCollector):
+    def handle(session: UserSession):
+        if postback_data == 'exit' and session.user is not None:
+            session.remove()
+            return None
+
+        if session.take_timed_out():
+            reply_timed_out(session, reply)
+            return None
+
+        # 不存在的使用者 (例如很久以前的按鈕) 與傳文字訊息相同，新增一名使用者並問出初始問題
+        user = session.get_or_create()
+        process_postback(user=user, postback_data=postback_data, reply=reply)
+
+    in_session(user_id, reply, handle)
+
+
+def process_postback(user: User, postback_data: str, reply: ReplyCollector):
+    #使用者回答問題的間隔過長或已結束一次預測時，重設使用者狀態。
+    if user.is_timeout and not user.is_end:
+        user.reset()
+        session_timeouts.inc()
+        reply.add(TIMEOUT_MESSAGES)
+        return None
+    
+    if user.is_end:
+        user.reset()
+
+    '''
+    如果使用者當前的問題尚未被問出
+    讓機器人先問問題
+    待下一次使用者回應時
+    再對該問題進行回覆
+    '''
+
+    if not user.current_question_is_asked:
+        user.ask_current_question(reply=reply)
+        return None
+
+    if isinstance(user.current_question, TextQuestion):
+        # 文字問題不應該按按鈕回答
+        reply.add(ENTER_TEXT_MESSAGE)
+        return None
+    
+    ans_is_valid = user.answer_current_question(reply=reply, ans=postback_data)
+    if not ans_is_valid:
+        return None
+    
+    if not user.arrived_at_last_question:
+        user.goto_next_question()
+    else:
+        user.finalize(reply=reply)
+
+    '''
+    user.finalize()後
+    user不一定會進入end狀態
+    因為可能會讀入下一個問題集
+    此時必須問出剛讀進來的問題
+    '''
+    if not user.is_end: 
+        user.ask_current_question(reply=reply)
+        return None
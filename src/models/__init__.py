@@ -1,2 +1,11 @@
-from .user_board import UserBoard
-from .question import TextQuestion, ButtonQuestion
\ No newline at end of file
+from .user import User, get_predictor, get_prediction_client
+from .reply_collector import ReplyCollector
+from .user_board import UserBoard, UserSession
+from .session_store import SessionStore, SessionConflict, MemorySessionStore, SqliteSessionStore
+from .session_snapshot import write_snapshot, read_snapshot
+from .completion_store import CompletionStore
+from .reminder_scheduler import ReminderScheduler
+from .question import TextQuestion, ButtonQuestion
+from .flow import FlowEngine, Transition
+from .validator import CompiledValidator
+from .message import PrecompiledMessage, precompile, text_message
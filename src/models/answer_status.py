@@ -1,12 +1,20 @@
+from typing import Any
+
+
 class AnswerStatus(object):
-    def __init__(self, ans_is_valid: bool, err_msg: str = "") -> None:
+    def __init__(self, ans_is_valid: bool, err_msg: str = "", value: Any = None) -> None:
         self._ans_is_valid = ans_is_valid
         self._err_msg = err_msg
+        self._value = value
 
     @property
     def ans_is_valid(self) -> bool:
         return self._ans_is_valid
-    
+
     @property
     def err_msg(self) -> bool:
-        return self._err_msg
\ No newline at end of file
+        return self._err_msg
+
+    @property
+    def value(self) -> Any:
+        return self._value
\ No newline at end of file
@@ -1,7 +1,11 @@
 from abc import ABC, abstractmethod
-from typing import Any
+from typing import Any, Callable
 from enum import Enum
 
+import operator
+import re
+
+
 
 class CompareMethod(Enum):
     ST = "st"
@@ -9,7 +13,22 @@ class CompareMethod(Enum):
     BT = "be"
     BTE = "bte"
     EQ = "qu"
-    
+
+
+# compile() 產生的函數在檢查失敗時回傳的值，不使用例外
+INVALID = object()
+
+_OPERATORS = {
+    CompareMethod.ST: operator.lt,
+    CompareMethod.STE: operator.le,
+    CompareMethod.BT: operator.gt,
+    CompareMethod.BTE: operator.ge,
+    CompareMethod.EQ: operator.eq,
+}
+
+_INT_PATTERN = re.compile(r"[+-]?[0-9]+")
+_FLOAT_PATTERN = re.compile(r"[+-]?(?:[0-9]+\.?[0-9]*|\.[0-9]+)")
+
 
 class CheckStrategy(ABC):
     @abstractmethod
@@ -25,6 +44,37 @@ class CheckStrategy(ABC):
     def error_message(self) -> str:
         pass
 
+    def compile(self) -> Callable[[Any], Any]:
+        '''
+        回傳合併 check 與 transfer 的單一函數，
+        檢查通過時回傳轉換後的值，否則回傳 INVALID
+        '''
+        check, transfer = self.check, self.transfer
+
+        def step(value: Any) -> Any:
+            return transfer(value) if check(value) else INVALID
+        return step
+
+    def check_column(self, values):
+        '''
+        一次檢查一整欄 (numpy array) 的值，回傳 (轉換後的值, 是否通過的 bool array)。
+        預設逐筆呼叫 compile() 的結果，子類別可以改用向量化的實作。
+        '''
+        return self._check_column_by_step(values, dtype=object)
+
+    def _check_column_by_step(self, values, dtype):
+        import numpy as np
+
+        step = self.compile()
+        out = np.zeros(len(values), dtype=dtype) if dtype is not object else np.empty(len(values), dtype=object)
+        ok = np.zeros(len(values), dtype=bool)
+        for i, value in enumerate(values):
+            result = step(value)
+            if result is not INVALID:
+                out[i] = result
+                ok[i] = True
+        return out, ok
+
 
 class IntCheckStrategy(CheckStrategy):
     def check(self, value: Any) -> bool:
@@ -40,6 +90,27 @@ class IntCheckStrategy(CheckStrategy):
     @property
     def error_message(self) -> str:
         return "請輸入一個整數"
+
+    def compile(self) -> Callable[[Any], Any]:
+        fast = _INT_PATTERN.fullmatch
+
+        def step(value: Any) -> Any:
+            if type(value) is str and fast(value):
+                return int(value)
+            # 前後空白、全形數字等少見的寫法才走例外
+            try:
+                return int(value)
+            except (ValueError, TypeError):
+                return INVALID
+        return step
+
+    def check_column(self, values):
+        import numpy as np
+
+        try:
+            return np.asarray(values, dtype=str).astype(np.int64), np.ones(len(values), dtype=bool)
+        except (ValueError, OverflowError):
+            return self._check_column_by_step(values, dtype=object)
         
 
 class FloatCheckStrategy(CheckStrategy):
@@ -56,6 +127,26 @@ class FloatCheckStrategy(CheckStrategy):
     @property
     def error_message(self) -> str:
         return "請輸入一個浮點數"
+
+    def compile(self) -> Callable[[Any], Any]:
+        fast = _FLOAT_PATTERN.fullmatch
+
+        def step(value: Any) -> Any:
+            if type(value) is str and fast(value):
+                return float(value)
+            try:
+                return float(value)
+            except (ValueError, TypeError):
+                return INVALID
+        return step
+
+    def check_column(self, values):
+        import numpy as np
+
+        try:
+            return np.asarray(values, dtype=str).astype(np.float64), np.ones(len(values), dtype=bool)
+        except ValueError:
+            return self._check_column_by_step(values, dtype=np.float64)
         
 
 class InListCheckStrategy(CheckStrategy):
@@ -73,6 +164,25 @@ class InListCheckStrategy(CheckStrategy):
     def error_message(self) -> str:
         check_str = ", ".join(map(str, self._check_list))
         return f"請輸入[{check_str}]中的其中一個值"
+
+    def compile(self) -> Callable[[Any], Any]:
+        try:
+            allowed = frozenset(self._check_list)
+        except TypeError:
+            return super().compile()
+
+        def step(value: Any) -> Any:
+            return value if value in allowed else INVALID
+        return step
+
+    def check_column(self, values):
+        import numpy as np
+
+        try:
+            ok = np.isin(values, list(self._check_list))
+        except TypeError:
+            return super().check_column(values)
+        return values, ok
     
 
 class CompareCheckStrategy(CheckStrategy):
@@ -111,4 +221,16 @@ class CompareCheckStrategy(CheckStrategy):
         if self._method == CompareMethod.STE:
             return f"請輸入小於等於{self._value}的值"
         return "無法比較"
-        
\ No newline at end of file
+
+    def compile(self) -> Callable[[Any], Any]:
+        compare = _OPERATORS[self._method]
+        bound = self._value
+
+        def step(value: Any) -> Any:
+            return value if isinstance(value, (int, float)) and compare(value, bound) else INVALID
+        return step
+
+    def check_column(self, values):
+        if values.dtype.kind not in "iuf":
+            return super().check_column(values)
+        return values, _OPERATORS[self._method](values, self._value)
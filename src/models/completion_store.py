@@ -0,0 +1,78 @@
+from typing import Any
+
+import sqlite3
+import threading
+import time
+
+
+class CompletionStore(object):
+    '''
+    記住完成預測的使用者與完成時間，供 ReminderScheduler 送出 rescreen 通知。
+    與 session store 分開保存，不受使用者超時 (USER_TIMEOUT) 與 sweep 影響，
+    完成預測很久之後、session 早已被移除的使用者也能收到通知。
+    存在 SQLite 檔案中，同一台機器上的多個 worker 共用，process 重新啟動後仍然存在。
+    每位使用者只記住最近一次完成，送出通知前以 claim 刪除，每次完成只會通知一次。
+    '''
+    def __init__(self, path: str) -> None:
+        self._path = path
+        self._local = threading.local()
+        self._recorded = 0
+        self._claimed = 0
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS completions (user_id TEXT PRIMARY KEY, completed_at REAL NOT NULL)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS completions_completed_at ON completions (completed_at, user_id)")
+
+    @property
+    def _connection(self) -> sqlite3.Connection:
+        # 與 SqliteSessionStore 相同，每個執行緒各自建立一條連線
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self._path, timeout=5, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    @property
+    def stats(self) -> dict[str, int]:
+        return {
+            "pending": self.count(),
+            "recorded": self._recorded,
+            "claimed": self._claimed,
+        }
+
+    def count(self) -> int:
+        return self._connection.execute("SELECT COUNT(*) FROM completions").fetchone()[0]
+
+    def record(self, user_id: str, completed_at: float | None = None) -> None:
+        completed_at = time.time() if completed_at is None else completed_at
+        self._connection.execute(
+            "INSERT OR REPLACE INTO completions (user_id, completed_at) VALUES (?, ?)", (user_id, completed_at)
+        )
+        self._recorded += 1
+
+    def scan(self, before: float, cursor: Any = None, limit: int = 500) -> tuple[list[tuple[str, float]], Any]:
+        '''
+        分頁讀取 before 之前完成的使用者，依完成時間排序，只走訪到期的部分。
+        Return ([(user_id, completed_at), ...], next cursor)，next cursor 為 None 代表已讀完
+        '''
+        completed_at, user_id = cursor or (float("-inf"), "")
+        rows = self._connection.execute(
+            "SELECT user_id, completed_at FROM completions WHERE completed_at <= ? AND (completed_at, user_id) > (?, ?) "
+            "ORDER BY completed_at, user_id LIMIT ?",
+            (before, completed_at, user_id, limit)
+        ).fetchall()
+        return rows, (rows[-1][1], rows[-1][0]) if len(rows) == limit else None
+
+    def claim(self, user_id: str, completed_at: float) -> bool:
+        '''
+        Return True if this caller should send the reminder of this completion.
+        多個 worker 同時掃描時只有一個會刪除成功；使用者在掃描後又完成一次時 completed_at 不同，留給下一次
+        '''
+        claimed = self._connection.execute(
+            "DELETE FROM completions WHERE user_id = ? AND completed_at = ?", (user_id, completed_at)
+        ).rowcount == 1
+        if claimed:
+            self._claimed += 1
+        return claimed
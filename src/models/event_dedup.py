@@ -0,0 +1,75 @@
+import threading
+import time
+
+
+class EventDedupIndex(object):
+    '''
+    記住最近處理過的 webhook event ID，LINE 重送同一個事件時可以直接略過
+    (MemorySessionStore 也用它記住被 sweep 移除的超時使用者)。
+    以固定大小的環狀緩衝區依時間順序保存 ID，另以 dict 做 O(1) 查詢；
+    超過 window 秒或緩衝區滿時，最舊的 ID 會被移除。
+
+    capacity: 最多記住幾個 ID
+    window: 每個 ID 記住幾秒
+    '''
+    def __init__(self, capacity: int = 100000, window: float = 3600) -> None:
+        self._capacity = max(1, capacity)
+        self._window = window
+        # 每一格為 (event_id, 序號, 時間)，_head 指向最舊的一格
+        self._ring: list[tuple[str, int, float] | None] = [None] * self._capacity
+        self._head = 0
+        self._size = 0
+        # event_id -> 序號，序號用來判斷被 release 後又重新加入的 ID
+        self._seen: dict[str, int] = {}
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._seen)
+
+    @property
+    def capacity(self) -> int:
+        return self._capacity
+
+    @property
+    def window(self) -> float:
+        return self._window
+
+    def claim(self, event_id: str, now: float | None = None) -> bool:
+        '''
+        Return True if the event was not seen within the window, and remember it
+        '''
+        now = time.time() if now is None else now
+        with self._lock:
+            self._expire(now - self._window)
+            if event_id in self._seen:
+                return False
+            if self._size == self._capacity:
+                self._pop_oldest()
+            self._sequence += 1
+            self._ring[(self._head + self._size) % self._capacity] = (event_id, self._sequence, now)
+            self._size += 1
+            self._seen[event_id] = self._sequence
+            return True
+
+    def release(self, event_id: str, now: float | None = None) -> bool:
+        '''
+        忘記 event_id，讓之後重送的同一事件可以再被處理 (例如放進佇列失敗時)。
+        Return True if the event was seen within the window
+        '''
+        now = time.time() if now is None else now
+        with self._lock:
+            self._expire(now - self._window)
+            return self._seen.pop(event_id, None) is not None
+
+    def _expire(self, before: float) -> None:
+        while self._size > 0 and self._ring[self._head][2] <= before:
+            self._pop_oldest()
+
+    def _pop_oldest(self) -> None:
+        event_id, sequence, _ = self._ring[self._head]
+        self._ring[self._head] = None
+        self._head = (self._head + 1) % self._capacity
+        self._size -= 1
+        if self._seen.get(event_id) == sequence:
+            del self._seen[event_id]
@@ -0,0 +1,302 @@
+from typing import Any
+
+from linebot.models import SendMessage, TextSendMessage
+
+import hashlib
+import json
+import logging
+import os
+import pickle
+import stat
+
+from .message import text_message
+from .question import Question
+from .question_set_factory import QuestionSet, DeclarativeQuestionSetFactory, FlowDefinitionError
+
+
+class PredictionResultFormat(object):
+    '''
+    預測結果的回覆格式
+    flag: 回應中代表是否患病的欄位
+    percentage: 回應中代表機率的欄位
+    unavailable: 綜合篩檢時沒有及時取得結果的說明
+    '''
+    __slots__ = ("flag", "percentage", "positive", "negative", "percentage_label", "unavailable",
+                 "_positive_message", "_negative_message")
+
+    def __init__(self, flag: str, percentage: str, positive: str, negative: str, percentage_label: str,
+                 unavailable: str | None = None) -> None:
+        self.flag = flag
+        self.percentage = percentage
+        self.positive = positive
+        self.negative = negative
+        self.percentage_label = percentage_label
+        self.unavailable = unavailable or f"{percentage_label}:暫時無法取得"
+        self._positive_message = text_message(positive)
+        self._negative_message = text_message(negative)
+
+    def _parse(self, response_data: dict[str, Any]) -> tuple[bool, float]:
+        have_disease = response_data.get(self.flag, None)
+        percentage = response_data.get(self.percentage, None)
+        if have_disease is None or percentage is None:
+            raise ValueError("Response error!")
+        return have_disease is not False, percentage
+
+    def is_valid(self, response_data: dict[str, Any]) -> bool:
+        '''
+        Return False if format would fail on the response (missing fields, wrong types)
+        '''
+        try:
+            self.format(response_data)
+        except Exception:
+            return False
+        return True
+
+    def format(self, response_data: dict[str, Any]) -> list[SendMessage]:
+        have_disease, percentage = self._parse(response_data)
+        result = self._positive_message if have_disease else self._negative_message
+        return [result, TextSendMessage(text=f"{self.percentage_label}:{percentage:.2f}%")]
+
+    def summary(self, response_data: dict[str, Any] | None) -> str:
+        '''
+        綜合篩檢時每種疾病一行，response_data 為 None 或格式錯誤時回傳 unavailable
+        '''
+        if response_data is None:
+            return self.unavailable
+        try:
+            have_disease, percentage = self._parse(response_data)
+        except ValueError:
+            return self.unavailable
+        return f"{self.positive if have_disease else self.negative}，{self.percentage_label}:{percentage:.2f}%"
+
+
+
+class Transition(object):
+    '''
+    問題集最後一題回答後要做的事
+    goto: 換到 target 問題集
+    end: 回覆 messages 並結束
+    reply: 回覆 messages，停留在原本的問題
+    predict: 以問題集的回答呼叫 disease 的預測 API，回覆結果與 messages 後結束；
+             features 為所屬問題集的問題 key (編譯時填入)，deadline 為綜合篩檢時等待這個 API 的秒數
+    screen: 同時呼叫 targets 中每個問題集的預測 API，回覆及時取得的結果與 messages 後結束；
+            predictions 為 targets 的 predict transition (編譯時填入)
+    '''
+    GOTO = "goto"
+    END = "end"
+    REPLY = "reply"
+    PREDICT = "predict"
+    SCREEN = "screen"
+    ACTIONS = (GOTO, END, REPLY, PREDICT, SCREEN)
+
+    __slots__ = ("action", "target", "messages", "disease", "result", "deadline", "features", "targets", "predictions")
+
+    def __init__(self, action: str, target: str | None = None, messages: list[SendMessage] | None = None,
+                 disease: str | None = None, result: PredictionResultFormat | None = None,
+                 deadline: float | None = None, targets: list[str] | None = None) -> None:
+        self.action = action
+        self.target = target
+        self.messages = messages or []
+        self.disease = disease
+        self.result = result
+        self.deadline = deadline
+        self.features: tuple[str, ...] = ()
+        self.targets = targets or []
+        self.predictions: tuple[Transition, ...] = ()
+
+
+class FlowEngine(object):
+    '''
+    由 flows/ 目錄中的宣告式定義編譯出的狀態機。
+    每個問題集是一個狀態，(問題集 key, 最後一題的回答) 以字典直接查到下一步，
+    "*" 代表任何回答。
+    以 "include": [問題集 key, ...] 取代 "questions" 的問題集由這些問題集的問題聯集組成，
+    同一個 key 的問題只問一次 (以先列出的問題集為準)。
+    編譯結果可以 pickle 快取到磁碟，定義檔沒有變動時直接讀取快取。
+    unpickle 可以執行任意程式碼，只讀取由目前使用者擁有、其他人無法寫入的快取檔。
+    '''
+    CACHE_VERSION = 5
+    ANY_ANSWER = "*"
+
+    def __init__(self, question_sets: dict[str, QuestionSet], transitions: dict[str, dict[str, Transition]], initial_key: str) -> None:
+        self._question_sets = question_sets
+        self._transitions = transitions
+        self._initial_key = initial_key
+
+    @property
+    def initial(self) -> QuestionSet:
+        return self._question_sets[self._initial_key]
+
+    @property
+    def keys(self) -> list[str]:
+        return list(self._question_sets)
+
+    def question_set(self, key: str) -> QuestionSet:
+        return self._question_sets[key]
+
+    def transition(self, key: str, answer: Any) -> Transition | None:
+        transitions = self._transitions[key]
+        transition = transitions.get(str(answer))
+        if transition is None:
+            transition = transitions.get(self.ANY_ANSWER)
+        return transition
+
+    def result_formats(self, disease: str) -> list[PredictionResultFormat]:
+        '''
+        Return the result formats of every predict transition calling the disease
+        '''
+        return [transition.result for key_transitions in self._transitions.values()
+                for transition in key_transitions.values()
+                if transition.action == Transition.PREDICT and transition.disease == disease]
+
+    @classmethod
+    def compile(cls, definitions: list[dict]) -> "FlowEngine":
+        question_sets: dict[str, QuestionSet] = {}
+        transitions: dict[str, dict[str, Transition]] = {}
+        initial_keys = []
+        # include 的問題集要在被引用的問題集建立之後才能組成
+        for definition in sorted(definitions, key=lambda definition: "include" in definition):
+            if "include" in definition:
+                question_set = cls._union_question_set(definition, question_sets)
+            else:
+                question_set = DeclarativeQuestionSetFactory(definition).template
+            if question_set.key in question_sets:
+                raise FlowDefinitionError(f"Duplicated question set {question_set.key!r}")
+            question_sets[question_set.key] = question_set
+            transitions[question_set.key] = {str(answer): cls._compile_transition(transition)
+                                             for answer, transition in definition.get("transitions", {}).items()}
+            if definition.get("initial", False):
+                initial_keys.append(question_set.key)
+
+        if len(initial_keys) != 1:
+            raise FlowDefinitionError(f"Exactly one initial question set is required, got {initial_keys}")
+        for key, key_transitions in transitions.items():
+            last_question = question_sets[key].questions[-1]
+            for answer, transition in key_transitions.items():
+                if transition.action == Transition.GOTO and transition.target not in question_sets:
+                    raise FlowDefinitionError(f"Question set {key!r} goes to unknown question set {transition.target!r}")
+                if transition.action == Transition.PREDICT:
+                    transition.features = tuple(question.key for question in question_sets[key].questions)
+                elif transition.action == Transition.SCREEN:
+                    transition.predictions = tuple(cls._screen_target(key, target, question_sets, transitions)
+                                                   for target in transition.targets)
+                if answer != cls.ANY_ANSWER and not last_question.check(answer).ans_is_valid:
+                    raise FlowDefinitionError(f"Transition answer {answer!r} of {key!r} can never be given")
+        return cls(question_sets=question_sets, transitions=transitions, initial_key=initial_keys[0])
+
+    @staticmethod
+    def _union_question_set(definition: dict, question_sets: dict[str, QuestionSet]) -> QuestionSet:
+        questions: dict[str, Question] = {}
+        for key in definition["include"]:
+            if key not in question_sets:
+                raise FlowDefinitionError(f"Question set {definition.get('key')!r} includes unknown question set {key!r}")
+            for question in question_sets[key].questions:
+                if not question.key:
+                    raise FlowDefinitionError(f"Question set {key!r} included by {definition.get('key')!r} has a question without key")
+                questions.setdefault(question.key, question)
+        if not questions:
+            raise FlowDefinitionError(f"Question set {definition.get('key')!r} has no questions")
+        return QuestionSet(key=definition["key"], questions=list(questions.values()))
+
+    @classmethod
+    def _screen_target(cls, key: str, target: str, question_sets: dict[str, QuestionSet],
+                       transitions: dict[str, dict[str, Transition]]) -> Transition:
+        '''
+        Return the predict transition of the target question set, whose features must all be asked in key
+        '''
+        prediction = transitions.get(target, {}).get(cls.ANY_ANSWER)
+        if prediction is None or prediction.action != Transition.PREDICT:
+            raise FlowDefinitionError(f"Screening target {target!r} of {key!r} has no '*' predict transition")
+        asked = {question.key for question in question_sets[key].questions}
+        missing = [question.key for question in question_sets[target].questions if question.key not in asked]
+        if missing:
+            raise FlowDefinitionError(f"Question set {key!r} does not ask {missing} required by {target!r}")
+        return prediction
+
+    @staticmethod
+    def _compile_transition(definition: dict) -> Transition:
+        action = definition.get("action")
+        if action not in Transition.ACTIONS:
+            raise FlowDefinitionError(f"Unknown transition action: {action}")
+        result = definition.get("result")
+        return Transition(
+            action=action,
+            target=definition.get("target"),
+            messages=[text_message(text) for text in definition.get("messages", [])],
+            disease=definition.get("disease"),
+            result=PredictionResultFormat(**result) if result is not None else None,
+            deadline=definition.get("deadline"),
+            targets=list(definition.get("targets", [])),
+        )
+
+    @staticmethod
+    def read_sources(directory: str) -> tuple[list[tuple[str, bytes]], str]:
+        '''
+        讀取目錄中所有的 .json 定義檔 (安裝 PyYAML 時也可使用 .yaml/.yml)，
+        回傳檔名與內容，以及所有內容的 sha256
+        '''
+        digest = hashlib.sha256()
+        sources = []
+        for name in sorted(os.listdir(directory)):
+            if not name.endswith((".json", ".yaml", ".yml")):
+                continue
+            with open(os.path.join(directory, name), "rb") as f:
+                content = f.read()
+            digest.update(name.encode("utf-8") + b"\0" + content)
+            sources.append((name, content))
+        return sources, digest.hexdigest()
+
+    @staticmethod
+    def parse_sources(sources: list[tuple[str, bytes]]) -> list[dict]:
+        definitions = []
+        for name, content in sources:
+            if name.endswith(".json"):
+                definitions.append(json.loads(content))
+                continue
+            try:
+                import yaml
+            except ImportError as e:
+                raise FlowDefinitionError(f"PyYAML is required to read {name}") from e
+            definitions.append(yaml.safe_load(content))
+        return definitions
+
+    @classmethod
+    def load(cls, directory: str, cache_path: str | None = None) -> "FlowEngine":
+        '''
+        快取與定義檔的 sha256 相符時直接使用快取，不需重新解析與編譯
+        '''
+        sources, digest = cls.read_sources(directory)
+        cache_key = f"{cls.CACHE_VERSION}:{digest}\n".encode()
+        if cache_path:
+            try:
+                with open(cache_path, "rb") as f:
+                    # 檢查已開啟的檔案本身，檢查後檔案無法再被換掉
+                    if not cls._is_trusted_cache(os.fstat(f.fileno())):
+                        logging.warning("Ignored flow cache %s: not owned by this user or writable by others", cache_path)
+                    # key 以一行純文字寫在 pickle 之前，定義檔變動過的快取不會被 unpickle
+                    elif f.readline(len(cache_key)) == cache_key:
+                        return pickle.load(f)
+            except FileNotFoundError:
+                pass
+            except Exception:
+                # 快取只是加速，任何錯誤 (包括舊版快取引用已不存在的類別) 都當作沒有快取
+                logging.warning("Ignored unreadable flow cache %s", cache_path, exc_info=True)
+
+        engine = cls.compile(cls.parse_sources(sources))
+        if cache_path:
+            try:
+                tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+                # O_EXCL: 不沿著別人預先放好的 symlink 寫入
+                with os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), "wb") as f:
+                    f.write(cache_key)
+                    pickle.dump(engine, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp_path, cache_path)
+            except OSError:
+                logging.warning("Unable to write flow cache to %s", cache_path)
+        return engine
+
+    @staticmethod
+    def _is_trusted_cache(st: os.stat_result) -> bool:
+        if not hasattr(os, "getuid"):
+            return True
+        return st.st_uid == os.getuid() and not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
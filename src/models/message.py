@@ -0,0 +1,26 @@
+from linebot.models import SendMessage, TextSendMessage
+
+
+class PrecompiledMessage(SendMessage):
+    '''
+    所有使用者共用、內容不會改變的訊息。
+    建立時就先轉成 LINE API 的 JSON payload，
+    回覆時 as_json_dict 直接回傳，不需要每次走訪整個訊息物件。
+    '''
+    def __init__(self, message: SendMessage) -> None:
+        super().__init__()
+        self.type = message.type
+        self._payload = message.as_json_dict()
+
+    def as_json_dict(self) -> dict:
+        return self._payload
+
+
+def precompile(message: SendMessage) -> SendMessage:
+    if isinstance(message, PrecompiledMessage):
+        return message
+    return PrecompiledMessage(message)
+
+
+def text_message(text: str) -> SendMessage:
+    return PrecompiledMessage(TextSendMessage(text=text))
@@ -1,62 +1,69 @@
 from __future__ import annotations
 
 from abc import ABC, abstractmethod
-from typing import Any
 
-from linebot import LineBotApi
-from linebot.models import TextSendMessage, TemplateSendMessage, ButtonsTemplate, PostbackAction
+from linebot.models import SendMessage, TextSendMessage, TemplateSendMessage, ButtonsTemplate, PostbackAction
 
+from .answer_status import AnswerStatus
+from .message import precompile, text_message
 from .check_strategy import CheckStrategy
+from .reply_collector import ReplyCollector
+from .validator import CompiledValidator
 
 
 class Question(ABC):
+    '''
+    問題本身是不可變且所有使用者共用的模板，
+    每位使用者的回答與是否已問出由 User 自行保存。
+    '''
     def __init__(self, title: str, key: str, ans_check_strategies: list[CheckStrategy] = []) -> None:
         self._title = title
         self._key = key
-        self._ans_check_strategies = ans_check_strategies
-        self._ans = None
-        self._is_asked = False
-
-    @property
-    def is_asked(self) -> bool:
-        return self._is_asked
+        self._validator = CompiledValidator(ans_check_strategies)
+        self._ask_message = precompile(self._build_ask_message())
+        self._error_messages = {strategy.error_message: text_message(strategy.error_message) for strategy in ans_check_strategies}
 
     @property
     def key(self) -> str:
         return self._key
 
-    @property
-    def ans(self) -> Any:
-        return self._ans
-
     @abstractmethod
-    def ask(self, line_bot_api: LineBotApi, reply_token: str):
+    def _build_ask_message(self) -> SendMessage:
         pass
 
-    def answer(self, line_bot_api: LineBotApi, reply_token: str, ans: str) -> bool:
+    @property
+    def ask_message(self) -> SendMessage:
+        return self._ask_message
+
+    def ask(self, reply: ReplyCollector):
+        reply.add(self._ask_message)
+
+    @property
+    def validator(self) -> CompiledValidator:
+        return self._validator
+
+    def check(self, ans: str) -> AnswerStatus:
+        value, err_msg = self._validator.validate(str(ans))
+        if err_msg is not None:
+            return AnswerStatus(ans_is_valid=False, err_msg=err_msg)
+        return AnswerStatus(ans_is_valid=True, value=value)
+
+    def answer(self, reply: ReplyCollector, ans: str) -> AnswerStatus:
         '''
-        Return True if the answer if valid else False
+        Return the checked answer, reply the error message if the answer is invalid
         '''
-        ans_tmp = str(ans)
-        for strategy in self._ans_check_strategies:
-            if not strategy.check(ans_tmp):
-                line_bot_api.reply_message(reply_token=reply_token, messages=TextSendMessage(text=strategy.error_message))
-                return False
-            ans_tmp = strategy.transfer(ans_tmp)
-        self._ans = ans_tmp
-        return True
+        status = self.check(ans)
+        if not status.ans_is_valid:
+            reply.add(self._error_messages[status.err_msg])
+        return status
 
 
 class TextQuestion(Question):
     def __init__(self, title: str, key: str, ans_check_strategies: list[CheckStrategy] = []) -> None:
         super().__init__(title, key, ans_check_strategies)
 
-    def ask(self, line_bot_api: LineBotApi, reply_token: str):
-        line_bot_api.reply_message(
-            reply_token=reply_token, 
-            messages=TextSendMessage(text="請輸入"+self._title)
-        )
-        self._is_asked = True
+    def _build_ask_message(self) -> SendMessage:
+        return TextSendMessage(text="請輸入"+self._title)
 
 
 class ButtonQuestionOption(object):
@@ -67,21 +74,21 @@ class ButtonQuestionOption(object):
     @property
     def label(self) -> str:
         return self._label
-    
+
     @property
     def data(self) -> str:
         return self._data
-    
+
 
 class ButtonQuestion(Question):
     def __init__(self, title: str, key: str, introduction: str = "", options: list[ButtonQuestionOption] = [], ans_check_strategies: list[CheckStrategy] = []) -> None:
-        super().__init__(title, key, ans_check_strategies)
         self._introduction = introduction
-        self._options = options
+        self._options = tuple(options)
+        super().__init__(title, key, ans_check_strategies)
 
-    def ask(self, line_bot_api: LineBotApi, reply_token: str):
+    def _build_ask_message(self) -> SendMessage:
         actions = [PostbackAction(label=option.label, data=option.data) for option in self._options]
-        template_message = TemplateSendMessage(
+        return TemplateSendMessage(
             alt_text= "請輸入" + self._title,
             template=ButtonsTemplate(
                 title=self._title,
@@ -89,5 +96,3 @@ class ButtonQuestion(Question):
                 actions=actions
             )
         )
-        line_bot_api.reply_message(reply_token=reply_token, messages=template_message)
-        self._is_asked = True
\ No newline at end of file
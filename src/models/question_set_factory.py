@@ -1,6 +1,6 @@
 from abc import ABC, abstractmethod
 from .question import ButtonQuestionOption, Question, TextQuestion, ButtonQuestion
-from .check_strategy import IntCheckStrategy, FloatCheckStrategy, InListCheckStrategy, CompareCheckStrategy, CompareMethod
+from .check_strategy import CheckStrategy, IntCheckStrategy, FloatCheckStrategy, InListCheckStrategy, CompareCheckStrategy, CompareMethod
 
 
 class QuestionSet(object):
@@ -11,79 +11,84 @@ class QuestionSet(object):
     KEY_HYPERTENSION = "hypertension"
     def __init__(self, key: str, questions: list[Question]) -> None:
         self._key = key
-        self._questions = questions
+        self._questions = tuple(questions)
 
     @property
     def key(self) -> str:
         return self._key
 
     @property
-    def questions(self) -> list[Question]:
+    def questions(self) -> tuple[Question, ...]:
         return self._questions
 
 
 class QuestionSetFactory(ABC):
     def __init__(self) -> None:
         super().__init__()
+        self._template: QuestionSet | None = None
 
     @abstractmethod
     def generate(self) -> QuestionSet:
         pass
 
+    @property
+    def template(self) -> QuestionSet:
+        '''
+        問題集不可變，只需建立一次並讓所有使用者共用
+        '''
+        if self._template is None:
+            self._template = self.generate()
+        return self._template
 
-class InitialQuestionSetFactory(QuestionSetFactory):
-    __INITIAL_QUES_ANS_CHECK_STRATEGY = [InListCheckStrategy(["0", "1"])]
-    def __init__(self) -> None:
-        super().__init__()
 
-    def generate(self) -> QuestionSet:
-        options = [ButtonQuestionOption(label="是", data="1"), ButtonQuestionOption(label="否", data="0")]
-        questions = [ButtonQuestion(title="是否進行疾病預測", key="", introduction="您好，我是健康智能管家。\n請問是否進行疾病預測呢?", options=options, 
-                                    ans_check_strategies=self.__INITIAL_QUES_ANS_CHECK_STRATEGY)]
-        return QuestionSet(
-            key=QuestionSet.KEY_TEST, 
-            questions=questions
-        )
-    
+class FlowDefinitionError(ValueError):
+    pass
 
-class ChooseQuestionSetFactory(QuestionSetFactory):
-    __CHOOSE_QUES_ANS_CHECK_STRATEGIES = [InListCheckStrategy(["1", "2", "3"])]
-    def __init__(self) -> None:
-        super().__init__()
-    
-    def generate(self) -> QuestionSet:
-        options = [ButtonQuestionOption(label="糖尿病", data="1"), ButtonQuestionOption(label="高血壓", data="2"), ButtonQuestionOption(label="心臟病", data="3")]
-        questions = [ButtonQuestion(title="要預測的疾病", key="", introduction="請選擇要預測的疾病", options=options,
-                                    ans_check_strategies=self.__CHOOSE_QUES_ANS_CHECK_STRATEGIES)]
-        return QuestionSet(
-            key=QuestionSet.KET_CHOOSE, 
-            questions=questions
-        )
-    
 
-class DiabetesQuestionSetFactory(QuestionSetFactory):
-    __GENDER_QUEST_ANS_CHECK_STRATEGIES = [IntCheckStrategy(), InListCheckStrategy([0, 1])]
-    __AGE_QUEST_ANS_CHECK_STRATEGIES = [IntCheckStrategy(), CompareCheckStrategy(method=CompareMethod.BT, value=0)]
-    __BMI_QUEST_ANS_CHECK_STRATEGIES = [FloatCheckStrategy(), CompareCheckStrategy(method=CompareMethod.BT, value=0)]
-    __HBA1C_QUEST_ANS_CHECK_STRATEGIES = [FloatCheckStrategy(), CompareCheckStrategy(method=CompareMethod.BT, value=0)]
-    __BS_QUEST_ANS_CHECK_STRATEGIES = [IntCheckStrategy(), CompareCheckStrategy(method=CompareMethod.BT, value=0)]
-    def __init__(self) -> None:
+class DeclarativeQuestionSetFactory(QuestionSetFactory):
+    '''
+    由宣告式定義 (flows/*.json 中的一個問題集) 建立問題集:
+        {"key": "...", "questions": [{"type": "button" | "text", "key": "...", "title": "...",
+                                      "introduction": "...", "options": [{"label": "...", "data": "..."}],
+                                      "checks": [{"type": "int" | "float" | "in_list" | "compare", ...}]}]}
+    建立時會檢查每個按鈕選項都能通過該問題的檢查，避免定義錯誤到執行時才發現。
+    '''
+    def __init__(self, definition: dict) -> None:
         super().__init__()
+        self._definition = definition
+
+    @staticmethod
+    def build_check_strategy(definition: dict) -> CheckStrategy:
+        check_type = definition.get("type")
+        if check_type == "int":
+            return IntCheckStrategy()
+        if check_type == "float":
+            return FloatCheckStrategy()
+        if check_type == "in_list":
+            return InListCheckStrategy(list(definition["values"]))
+        if check_type == "compare":
+            return CompareCheckStrategy(method=CompareMethod[definition["method"]], value=definition["value"])
+        raise FlowDefinitionError(f"Unknown check type: {check_type}")
+
+    def _build_question(self, definition: dict) -> Question:
+        strategies = [self.build_check_strategy(check) for check in definition.get("checks", [])]
+        if definition["type"] == "text":
+            return TextQuestion(title=definition["title"], key=definition["key"], ans_check_strategies=strategies)
+        if definition["type"] == "button":
+            options = [ButtonQuestionOption(label=option["label"], data=option["data"]) for option in definition["options"]]
+            question = ButtonQuestion(title=definition["title"], key=definition["key"], introduction=definition.get("introduction", ""),
+                                      options=options, ans_check_strategies=strategies)
+            for option in options:
+                if not question.check(option.data).ans_is_valid:
+                    raise FlowDefinitionError(f"Option {option.data!r} of {definition['title']!r} does not pass its own checks")
+            return question
+        raise FlowDefinitionError(f"Unknown question type: {definition['type']}")
 
     def generate(self) -> QuestionSet:
-        gender_options = [ButtonQuestionOption(label="男", data="0"), ButtonQuestionOption(label="女", data="1")]
-        gender_question = ButtonQuestion(title="性別", key="gender", introduction="請選擇性別", options=gender_options,
-                                         ans_check_strategies=self.__GENDER_QUEST_ANS_CHECK_STRATEGIES)
-        age_question = TextQuestion(title="年齡", key="age",
-                                    ans_check_strategies=self.__AGE_QUEST_ANS_CHECK_STRATEGIES)
-        bmi_question = TextQuestion(title="BMI", key="bmi",
-                                    ans_check_strategies=self.__BMI_QUEST_ANS_CHECK_STRATEGIES)
-        hba1c_question = TextQuestion(title="hba1c(%)", key="hba1c",
-                                      ans_check_strategies=self.__HBA1C_QUEST_ANS_CHECK_STRATEGIES)
-        blood_sugar_question = TextQuestion(title="血糖值(mg/dL)", key="blood_sugar",
-                                            ans_check_strategies=self.__BS_QUEST_ANS_CHECK_STRATEGIES)
-        questions=[gender_question, age_question, bmi_question, hba1c_question, blood_sugar_question]
-        return QuestionSet(
-            key=QuestionSet.KEY_DIABETES, 
-            questions=questions
-        )
\ No newline at end of file
+        try:
+            questions = [self._build_question(question) for question in self._definition["questions"]]
+        except KeyError as e:
+            raise FlowDefinitionError(f"Missing field {e} in question set {self._definition.get('key')!r}") from e
+        if not questions:
+            raise FlowDefinitionError(f"Question set {self._definition.get('key')!r} has no questions")
+        return QuestionSet(key=self._definition["key"], questions=questions)
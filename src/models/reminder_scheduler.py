@@ -0,0 +1,221 @@
+from collections import deque
+from linebot.models import SendMessage
+from typing import Any
+
+from .user import User, flow_engine
+from .user_board import UserBoard
+from .session_store import SessionConflict
+from .completion_store import CompletionStore
+from services import MulticastSender
+
+import logging
+import threading
+import time
+
+
+class ReminderScheduler(object):
+    '''
+    在背景執行緒中主動通知使用者，不佔用處理 webhook 的執行緒:
+    timeout nudge: 回答到一半就超時的使用者收到 nudge_messages，並被移除 (與 sweep 相同，下次傳訊息時重新開始)。
+                   已被 sweep 移除的使用者由 expired (session store 的 expire listener) 收集，
+                   送出前取走 session store 記住的超時紀錄，已經傳過訊息 (收過超時訊息) 的使用者不會再收到一次；
+                   超時但還沒被 sweep 的由掃描找出
+    rescreen: 完成預測超過 rescreen_after 秒的使用者收到 rescreen_messages 與初始問題，
+              狀態重設 (session 已被移除時重新建立) 為已問出初始問題，直接按下按鈕就能再做一次篩檢。
+              完成時間記在 completions (CompletionStore)，與 session 的超時無關，rescreen_after 可以遠大於使用者超時秒數
+    每 interval 秒掃描一輪: timeout nudge 以 UserBoard.scan 分頁掃描 session store，每頁只短暫持有 session store 的鎖；
+    rescreen 只分頁讀取 completions 中已到期的使用者。
+    符合條件的使用者在 UserBoard.session 中重新確認並修改狀態，不會與同一使用者的事件交錯；
+    收件人累積到一個 multicast 批次就送出，一輪結束時送出剩下的。
+    '''
+    TIMEOUT_NUDGE = "timeout_nudge"
+    RESCREEN = "rescreen"
+
+    def __init__(self, board: UserBoard, sender: MulticastSender, nudge_messages: list[SendMessage] | None = None,
+                 rescreen_messages: list[SendMessage] | None = None, rescreen_after: float = 0,
+                 completions: CompletionStore | None = None, interval: float = 60, page_size: int = 500,
+                 max_pending: int = 100000) -> None:
+        self._board = board
+        self._sender = sender
+        self._nudge_messages = nudge_messages
+        self._completions = completions
+        self._rescreen_messages = None
+        if rescreen_messages is not None and rescreen_after > 0 and completions is not None:
+            self._rescreen_messages = list(rescreen_messages) + [flow_engine.initial.questions[0].ask_message]
+        self._rescreen_after = rescreen_after
+        self._interval = interval
+        self._page_size = page_size
+        # sweep 移除、尚未通知的使用者
+        self._expired: deque[str] = deque()
+        self._max_pending = max_pending
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+        self._rounds = 0
+        self._scanned = 0
+        self._sent = {self.TIMEOUT_NUDGE: 0, self.RESCREEN: 0}
+        self._failed = {self.TIMEOUT_NUDGE: 0, self.RESCREEN: 0}
+        self._dropped = 0
+        self._last_round_seconds = 0.0
+
+    @property
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "rounds": self._rounds,
+                "scanned": self._scanned,
+                "sent": dict(self._sent),
+                "failed": dict(self._failed),
+                "pending": len(self._expired),
+                "dropped": self._dropped,
+                "last_round_seconds": round(self._last_round_seconds, 3),
+            }
+
+    def expired(self, user_id: str, user: User) -> None:
+        '''
+        session store 的 expire listener，在 sweep 中呼叫，只把使用者放進待送清單
+        '''
+        if self._nudge_messages is None or not user.in_progress:
+            return
+        with self._lock:
+            if len(self._expired) >= self._max_pending:
+                self._dropped += 1
+                return
+            self._expired.append(user_id)
+
+    def start(self) -> None:
+        '''
+        與 EventDispatcher 相同，執行緒必須在 gunicorn fork 之後才建立
+        '''
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="reminder-scheduler", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float | None = None) -> None:
+        self._stop.set()
+        self._sender.close()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self._interval):
+            try:
+                self.run_round()
+            except Exception:
+                logging.exception("Reminder round failed")
+
+    def run_round(self) -> dict[str, Any]:
+        '''
+        掃描一輪並送出通知，Return the counts of this round
+        '''
+        start = time.perf_counter()
+        now = time.time()
+        recipients: dict[str, list[str]] = {self.TIMEOUT_NUDGE: [], self.RESCREEN: []}
+        result = {"scanned": 0, "sent": {self.TIMEOUT_NUDGE: 0, self.RESCREEN: 0}, "failed": {self.TIMEOUT_NUDGE: 0, self.RESCREEN: 0}}
+        if self._nudge_messages is not None:
+            self._scan_sessions(now, recipients, result)
+        if self._rescreen_messages is not None:
+            self._scan_completions(now, recipients, result)
+        for kind, user_ids in recipients.items():
+            if user_ids:
+                self._send(kind, user_ids, result)
+
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self._rounds += 1
+            self._scanned += result["scanned"]
+            self._last_round_seconds = elapsed
+        if any(result["sent"].values()) or any(result["failed"].values()):
+            logging.info("Reminder round in %.3fs: %s", elapsed, result)
+        return result
+
+    def _scan_sessions(self, now: float, recipients: dict[str, list[str]], result: dict[str, Any]) -> None:
+        # 同一輪中重複出現的使用者只處理一次
+        seen: set[str] = set()
+        cursor = None
+        while not self._stop.is_set():
+            users, cursor = self._board.scan(cursor, self._page_size)
+            for user_id, user in users:
+                if user_id in seen:
+                    continue
+                seen.add(user_id)
+                result["scanned"] += 1
+                if self._is_timed_out(user, now) and self._claim_nudge(user_id, now):
+                    recipients[self.TIMEOUT_NUDGE].append(user_id)
+            recipients[self.TIMEOUT_NUDGE].extend(user_id for user_id in self._take_expired()
+                                                  if self._board.take_timed_out(user_id))
+            self._send_full_batches(recipients, result)
+            if cursor is None:
+                break
+
+    def _scan_completions(self, now: float, recipients: dict[str, list[str]], result: dict[str, Any]) -> None:
+        cursor = None
+        while not self._stop.is_set():
+            completions, cursor = self._completions.scan(now - self._rescreen_after, cursor, self._page_size)
+            for user_id, completed_at in completions:
+                result["scanned"] += 1
+                if self._claim_rescreen(user_id, completed_at):
+                    recipients[self.RESCREEN].append(user_id)
+            self._send_full_batches(recipients, result)
+            if cursor is None:
+                break
+
+    def _send_full_batches(self, recipients: dict[str, list[str]], result: dict[str, Any]) -> None:
+        batch_size = self._sender.batch_size
+        for kind, user_ids in recipients.items():
+            if len(user_ids) >= batch_size:
+                self._send(kind, user_ids[:batch_size], result)
+                del user_ids[:batch_size]
+
+    @staticmethod
+    def _is_timed_out(user: User, now: float) -> bool:
+        return user.in_progress and user.expires_at <= now
+
+    def _claim_nudge(self, user_id: str, now: float) -> bool:
+        '''
+        在使用者的鎖中重新確認 (掃描後使用者可能已傳了新訊息) 並移除使用者，Return True if the user should be notified
+        '''
+        try:
+            with self._board.session(user_id) as session:
+                if session.user is None or not self._is_timed_out(session.user, now):
+                    return False
+                session.remove()
+                return True
+        except SessionConflict:
+            # 其他 worker 同時處理了這位使用者的事件，下一輪再重新確認
+            return False
+
+    def _claim_rescreen(self, user_id: str, completed_at: float) -> bool:
+        '''
+        在使用者的鎖中取走完成紀錄並重設狀態，Return True if the user should be notified
+        '''
+        try:
+            with self._board.session(user_id) as session:
+                user = session.user
+                if user is not None and user.in_progress and not user.is_timeout:
+                    # 正在回答新的問卷，不打斷；完成時會記下新的完成時間
+                    return False
+                if not self._completions.claim(user_id, completed_at):
+                    return False
+                user = session.get_or_create()
+                user.reset()
+                user.mark_current_question_asked()
+                return True
+        except SessionConflict:
+            return False
+
+    def _take_expired(self) -> list[str]:
+        with self._lock:
+            user_ids = list(self._expired)
+            self._expired.clear()
+        return user_ids
+
+    def _send(self, kind: str, user_ids: list[str], result: dict[str, Any]) -> None:
+        messages = self._nudge_messages if kind == self.TIMEOUT_NUDGE else self._rescreen_messages
+        sent, failed = self._sender.send(user_ids, messages)
+        result["sent"][kind] += sent
+        result["failed"][kind] += failed
+        with self._lock:
+            self._sent[kind] += sent
+            self._failed[kind] += failed
@@ -0,0 +1,78 @@
+from linebot import LineBotApi, AsyncLineBotApi
+from linebot.models import SendMessage
+
+import time
+
+from services import LatencyHistogram, stage_seconds
+
+
+class ReplyCollector(object):
+    '''
+    收集處理單一事件時要回覆的所有訊息，最後由 flush 一次送出。
+    reply token 只能使用一次，且一次最多回覆五則訊息，
+    超過的部分改以 push_message 傳送。
+    '''
+    MAX_MESSAGES_PER_CALL = 5
+    latency = LatencyHistogram()
+
+    def __init__(self, line_bot_api: LineBotApi | AsyncLineBotApi, reply_token: str, user_id: str | None = None) -> None:
+        self._line_bot_api = line_bot_api
+        self._reply_token = reply_token
+        self._user_id = user_id
+        self._messages: list[SendMessage] = []
+        self._is_flushed = False
+
+    @property
+    def messages(self) -> list[SendMessage]:
+        return self._messages
+
+    @property
+    def is_flushed(self) -> bool:
+        return self._is_flushed
+
+    def add(self, messages: SendMessage | list[SendMessage]) -> None:
+        if isinstance(messages, list):
+            self._messages.extend(messages)
+        else:
+            self._messages.append(messages)
+
+    def truncate(self, count: int) -> None:
+        '''
+        丟棄第 count 則之後加入的訊息，重新處理同一事件前使用
+        '''
+        del self._messages[count:]
+
+    def _start_flush(self) -> bool:
+        if self._is_flushed:
+            return False
+        self._is_flushed = True
+        return len(self._messages) > 0
+
+    def flush(self) -> None:
+        if not self._start_flush():
+            return
+
+        start = time.perf_counter()
+        size = self.MAX_MESSAGES_PER_CALL
+        self._line_bot_api.reply_message(reply_token=self._reply_token, messages=self._messages[:size])
+        stage_seconds.observe(time.perf_counter() - start, "reply_message")
+        if self._user_id is not None:
+            for i in range(size, len(self._messages), size):
+                self._line_bot_api.push_message(to=self._user_id, messages=self._messages[i:i + size])
+        self.latency.observe(time.perf_counter() - start)
+
+    async def flush_async(self) -> None:
+        '''
+        與 flush 相同，但使用 AsyncLineBotApi 送出
+        '''
+        if not self._start_flush():
+            return
+
+        start = time.perf_counter()
+        size = self.MAX_MESSAGES_PER_CALL
+        await self._line_bot_api.reply_message(reply_token=self._reply_token, messages=self._messages[:size])
+        stage_seconds.observe(time.perf_counter() - start, "reply_message")
+        if self._user_id is not None:
+            for i in range(size, len(self._messages), size):
+                await self._line_bot_api.push_message(to=self._user_id, messages=self._messages[i:i + size])
+        self.latency.observe(time.perf_counter() - start)
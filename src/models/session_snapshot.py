@@ -0,0 +1,119 @@
+from typing import Iterable, Iterator
+
+import logging
+import os
+import struct
+import time
+
+from .user import User
+
+'''
+部署或機器停止前把記憶體中的使用者狀態寫成二進位快照，啟動時再讀回來，
+填到一半問卷的使用者不需要重新來過。
+
+檔案格式: MAGIC 之後接連續的紀錄，每筆紀錄為
+    <last_answer_time: float64><user_id 長度: uint16><state 長度: uint32><user_id><state>
+state 即 User.to_state() 的結果，最後以 user_id 長度為 0 的紀錄結尾，
+讀到結尾紀錄之前檔案就結束代表快照寫到一半，已讀出的紀錄仍然有效。
+讀取時一次只處理一筆紀錄，已超時的使用者只讀標頭就跳過，不需要解析 state。
+'''
+
+MAGIC = b"LBSNAP\x00\x01"
+_HEADER = struct.Struct("<dHI")
+_BUFFER_SIZE = 1 << 20
+
+
+def write_snapshot(path: str, users: Iterable[tuple[str, User]]) -> int:
+    '''
+    先寫到暫存檔再改名，寫到一半中斷時不會蓋掉舊的快照。
+    Return the number of users written
+    '''
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    count = 0
+    try:
+        with open(tmp_path, "wb", buffering=_BUFFER_SIZE) as f:
+            f.write(MAGIC)
+            for user_id, user in users:
+                key = user_id.encode()
+                state = user.to_state()
+                f.write(_HEADER.pack(user.last_answer_time, len(key), len(state)))
+                f.write(key)
+                f.write(state)
+                count += 1
+            f.write(_HEADER.pack(0.0, 0, 0))
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    return count
+
+
+class SnapshotReader(object):
+    '''
+    逐筆讀出快照中尚未超時的使用者，timeout 為目前設定的超時秒數 (即 User._timeout)
+    '''
+    def __init__(self, path: str, timeout: float, now: float | None = None) -> None:
+        self._path = path
+        self._timeout = timeout
+        self._now = time.time() if now is None else now
+        self._restored = 0
+        self._expired = 0
+        self._invalid = 0
+        self._truncated = False
+
+    @property
+    def stats(self) -> dict[str, int | bool]:
+        return {
+            "restored": self._restored,
+            "expired": self._expired,
+            "invalid": self._invalid,
+            "truncated": self._truncated,
+        }
+
+    def __iter__(self) -> Iterator[tuple[str, User]]:
+        deadline = self._now - self._timeout
+        with open(self._path, "rb", buffering=_BUFFER_SIZE) as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"Not a session snapshot: {self._path}")
+            while True:
+                header = f.read(_HEADER.size)
+                if len(header) < _HEADER.size:
+                    self._truncated = True
+                    return
+                last_answer_time, key_size, state_size = _HEADER.unpack(header)
+                if key_size == 0:
+                    return
+                if last_answer_time < deadline:
+                    # 已超時的使用者不需要解析，直接跳過
+                    f.seek(key_size + state_size, os.SEEK_CUR)
+                    self._expired += 1
+                    continue
+                key = f.read(key_size)
+                state = f.read(state_size)
+                if len(state) < state_size:
+                    self._truncated = True
+                    return
+                try:
+                    user = User.from_state(state, timeout=self._timeout)
+                except (ValueError, KeyError, TypeError):
+                    # 版本不符或問題集在部署後已被移除
+                    self._invalid += 1
+                    continue
+                self._restored += 1
+                yield key.decode(), user
+
+
+def read_snapshot(path: str, timeout: float, now: float | None = None) -> SnapshotReader:
+    return SnapshotReader(path, timeout, now)
+
+
+def remove_snapshot(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError:
+        logging.warning("Unable to remove session snapshot %s", path)
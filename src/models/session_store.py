@@ -0,0 +1,470 @@
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Callable, Iterable, Iterator
+
+import heapq
+import logging
+import sqlite3
+import threading
+import time
+
+from .event_dedup import EventDedupIndex
+from .user import User
+
+
+class SessionConflict(Exception):
+    '''
+    save 時發現使用者在 load 之後已被其他 process 修改 (或建立、刪除)，這次的修改沒有寫入
+    '''
+    def __init__(self, user_id: str) -> None:
+        super().__init__(f"Session of {user_id} was modified concurrently")
+        self.user_id = user_id
+
+
+class SessionStore(ABC):
+    '''
+    UserBoard 背後存放使用者狀態的地方。
+    每個事件只會呼叫一次 load，結束時最多呼叫一次 save 或 delete。
+    多個 process 共用的 store 在 save 時發現衝突會丟出 SessionConflict，呼叫端應以最新狀態重新處理事件。
+
+    timeout: 使用者超時秒數，超時的使用者會被主動移除
+    max_sessions: 最多保留幾個使用者，超過時移除最久未使用的使用者
+    event_window: 處理過的 webhook event ID 記住幾秒，期間內重送的事件會被略過
+    max_events: 最多記住幾個 webhook event ID
+    回答到一半就超時、被 sweep 移除的使用者記住 TIMED_OUT_WINDOW 秒 (最多 max_sessions 位)，
+    下次傳訊息時仍能和還沒被移除的超時使用者一樣收到超時訊息 (見 take_timed_out)
+    '''
+    TIMED_OUT_WINDOW = 24 * 3600
+
+    def __init__(self, timeout: float, max_sessions: int = 100000, event_window: float = 3600, max_events: int = 100000) -> None:
+        super().__init__()
+        self._timeout = timeout
+        self._max_sessions = max_sessions
+        self._event_window = event_window
+        self._max_events = max_events
+        self._expired_count = 0
+        self._lru_evicted_count = 0
+        self._expire_listener: Callable[[str, User], None] | None = None
+
+    @property
+    def timeout(self) -> float:
+        return self._timeout
+
+    @property
+    def stats(self) -> dict[str, int]:
+        return {
+            "live_sessions": self.count(),
+            "max_sessions": self._max_sessions,
+            "expired_evictions": self._expired_count,
+            "lru_evictions": self._lru_evicted_count,
+        }
+
+    def set_expire_listener(self, listener: Callable[[str, User], None] | None) -> None:
+        '''
+        sweep 移除每個超時的使用者時呼叫 listener(user_id, user)，
+        可能在處理事件的執行緒中、持有 session store 的鎖時呼叫，listener 必須很快返回
+        '''
+        self._expire_listener = listener
+
+    @abstractmethod
+    def load(self, user_id: str) -> User | None:
+        pass
+
+    @abstractmethod
+    def save(self, user_id: str, user: User) -> None:
+        pass
+
+    @abstractmethod
+    def delete(self, user_id: str) -> None:
+        pass
+
+    @abstractmethod
+    def count(self) -> int:
+        pass
+
+    @abstractmethod
+    def items(self) -> Iterator[tuple[str, User]]:
+        '''
+        逐一取出尚未超時的使用者，供寫入快照
+        '''
+        pass
+
+    @abstractmethod
+    def scan(self, cursor: Any = None, limit: int = 500) -> tuple[list[tuple[str, User]], Any]:
+        '''
+        分頁讀取使用者 (包含已超時但尚未被 sweep 移除的)，每頁最多 limit 位，不會一次走訪所有使用者。
+        cursor 為 None 時從頭開始，Return (users, next cursor)，next cursor 為 None 代表已讀完一輪。
+        讀取期間新增的使用者可能要到下一輪才會讀到
+        '''
+        pass
+
+    def restore(self, users: Iterable[tuple[str, User]]) -> int:
+        '''
+        放回從快照讀出的使用者，已經存在的使用者不會被覆蓋。Return the number of users restored
+        '''
+        restored = 0
+        for user_id, user in users:
+            if self.load(user_id) is None:
+                try:
+                    self.save(user_id, user)
+                except SessionConflict:
+                    # 其他 process 已經建立了這位使用者
+                    continue
+                restored += 1
+        return restored
+
+    @abstractmethod
+    def sweep(self, now: float | None = None) -> int:
+        '''
+        移除已超時的使用者，回傳移除的數量
+        '''
+        pass
+
+    @abstractmethod
+    def take_timed_out(self, user_id: str, now: float | None = None) -> bool:
+        '''
+        Return True if sweep removed the user before the user finished, within TIMED_OUT_WINDOW.
+        同一次超時只會回傳一次 True
+        '''
+        pass
+
+    @abstractmethod
+    def claim_event(self, event_id: str, now: float | None = None) -> bool:
+        '''
+        Return True if the webhook event was not handled within event_window and should be handled now
+        '''
+        pass
+
+    @abstractmethod
+    def release_event(self, event_id: str) -> None:
+        '''
+        事件最後沒有被處理時呼叫，讓 LINE 重送的同一事件可以再被處理
+        '''
+        pass
+
+
+class MemorySessionStore(SessionStore):
+    '''
+    直接把 User 物件放在記憶體中，只能在單一 process 內使用。
+    _users 依最近使用的順序排列，_deadlines 是以超時時間排序的 heap，
+    每次 save 時只需檢查 heap 頂端就能找出已超時的使用者。
+    多個執行緒同時處理事件時，_users 與 _deadlines 的每個操作都在 _lock 中完成，
+    這些操作都很短，處理事件期間不會持有這把鎖 (見 UserBoard.session)。
+    '''
+    def __init__(self, timeout: float, max_sessions: int = 100000, event_window: float = 3600, max_events: int = 100000) -> None:
+        super().__init__(timeout, max_sessions, event_window, max_events)
+        self._users: OrderedDict[str, User] = OrderedDict()
+        self._deadlines: list[tuple[float, str]] = []
+        self._events = EventDedupIndex(capacity=max_events, window=event_window)
+        self._timed_out = EventDedupIndex(capacity=max_sessions, window=self.TIMED_OUT_WINDOW)
+        self._lock = threading.RLock()
+
+    def load(self, user_id: str) -> User | None:
+        with self._lock:
+            user = self._users.get(user_id)
+            if user is not None:
+                self._users.move_to_end(user_id)
+            return user
+
+    def save(self, user_id: str, user: User) -> None:
+        with self._lock:
+            if self._users.get(user_id) is not user:
+                heapq.heappush(self._deadlines, (user.expires_at, user_id))
+            self._users[user_id] = user
+            self._users.move_to_end(user_id)
+            self.sweep()
+            while len(self._users) > self._max_sessions:
+                self._users.popitem(last=False)
+                self._lru_evicted_count += 1
+            # 被刪除或被 LRU 移除的使用者仍留在 heap 中，數量過多時重建 heap
+            if len(self._deadlines) > 2 * len(self._users) + 1024:
+                self._deadlines = [(user.expires_at, user_id) for user_id, user in self._users.items()]
+                heapq.heapify(self._deadlines)
+
+    def delete(self, user_id: str) -> None:
+        with self._lock:
+            self._users.pop(user_id, None)
+
+    def count(self) -> int:
+        return len(self._users)
+
+    def items(self) -> Iterator[tuple[str, User]]:
+        # 先複製一份參照，避免迭代時其他執行緒修改 _users
+        now = time.time()
+        with self._lock:
+            users = list(self._users.items())
+        for user_id, user in users:
+            if user.expires_at > now:
+                yield user_id, user
+
+    def scan(self, cursor: Any = None, limit: int = 500) -> tuple[list[tuple[str, User]], Any]:
+        # 第一頁時複製一份 user_id 清單 (只複製參照)，cursor 為 (清單, 位置)，之後每頁只在鎖中讀出 limit 位。
+        # heap 與 LRU 順序在兩頁之間都會改變，以它們的位置分頁會漏掉使用者；
+        # 清單複製之後才新增的使用者下一輪才會讀到
+        if cursor is None:
+            with self._lock:
+                cursor = (list(self._users), 0)
+        user_ids, position = cursor
+        page = user_ids[position:position + limit]
+        with self._lock:
+            users = [(user_id, self._users.get(user_id)) for user_id in page]
+        position += limit
+        return [(user_id, user) for user_id, user in users if user is not None], (user_ids, position) if position < len(user_ids) else None
+
+    def restore(self, users: Iterable[tuple[str, User]]) -> int:
+        with self._lock:
+            # 一次放入所有使用者，最後才重建 heap 並檢查數量上限，不需要每個使用者都 sweep 一次。
+            # 快照依最近使用的順序寫入，放回後仍排在啟動後才出現的使用者之前
+            existing = list(self._users)
+            restored = 0
+            for user_id, user in users:
+                if user_id not in self._users:
+                    self._users[user_id] = user
+                    restored += 1
+            for user_id in existing:
+                self._users.move_to_end(user_id)
+            self._deadlines = [(user.expires_at, user_id) for user_id, user in self._users.items()]
+            heapq.heapify(self._deadlines)
+            while len(self._users) > self._max_sessions:
+                self._users.popitem(last=False)
+                self._lru_evicted_count += 1
+            return restored
+
+    def claim_event(self, event_id: str, now: float | None = None) -> bool:
+        return self._events.claim(event_id, now)
+
+    def release_event(self, event_id: str) -> None:
+        self._events.release(event_id)
+
+    def take_timed_out(self, user_id: str, now: float | None = None) -> bool:
+        return self._timed_out.release(user_id, now)
+
+    def sweep(self, now: float | None = None) -> int:
+        now = time.time() if now is None else now
+        with self._lock:
+            removed = 0
+            while self._deadlines and self._deadlines[0][0] <= now:
+                _, user_id = heapq.heappop(self._deadlines)
+                user = self._users.get(user_id)
+                if user is None:
+                    continue
+                if user.expires_at > now:
+                    # 使用者在加入 heap 之後被重設過，以新的超時時間重新排入
+                    heapq.heappush(self._deadlines, (user.expires_at, user_id))
+                    continue
+                del self._users[user_id]
+                removed += 1
+                if not user.is_end:
+                    self._timed_out.claim(user_id, now)
+                if self._expire_listener is not None:
+                    self._expire_listener(user_id, user)
+            self._expired_count += removed
+            return removed
+
+
+class SqliteSessionStore(SessionStore):
+    '''
+    把序列化後的使用者狀態存在 SQLite 檔案中，
+    同一台機器上的多個 gunicorn worker 可以共用同一個檔案，
+    處理過的 webhook event ID 也存在同一個檔案中，任何一個 worker 都能認出重送的事件。
+    超時與超量的使用者及 event ID 每隔 sweep_interval 秒清除一次。
+
+    UserBoard 的鎖只在同一個 process 內有效，不同 worker 可能同時處理同一位使用者的事件。
+    每列有 version，save 以 compare-and-swap 寫入: load 時讀到的 version 沒有變才更新 (load 時不存在的使用者則只新增)，
+    否則丟出 SessionConflict。處理事件期間 (包含呼叫預測 API) 不持有資料庫的寫入鎖。
+    無法解讀的狀態 (例如舊版格式、已移除的問題集) 與讀取快照時相同，視為不存在並刪除。
+    '''
+    def __init__(self, timeout: float, path: str, max_sessions: int = 100000, sweep_interval: float = 30,
+                 event_window: float = 3600, max_events: int = 100000) -> None:
+        super().__init__(timeout, max_sessions, event_window, max_events)
+        self._path = path
+        self._sweep_interval = sweep_interval
+        self._next_sweep = 0.0
+        self._invalid_count = 0
+        self._local = threading.local()
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "user_id TEXT PRIMARY KEY, state BLOB NOT NULL, updated_at REAL NOT NULL, expires_at REAL NOT NULL, "
+            "version INTEGER NOT NULL DEFAULT 0)"
+        )
+        columns = [row[1] for row in self._connection.execute("PRAGMA table_info(sessions)")]
+        if "version" not in columns:
+            # 舊版建立的檔案
+            self._connection.execute("ALTER TABLE sessions ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS sessions_expires_at ON sessions (expires_at)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS sessions_updated_at ON sessions (updated_at)")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS webhook_events (event_id TEXT PRIMARY KEY, seen_at REAL NOT NULL)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS webhook_events_seen_at ON webhook_events (seen_at)")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS timed_out_users (user_id TEXT PRIMARY KEY, expired_at REAL NOT NULL)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS timed_out_users_expired_at ON timed_out_users (expired_at)")
+
+    @property
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite3 的連線不能跨執行緒共用，每個執行緒各自建立一條
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self._path, timeout=5, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    @property
+    def stats(self) -> dict[str, int]:
+        stats = super().stats
+        stats["invalid_states"] = self._invalid_count
+        return stats
+
+    def _decode(self, user_id: str, state: bytes) -> User | None:
+        '''
+        Return None if the state cannot be decoded, the caller must drop the row
+        '''
+        try:
+            return User.from_state(state, timeout=self._timeout)
+        except (ValueError, KeyError, TypeError, IndexError):
+            self._invalid_count += 1
+            logging.warning("Dropped undecodable session state of %s", user_id)
+            return None
+
+    def _drop(self, user_ids: list[str]) -> None:
+        for user_id in user_ids:
+            self._versions.pop(user_id, None)
+        self._connection.executemany("DELETE FROM sessions WHERE user_id = ?", [(user_id,) for user_id in user_ids])
+
+    @property
+    def _versions(self) -> dict[str, int]:
+        # 這個執行緒 load 過、還沒 save 或 delete 的使用者 -> 讀到的 version
+        versions = getattr(self._local, "versions", None)
+        if versions is None:
+            versions = self._local.versions = {}
+        return versions
+
+    def load(self, user_id: str) -> User | None:
+        row = self._connection.execute("SELECT state, version FROM sessions WHERE user_id = ?", (user_id,)).fetchone()
+        if row is None:
+            self._versions.pop(user_id, None)
+            return None
+        user = self._decode(user_id, row[0])
+        if user is None:
+            self._drop([user_id])
+            return None
+        self._versions[user_id] = row[1]
+        return user
+
+    def save(self, user_id: str, user: User) -> None:
+        now = time.time()
+        version = self._versions.pop(user_id, None)
+        if user.is_dirty:
+            if version is None:
+                written = self._connection.execute(
+                    "INSERT INTO sessions (user_id, state, updated_at, expires_at) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT (user_id) DO NOTHING",
+                    (user_id, user.to_state(), now, user.expires_at)
+                ).rowcount
+            else:
+                written = self._connection.execute(
+                    "UPDATE sessions SET state = ?, updated_at = ?, expires_at = ?, version = version + 1 "
+                    "WHERE user_id = ? AND version = ?",
+                    (user.to_state(), now, user.expires_at, user_id, version)
+                ).rowcount
+            if written == 0:
+                raise SessionConflict(user_id)
+        if now >= self._next_sweep:
+            self._next_sweep = now + self._sweep_interval
+            self.sweep(now)
+
+    def delete(self, user_id: str) -> None:
+        self._versions.pop(user_id, None)
+        self._connection.execute("DELETE FROM sessions WHERE user_id = ?", (user_id,))
+
+    def count(self) -> int:
+        return self._connection.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    def items(self) -> Iterator[tuple[str, User]]:
+        cursor = self._connection.execute("SELECT user_id, state FROM sessions WHERE expires_at > ?", (time.time(),))
+        invalid = []
+        for user_id, state in cursor:
+            user = self._decode(user_id, state)
+            if user is None:
+                invalid.append(user_id)
+            else:
+                yield user_id, user
+        self._drop(invalid)
+
+    def scan(self, cursor: Any = None, limit: int = 500) -> tuple[list[tuple[str, User]], Any]:
+        # 以 user_id 為 cursor 走主鍵索引分頁
+        rows = self._connection.execute(
+            "SELECT user_id, state FROM sessions WHERE user_id > ? ORDER BY user_id LIMIT ?", (cursor or "", limit)
+        ).fetchall()
+        users, invalid = [], []
+        for user_id, state in rows:
+            user = self._decode(user_id, state)
+            if user is None:
+                invalid.append(user_id)
+            else:
+                users.append((user_id, user))
+        self._drop(invalid)
+        return users, rows[-1][0] if len(rows) == limit else None
+
+    def claim_event(self, event_id: str, now: float | None = None) -> bool:
+        now = time.time() if now is None else now
+        # 已過期但還沒被 sweep 清掉的紀錄直接覆蓋
+        return self._connection.execute(
+            "INSERT INTO webhook_events (event_id, seen_at) VALUES (?, ?) "
+            "ON CONFLICT (event_id) DO UPDATE SET seen_at = excluded.seen_at WHERE seen_at <= ?",
+            (event_id, now, now - self._event_window)
+        ).rowcount == 1
+
+    def release_event(self, event_id: str) -> None:
+        self._connection.execute("DELETE FROM webhook_events WHERE event_id = ?", (event_id,))
+
+    def take_timed_out(self, user_id: str, now: float | None = None) -> bool:
+        now = time.time() if now is None else now
+        # 多個 worker 同時收到同一位使用者的訊息時，只有一個會刪除成功
+        row = self._connection.execute(
+            "DELETE FROM timed_out_users WHERE user_id = ? RETURNING expired_at", (user_id,)
+        ).fetchone()
+        return row is not None and row[0] > now - self.TIMED_OUT_WINDOW
+
+    def sweep(self, now: float | None = None) -> int:
+        now = time.time() if now is None else now
+        # 多個 worker 同時 sweep 時，每位使用者只會被其中一個 worker 刪除並交給 listener
+        rows = self._connection.execute("DELETE FROM sessions WHERE expires_at <= ? RETURNING user_id, state", (now,)).fetchall()
+        timed_out = []
+        for user_id, state in rows:
+            # 無法解讀的使用者一樣已被刪除，只是不記住也不交給 listener
+            user = self._decode(user_id, state)
+            if user is None:
+                continue
+            if not user.is_end:
+                timed_out.append((user_id, now))
+            if self._expire_listener is not None:
+                self._expire_listener(user_id, user)
+        self._connection.executemany(
+            "INSERT OR REPLACE INTO timed_out_users (user_id, expired_at) VALUES (?, ?)", timed_out
+        )
+        removed = len(rows)
+        self._expired_count += removed
+        overflow = self.count() - self._max_sessions
+        if overflow > 0:
+            self._lru_evicted_count += self._connection.execute(
+                "DELETE FROM sessions WHERE user_id IN (SELECT user_id FROM sessions ORDER BY updated_at LIMIT ?)",
+                (overflow,)
+            ).rowcount
+        self._connection.execute("DELETE FROM webhook_events WHERE seen_at <= ?", (now - self._event_window,))
+        self._connection.execute(
+            "DELETE FROM webhook_events WHERE event_id IN "
+            "(SELECT event_id FROM webhook_events ORDER BY seen_at DESC LIMIT -1 OFFSET ?)",
+            (self._max_events,)
+        )
+        self._connection.execute("DELETE FROM timed_out_users WHERE expired_at <= ?", (now - self.TIMED_OUT_WINDOW,))
+        self._connection.execute(
+            "DELETE FROM timed_out_users WHERE user_id IN "
+            "(SELECT user_id FROM timed_out_users ORDER BY expired_at DESC LIMIT -1 OFFSET ?)",
+            (self._max_sessions,)
+        )
+        return removed
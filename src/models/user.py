@@ -1,37 +1,181 @@
 from .question import Question
-from .question_set_factory import QuestionSet, InitialQuestionSetFactory, ChooseQuestionSetFactory, DiabetesQuestionSetFactory
-from vars import base_api_url
+from .reply_collector import ReplyCollector
+from .question_set_factory import QuestionSet
+from .flow import FlowEngine, Transition
+from .message import text_message
+from services import Predictor, PredictionClient, PredictionError, CircuitBreaker, CachingPredictor, BatchingPredictor
+from services import LocalPredictor, PredictionFanout
+from services import metrics_registry, stage_seconds, invalid_answers, flow_completions
+from services import AnswerLog
+from vars import base_api_url, predict_connect_timeout, predict_read_timeout, predict_retries, predict_pool_size
+from vars import predict_breaker_threshold, predict_breaker_reset
+from vars import predict_cache_size, predict_cache_ttl, predict_cache_single_flight
+from vars import predict_batch_size, predict_batch_window
+from vars import predict_fanout_deadline, predict_fanout_workers
+from vars import predict_model_dir, predict_remote_fallback
+from vars import flow_definitions_dir, flow_cache_path
+from vars import answer_log_dir, answer_log_segment_bytes, answer_log_segment_seconds, answer_log_flush_interval, answer_log_queue_size
+
+from typing import Any
 
 import time
-import requests
-import logging
+import json
+import atexit
+import threading
 
-from linebot import LineBotApi
 from linebot.models import TextSendMessage
 
 
-initial_question_set_factory = InitialQuestionSetFactory()
-choose_question_set_factory = ChooseQuestionSetFactory()
-diabetes_question_set_factory = DiabetesQuestionSetFactory()
+flow_engine = FlowEngine.load(flow_definitions_dir, cache_path=flow_cache_path)
+
+_prediction_client: PredictionClient | None = None
+_predictor: Predictor | None = None
+_predictor_lock = threading.Lock()
+
+
+def _is_valid_prediction(disease: str, response_data: dict[str, Any]) -> bool:
+    '''
+    快取前確認回應能以問題集的結果格式解讀，格式錯誤的回應不會在整個 ttl 內一再回覆伺服端錯誤
+    '''
+    return all(result.is_valid(response_data) for result in flow_engine.result_formats(disease))
+
+
+def get_predictor() -> Predictor:
+    '''
+    預測 API client 與快取、批次等包裝 (以及本地模型) 在第一次預測 (或暖機) 時才建立，
+    不佔用冷啟動到處理第一則訊息之間的時間
+    '''
+    global _prediction_client, _predictor
+    if _predictor is not None:
+        return _predictor
+    with _predictor_lock:
+        if _predictor is None:
+            client = PredictionClient(
+                base_url=base_api_url,
+                connect_timeout=predict_connect_timeout,
+                read_timeout=predict_read_timeout,
+                retries=predict_retries,
+                pool_size=predict_pool_size,
+                breaker=CircuitBreaker(failure_threshold=predict_breaker_threshold, reset_timeout=predict_breaker_reset)
+            )
+            metrics_registry.register_stats("linebot_prediction_client", "Prediction API client", lambda: client.stats)
+            metrics_registry.register_histogram("linebot_prediction_request_seconds", "Prediction API request latency",
+                                                client.latency)
+            predictor: Predictor = client
+            if predict_batch_size > 1:
+                predictor = BatchingPredictor(client, max_batch_size=predict_batch_size, window=predict_batch_window,
+                                              flush_workers=predict_pool_size)
+                metrics_registry.register_stats("linebot_prediction_batcher", "Prediction micro-batching",
+                                                lambda batcher=predictor: batcher.stats)
+            if predict_cache_size > 0:
+                predictor = CachingPredictor(predictor, max_size=predict_cache_size, ttl=predict_cache_ttl,
+                                             single_flight=predict_cache_single_flight, validate=_is_valid_prediction)
+                metrics_registry.register_stats("linebot_prediction_cache", "Prediction result cache", lambda cache=predictor: cache.stats)
+            if predict_model_dir:
+                # 有本地模型的疾病不需要經過網路，預測 API 只作為 fallback
+                predictor = LocalPredictor(predict_model_dir, fallback=predictor if predict_remote_fallback else None)
+                metrics_registry.register_stats("linebot_local_predictor", "In-process prediction models",
+                                                lambda local=predictor: local.stats)
+            _prediction_client = client
+            _predictor = predictor
+    return _predictor
+
+
+def get_prediction_client() -> PredictionClient:
+    get_predictor()
+    return _prediction_client
+
+
+# 綜合篩檢同時呼叫多種疾病的預測，執行緒在第一次篩檢時才建立
+prediction_fanout = PredictionFanout(get_predictor, max_workers=predict_fanout_workers,
+                                     default_deadline=predict_fanout_deadline)
+metrics_registry.register_stats("linebot_prediction_fanout", "Concurrent multi-disease screening", lambda: prediction_fanout.stats)
+
+
+# 完成問卷的回答與預測結果，請求執行緒只放進佇列，由背景執行緒批次寫檔
+answer_log: AnswerLog | None = None
+if answer_log_dir:
+    answer_log = AnswerLog(answer_log_dir, max_segment_bytes=answer_log_segment_bytes,
+                           max_segment_age=answer_log_segment_seconds, flush_interval=answer_log_flush_interval,
+                           queue_size=answer_log_queue_size)
+    metrics_registry.register_stats("linebot_answer_log", "Completed answer log", lambda: answer_log.stats)
+    atexit.register(answer_log.close, 5)
+
+_state_decoder = json.JSONDecoder()
 
 
 class User(object):
-    GOODBYE_MESSAGE = TextSendMessage(text="謝謝光臨!! 有需要都可以在叫我喔")
-    NOT_IMPLEMENTED_MESSAGE = TextSendMessage(text="本功能尚未完成，敬請期待！")
-    SERVER_ERROR_MESSAGE = TextSendMessage(text="伺服端錯誤，請稍後再試。")
+    GOODBYE_MESSAGE = text_message("謝謝光臨!! 有需要都可以在叫我喔")
+    NOT_IMPLEMENTED_MESSAGE = text_message("本功能尚未完成，敬請期待！")
+    SERVER_ERROR_MESSAGE = text_message("伺服端錯誤，請稍後再試。")
     '''
-    question_set: 當前的問題集
+    question_set: 當前的問題集 (所有使用者共用的模板)
     index: 問題集問題陣列的索引值
+    answers: 每個問題的回答，順序與問題集相同
+    asked: 已問出的問題 bitmap，第 i 個 bit 代表第 i 個問題
     timeout: 超時時間，即使用者過幾秒未回答
     last_answer_time: 上次回答的時間，每次使用answer(ans)方法時，都必須設置此值為當時的時間
     is_end: 預測是否結束
+    completed_at: 最近一次完成預測 (或綜合篩檢) 的時間，尚未完成過時為 None
     '''
+    STATE_VERSION = 2
+
+    __slots__ = ("_question_set", "_index", "_answers", "_asked", "_timeout", "_last_answer_time", "_is_end", "_completed_at",
+                 "_loaded_state")
+
     def __init__(self, timeout: float) -> None:
-        self._question_set = initial_question_set_factory.generate()
-        self._index = 0
         self._timeout = timeout
+        self._loaded_state: bytes | None = None
+        self._load_question_set(flow_engine.initial)
         self._last_answer_time = time.time()
         self._is_end = False
+        self._completed_at: float | None = None
+
+    def _load_question_set(self, question_set: QuestionSet) -> None:
+        self._question_set = question_set
+        self._index = 0
+        self._answers: list[Any] = [None] * len(question_set.questions)
+        self._asked = 0
+
+    def to_state(self) -> bytes:
+        '''
+        將使用者狀態序列化，供 session store 儲存。
+        格式: [版本, 問題集 key, index, 回答, 已問出的問題 bitmap, last_answer_time, is_end, completed_at]
+        '''
+        state = [self.STATE_VERSION, self._question_set.key, self._index, self._answers,
+                 self._asked, self._last_answer_time, self._is_end, self._completed_at]
+        return json.dumps(state, separators=(",", ":"), ensure_ascii=False).encode()
+
+    @classmethod
+    def from_state(cls, data: bytes, timeout: float) -> "User":
+        state = _state_decoder.decode(data.decode())
+        if state and state[0] == 1:
+            # 第 1 版沒有 completed_at，已結束的使用者以最後一次回答的時間代替
+            version, key, index, answers, asked, last_answer_time, is_end = state
+            completed_at = last_answer_time if is_end else None
+        else:
+            version, key, index, answers, asked, last_answer_time, is_end, completed_at = state
+            if version != cls.STATE_VERSION:
+                raise ValueError(f"Unsupported user state version: {version}")
+        # 所有欄位都來自 data，不需要經過 __init__ 載入初始問題集
+        user = cls.__new__(cls)
+        user._timeout = timeout
+        user._question_set = flow_engine.question_set(key)
+        user._index = index
+        user._answers = answers
+        user._asked = asked
+        user._last_answer_time = last_answer_time
+        user._is_end = is_end
+        user._completed_at = completed_at
+        user._loaded_state = data
+        return user
+
+    @property
+    def is_dirty(self) -> bool:
+        '''
+        自上次從 session store 讀出後狀態是否有改變
+        '''
+        return self._loaded_state is None or self._loaded_state != self.to_state()
 
     @property
     def is_end(self) -> bool:
@@ -40,10 +184,38 @@ class User(object):
     @property
     def is_timeout(self) -> bool:
         return time.time() - self._last_answer_time > self._timeout
+
+    @property
+    def last_answer_time(self) -> float:
+        return self._last_answer_time
+
+    @property
+    def completed_at(self) -> float | None:
+        return self._completed_at
+
+    @property
+    def in_progress(self) -> bool:
+        '''
+        是否已開始回答、尚未完成 (只被問了第一題的使用者不算)
+        '''
+        return not self._is_end and (self._index > 0 or self._question_set is not flow_engine.initial)
+
+    @property
+    def completed_prediction(self) -> bool:
+        '''
+        是否已完成一次預測 (而不是選擇不預測而結束)
+        '''
+        if not self._is_end:
+            return False
+        transition = flow_engine.transition(self._question_set.key, self.current_answer)
+        return transition is not None and transition.action in (Transition.PREDICT, Transition.SCREEN)
+
+    @property
+    def expires_at(self) -> float:
+        return self._last_answer_time + self._timeout
     
     def reset(self) -> None:
-        self._question_set = initial_question_set_factory.generate()
-        self._index = 0
+        self._load_question_set(flow_engine.initial)
         self._last_answer_time = time.time()
         self._is_end = False
 
@@ -54,49 +226,114 @@ class User(object):
     @property
     def current_question(self) -> Question:
         return self._question_set.questions[self._index]
+
+    @property
+    def current_question_is_asked(self) -> bool:
+        return bool(self._asked >> self._index & 1)
+
+    @property
+    def current_answer(self) -> Any:
+        return self._answers[self._index]
+
+    def ask_current_question(self, reply: ReplyCollector) -> None:
+        self.current_question.ask(reply=reply)
+        self.mark_current_question_asked()
+
+    def mark_current_question_asked(self) -> None:
+        '''
+        問題由其他途徑 (例如主動推播) 送出時使用
+        '''
+        self._asked |= 1 << self._index
+
+    def answer_current_question(self, reply: ReplyCollector, ans: str) -> bool:
+        '''
+        Return True if the answer if valid else False
+        '''
+        question = self.current_question
+        start = time.perf_counter()
+        status = question.answer(reply=reply, ans=ans)
+        stage_seconds.observe(time.perf_counter() - start, "answer_validation")
+        if status.ans_is_valid:
+            self._answers[self._index] = status.value
+        else:
+            invalid_answers.inc(self._question_set.key, question.key or str(self._index))
+        return status.ans_is_valid
     
     def goto_next_question(self) -> None:
         self._index += 1
 
-    def finalize(self, line_bot_api: LineBotApi, reply_token: str) -> None:
-        if self._question_set.key == QuestionSet.KEY_TEST:
-            if self.current_question.ans == "0":
-                self._is_end = True
-                line_bot_api.reply_message(reply_token, self.GOODBYE_MESSAGE)
-            elif self.current_question.ans == "1":
-                self._question_set = choose_question_set_factory.generate()
-                self._index = 0
-        elif self._question_set.key == QuestionSet.KET_CHOOSE:
-            if self.current_question.ans == "1":
-                self._question_set = diabetes_question_set_factory.generate()
-                self._index = 0
-            else:
-                line_bot_api.reply_message(reply_token, self.NOT_IMPLEMENTED_MESSAGE)
-        elif self._question_set.key == QuestionSet.KEY_DIABETES:
+    def finalize(self, reply: ReplyCollector) -> None:
+        '''
+        依問題集與最後一題的回答，由 flow_engine 查出下一步
+        '''
+        transition = flow_engine.transition(self._question_set.key, self.current_answer)
+        if transition is None:
+            return
+        if transition.action == Transition.GOTO:
+            self._load_question_set(flow_engine.question_set(transition.target))
+        elif transition.action == Transition.END:
+            self._is_end = True
+            reply.add(transition.messages)
+            flow_completions.inc(self._question_set.key, transition.action)
+        elif transition.action == Transition.REPLY:
+            reply.add(transition.messages)
+        elif transition.action == Transition.PREDICT:
             request_data = {}
 
-            for question in self._question_set.questions:
-                request_data[question.key] = question.ans
+            for question, ans in zip(self._question_set.questions, self._answers):
+                request_data[question.key] = ans
 
-            api_url = f"{base_api_url}/predict/diabetes"
+            start = time.perf_counter()
             try:
-                response = requests.post(api_url, json=request_data, headers={'Content-type': 'application/json'})
-                response.raise_for_status()
+                response_data = get_predictor().predict(transition.disease, request_data)
+                messages = transition.result.format(response_data) + transition.messages
+            except (Exception, PredictionError):
+                # 回應格式錯誤時使用者收到的是伺服端錯誤，紀錄也標為失敗
+                response_data = None
+                reply.add(self.SERVER_ERROR_MESSAGE)
+            else:
+                reply.add(messages)
+                self._is_end = True
+                self._completed_at = time.time()
+                flow_completions.inc(self._question_set.key, transition.action)
+            finally:
+                stage_seconds.observe(time.perf_counter() - start, "finalize_backend")
+            self._log_answers(transition.disease, request_data, response_data)
+        elif transition.action == Transition.SCREEN:
+            self._screen(reply, transition)
 
-                response_data = response.json()
+    def _screen(self, reply: ReplyCollector, transition: Transition) -> None:
+        '''
+        每種疾病只送出它需要的回答，所有預測同時進行，
+        回覆期限內取得的結果 (每種疾病一行)，全部失敗時才回覆伺服端錯誤
+        '''
+        answers = {question.key: ans for question, ans in zip(self._question_set.questions, self._answers)}
+        calls = [(prediction.disease, {key: answers[key] for key in prediction.features}, prediction.deadline)
+                 for prediction in transition.predictions]
 
-                have_diabetes = response_data.get('have_diabetes', None)
-                diabetes_percentage = response_data.get('diabetes_percentage', None)
+        start = time.perf_counter()
+        results = prediction_fanout.predict_all(calls)
+        stage_seconds.observe(time.perf_counter() - start, "finalize_backend")
+        for disease, features, _ in calls:
+            self._log_answers(disease, features, results[disease])
 
-                if have_diabetes is None or diabetes_percentage is None:
-                    raise ValueError("Response error!")
+        if all(result is None for result in results.values()):
+            reply.add(self.SERVER_ERROR_MESSAGE)
+            return
+        lines = [prediction.result.summary(results[prediction.disease]) for prediction in transition.predictions]
+        reply.add([TextSendMessage(text="\n".join(lines))] + transition.messages)
+        self._is_end = True
+        self._completed_at = time.time()
+        flow_completions.inc(self._question_set.key, transition.action)
 
-                result = "没有糖尿病" if have_diabetes is False else "有糖尿病"
-                line_bot_api.reply_message(reply_token, [
-                    TextSendMessage(text=f"{result}"),
-                    TextSendMessage(text=f"糖尿病機率:{diabetes_percentage:.2f}%"),
-                    self.GOODBYE_MESSAGE
-                ])
-                self._is_end = True
-            except (Exception, requests.HTTPError):
-                line_bot_api.reply_message(reply_token, self.SERVER_ERROR_MESSAGE)
\ No newline at end of file
+    def _log_answers(self, disease: str, answers: dict[str, Any], result: dict[str, Any] | None) -> None:
+        if answer_log is None:
+            return
+        answer_log.append({
+            "ts": time.time(),
+            "flow": self._question_set.key,
+            "disease": disease,
+            "ok": result is not None,
+            "answers": answers,
+            "result": result,
+        })
@@ -1,23 +1,214 @@
 from abc import ABC
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator
+
 from .user import User
+from .session_store import SessionStore, SessionConflict, MemorySessionStore
+from .session_snapshot import write_snapshot, read_snapshot, remove_snapshot
+from services import stage_seconds
 
+import logging
+import os
+import threading
+import time
+
+
+class _LockBucket(object):
+    '''
+    一部分使用者的鎖，user_id -> [鎖, 正在使用或等待這把鎖的執行緒數]。
+    bucket 的鎖只在取得或歸還使用者的鎖時短暫持有，沒有人使用的使用者鎖會被移除
+    '''
+    __slots__ = ("lock", "users", "waits")
 
-class UserBoard(ABC):
     def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.users: dict[str, list] = {}
+        self.waits = 0
+
+    def acquire(self, user_id: str) -> threading.RLock:
+        with self.lock:
+            entry = self.users.get(user_id)
+            if entry is None:
+                entry = self.users[user_id] = [threading.RLock(), 0]
+            entry[1] += 1
+        user_lock = entry[0]
+        if not user_lock.acquire(blocking=False):
+            with self.lock:
+                self.waits += 1
+            user_lock.acquire()
+        return user_lock
+
+    def release(self, user_id: str, user_lock: threading.RLock) -> None:
+        user_lock.release()
+        with self.lock:
+            entry = self.users[user_id]
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.users[user_id]
+
+
+class UserSession(object):
+    '''
+    UserBoard.session 中目前使用者的狀態，離開 session 時寫回 session store
+    '''
+    __slots__ = ("_board", "_user_id", "_user", "_removed")
+
+    def __init__(self, board: "UserBoard", user_id: str, user: User | None) -> None:
+        self._board = board
+        self._user_id = user_id
+        self._user = user
+        self._removed = False
+
+    @property
+    def user(self) -> User | None:
+        return self._user
+
+    def take_timed_out(self) -> bool:
+        '''
+        Return True if the user does not exist because sweep removed the user before the user finished.
+        只有處理使用者傳來的事件時才取走超時紀錄 (見 SessionStore.take_timed_out)
+        '''
+        return self._user is None and not self._removed and self._board.take_timed_out(self._user_id)
+
+    def get_or_create(self) -> User:
+        if self._user is None:
+            self._user = self._board.add_user(self._user_id)
+            self._removed = False
+        return self._user
+
+    def remove(self) -> None:
+        self._board.remove_user(self._user_id)
+        self._user = None
+        self._removed = True
+
+    def close(self) -> None:
+        if self._user is not None and not self._removed:
+            self._board.save_user(self._user_id, self._user)
+
+
+class UserBoard(ABC):
+    '''
+    事件應在 session(user_id) 中處理: 期間持有該使用者的鎖，
+    讀出 (或建立) 使用者、處理事件、寫回 session store 整個過程不會與同一使用者的其他事件交錯，
+    每個事件對 session store 只會有一次讀取與一次寫入。
+
+    使用者的鎖分散在 stripes 個 bucket 中，每個 bucket 各自一把鎖，
+    不同使用者只有在同一個 bucket 取得或歸還鎖的瞬間才會互相等待，
+    處理事件期間 (包含呼叫預測 API) 只會擋住同一位使用者。
+    '''
+    def __init__(self, store: SessionStore | None = None, stripes: int = 64) -> None:
         super().__init__()
-        self._users: dict[str, User] = {}
+        self._store = store if store is not None else MemorySessionStore(timeout=300)
+        self._buckets = [_LockBucket() for _ in range(max(1, stripes))]
+
+    def _bucket(self, user_id: str) -> _LockBucket:
+        return self._buckets[hash(user_id) % len(self._buckets)]
+
+    @contextmanager
+    def lock_user(self, user_id: str) -> Iterator[None]:
+        '''
+        同一位使用者的 critical section，同一執行緒可以重複進入
+        '''
+        bucket = self._bucket(user_id)
+        user_lock = bucket.acquire(user_id)
+        try:
+            yield
+        finally:
+            bucket.release(user_id, user_lock)
+
+    @contextmanager
+    def session(self, user_id: str) -> Iterator[UserSession]:
+        with self.lock_user(user_id):
+            start = time.perf_counter()
+            session = UserSession(self, user_id, self._store.load(user_id))
+            stage_seconds.observe(time.perf_counter() - start, "session_lookup")
+            try:
+                yield session
+            finally:
+                session.close()
+
+    def get_or_create(self, user_id: str) -> tuple[User, bool]:
+        '''
+        Return the user and whether it was just created.
+        檢查與建立在使用者的鎖中完成，兩個事件同時抵達時只會建立一名使用者
+        '''
+        with self.lock_user(user_id):
+            user = self._store.load(user_id)
+            if user is not None:
+                return user, False
+            user = self.add_user(user_id)
+            try:
+                self._store.save(user_id, user)
+            except SessionConflict:
+                # 其他 process 同時建立了這位使用者
+                return self._store.load(user_id), False
+            return user, True
+
+    def take_timed_out(self, user_id: str) -> bool:
+        '''
+        見 SessionStore.take_timed_out，在使用者的鎖中完成，不會與同一使用者的事件同時取得
+        '''
+        with self.lock_user(user_id):
+            return self._store.take_timed_out(user_id)
 
     def is_user_exist(self, user_id: str) -> bool:
-        return False if self._users.get(user_id) is None else True
+        return False if self._store.load(user_id) is None else True
+
+    def add_user(self, user_id: str) -> User:
+        return User(timeout=self._store.timeout)
 
-    def add_user(self, user_id: str):
-        self._users[user_id] = User(timeout=300)
+    def get_user(self, user_id: str) -> User | None:
+        return self._store.load(user_id)
+
+    def save_user(self, user_id: str, user: User) -> None:
+        self._store.save(user_id, user)
 
-    def get_user(self, user_id: str) -> User:
-        return self._users.get(user_id)
-    
     def remove_user(self, user_id: str) -> None:
-        user = self.get_user(user_id=user_id)
-        if user is not None:
-            self._users.pop(user_id)
-    
+        self._store.delete(user_id)
+
+    def remove_expired_users(self) -> int:
+        return self._store.sweep()
+
+    def scan(self, cursor: Any = None, limit: int = 500) -> tuple[list[tuple[str, User]], Any]:
+        '''
+        分頁讀取使用者，見 SessionStore.scan。讀出的使用者不在鎖中，要修改時必須在 session(user_id) 中重新讀取
+        '''
+        return self._store.scan(cursor, limit)
+
+    def set_expire_listener(self, listener: Callable[[str, User], None] | None) -> None:
+        self._store.set_expire_listener(listener)
+
+    def snapshot(self, path: str) -> int:
+        '''
+        把尚未超時的使用者寫成快照，Return the number of users written
+        '''
+        start = time.perf_counter()
+        count = write_snapshot(path, self._store.items())
+        logging.info("Wrote %d sessions to %s in %.3fs", count, path, time.perf_counter() - start)
+        return count
+
+    def restore(self, path: str) -> dict[str, int | bool]:
+        '''
+        從快照讀回尚未超時的使用者，已經存在的使用者不會被覆蓋。
+        讀完後刪除快照，之後異常結束而沒有寫新快照時，不會再讀回過時的狀態
+        '''
+        if not os.path.exists(path):
+            return {}
+        start = time.perf_counter()
+        reader = read_snapshot(path, timeout=self._store.timeout)
+        try:
+            self._store.restore(reader)
+        except (OSError, ValueError, UnicodeDecodeError):
+            logging.exception("Unable to restore sessions from %s", path)
+        remove_snapshot(path)
+        stats = reader.stats
+        logging.info("Restored sessions from %s in %.3fs: %s", path, time.perf_counter() - start, stats)
+        return stats
+
+    @property
+    def stats(self) -> dict[str, int]:
+        stats = self._store.stats
+        stats["lock_stripes"] = len(self._buckets)
+        stats["locked_users"] = sum(len(bucket.users) for bucket in self._buckets)
+        stats["lock_waits"] = sum(bucket.waits for bucket in self._buckets)
+        return stats
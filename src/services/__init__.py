@@ -0,0 +1,14 @@
+from .dispatcher import EventDispatcher
+from .prediction_client import Predictor, PredictionClient, PredictionError, CircuitOpenError, CircuitBreaker, LatencyHistogram
+from .prediction_cache import CachingPredictor
+from .prediction_batcher import BatchingPredictor
+from .prediction_fanout import PredictionFanout
+from .local_predictor import LocalPredictor, LogisticModel, save_logistic_model
+from .line_http_client import PooledRequestsHttpClient
+from .metrics import MetricsRegistry, metrics_registry, stage_seconds, session_timeouts, invalid_answers, flow_completions, duplicate_events
+from .metrics import failed_events
+from .rate_limiter import TokenBucket, KeyedRateLimiter, FloodControl
+from .multicast import MulticastSender
+from .answer_log import AnswerLog
+from .webhook import WebhookIngestor, WebhookEvent, WebhookError
+from .tracing import EventTracer, Trace
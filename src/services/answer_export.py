@@ -0,0 +1,178 @@
+'''
+把 AnswerLog 的區段檔轉成欄位式格式給資料分析使用，不會一次把所有紀錄讀進記憶體:
+逐行讀取區段檔，每個問題集各自累積 chunk_rows 筆後寫出一次。
+
+parquet: 每個問題集一個 (或欄位改變時多個) Parquet 檔，每 chunk_rows 筆為一個 row group，需要 pyarrow
+csv: 每個問題集每 chunk_rows 筆一個 CSV 檔，可用 pandas.concat(map(pandas.read_csv, ...)) 讀回
+未指定 --format 時，有安裝 pyarrow 就輸出 parquet，否則輸出 csv
+
+每筆紀錄攤平成 ts, flow, disease, ok, answer_<問題 key>..., result_<欄位>...
+
+    cd src && python -m services.answer_export /data/answers /data/export --format parquet
+'''
+from typing import Any, Iterator
+
+import argparse
+import glob
+import json
+import logging
+import os
+
+from .answer_log import OPEN_SUFFIX, CLOSED_SUFFIX
+
+
+def segment_paths(directory: str, include_open: bool = False) -> list[str]:
+    '''
+    Return segment paths in the order they were written
+    '''
+    paths = glob.glob(os.path.join(directory, "answers-*" + CLOSED_SUFFIX))
+    if include_open:
+        paths += glob.glob(os.path.join(directory, "answers-*" + OPEN_SUFFIX))
+    return sorted(paths, key=os.path.basename)
+
+
+def iter_records(paths: list[str]) -> Iterator[dict[str, Any]]:
+    '''
+    寫到一半的最後一行等無法解析的行會被略過
+    '''
+    for path in paths:
+        with open(path, "rb") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    logging.warning("Skipped malformed answer log line in %s", path)
+
+
+def flatten(record: dict[str, Any]) -> dict[str, Any]:
+    row = {
+        "ts": record.get("ts"),
+        "flow": record.get("flow"),
+        "disease": record.get("disease"),
+        "ok": record.get("ok"),
+    }
+    for key, value in (record.get("answers") or {}).items():
+        row[f"answer_{key}"] = value
+    for key, value in (record.get("result") or {}).items():
+        row[f"result_{key}"] = value
+    return row
+
+
+class _CsvSink(object):
+    def __init__(self, output: str, flow: str) -> None:
+        self._output = output
+        self._flow = flow
+        self._parts = 0
+
+    def write(self, rows: list[dict[str, Any]]) -> None:
+        import pandas as pd
+
+        path = os.path.join(self._output, f"{self._flow}-{self._parts:05d}.csv")
+        pd.DataFrame.from_records(rows).to_csv(path, index=False)
+        self._parts += 1
+
+    def close(self) -> None:
+        pass
+
+
+class _ParquetSink(object):
+    '''
+    同一個問題集的 chunk 寫進同一個 Parquet 檔的不同 row group，
+    欄位或型別無法轉換成目前檔案的 schema 時 (例如問題集改版) 另開一個檔案
+    '''
+    def __init__(self, output: str, flow: str) -> None:
+        self._output = output
+        self._flow = flow
+        self._parts = 0
+        self._writer = None
+
+    def write(self, rows: list[dict[str, Any]]) -> None:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        # from_pylist 只以第一筆的 key 決定欄位，失敗的預測 (沒有 result) 或綜合篩檢各疾病的回答不同時會漏掉欄位，
+        # 改以整個 chunk 所有 key 的聯集建表，型別也由整欄推斷
+        columns = dict.fromkeys(key for row in rows for key in row)
+        table = pa.Table.from_pydict({column: [row.get(column) for row in rows] for column in columns})
+        if self._writer is not None and table.schema != self._writer.schema:
+            try:
+                if set(table.schema.names) != set(self._writer.schema.names):
+                    raise ValueError("columns changed")
+                table = table.select(self._writer.schema.names).cast(self._writer.schema)
+            except (ValueError, pa.ArrowInvalid, pa.ArrowNotImplementedError):
+                self.close()
+        if self._writer is None:
+            path = os.path.join(self._output, f"{self._flow}-{self._parts:05d}.parquet")
+            self._writer = pq.ParquetWriter(path, table.schema)
+            self._parts += 1
+        self._writer.write_table(table)
+
+    def close(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+
+def default_format() -> str:
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return "csv"
+    return "parquet"
+
+
+def export(directory: str, output: str, format: str | None = None, chunk_rows: int = 50000,
+           include_open: bool = False) -> dict[str, int]:
+    '''
+    Return the number of rows exported for each flow
+    '''
+    format = format or default_format()
+    if format == "parquet":
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise RuntimeError("parquet export requires pyarrow, use --format csv instead")
+        sink_class = _ParquetSink
+    elif format == "csv":
+        sink_class = _CsvSink
+    else:
+        raise ValueError(f"Unknown export format: {format}")
+
+    os.makedirs(output, exist_ok=True)
+    sinks: dict[str, Any] = {}
+    buffers: dict[str, list[dict[str, Any]]] = {}
+    counts: dict[str, int] = {}
+    try:
+        for record in iter_records(segment_paths(directory, include_open)):
+            row = flatten(record)
+            flow = str(row["flow"] or "unknown")
+            buffer = buffers.setdefault(flow, [])
+            buffer.append(row)
+            if len(buffer) >= chunk_rows:
+                sinks.setdefault(flow, sink_class(output, flow)).write(buffer)
+                counts[flow] = counts.get(flow, 0) + len(buffer)
+                buffers[flow] = []
+        for flow, buffer in buffers.items():
+            if buffer:
+                sinks.setdefault(flow, sink_class(output, flow)).write(buffer)
+                counts[flow] = counts.get(flow, 0) + len(buffer)
+    finally:
+        for sink in sinks.values():
+            sink.close()
+    return counts
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("directory", help="AnswerLog 的區段檔目錄")
+    parser.add_argument("output", help="輸出目錄")
+    parser.add_argument("--format", choices=("parquet", "csv"))
+    parser.add_argument("--chunk-rows", type=int, default=50000)
+    parser.add_argument("--include-open", action="store_true", help="一併匯出仍在寫入中的區段檔")
+    args = parser.parse_args()
+    counts = export(args.directory, args.output, args.format, args.chunk_rows, args.include_open)
+    print(json.dumps(counts, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+from queue import Queue, Full, Empty
+from typing import Any
+
+import glob
+import json
+import logging
+import os
+import threading
+import time
+
+'''
+完成問卷的回答與預測結果，以 append-only 的 JSON Lines 區段檔 (segment) 保存，供資料分析使用。
+請求執行緒只把紀錄放進記憶體中的佇列，序列化、寫檔與 fsync 都由背景執行緒批次完成。
+
+正在寫入的區段檔副檔名為 .jsonl.open，超過 max_segment_bytes 或開啟超過 max_segment_age 秒後
+關閉並改名為 .jsonl，匯出時只讀取已關閉的區段檔 (見 answer_export.py)。
+'''
+
+OPEN_SUFFIX = ".jsonl.open"
+CLOSED_SUFFIX = ".jsonl"
+
+
+class AnswerLog(object):
+    '''
+    directory: 區段檔所在的目錄
+    max_segment_bytes: 區段檔超過此大小後換新的檔案
+    max_segment_age: 區段檔開啟超過此秒數後關閉 (沒有新紀錄時也會關閉)，流量小時匯出也看得到最近的紀錄；0 代表不限
+    flush_interval: 收到第一筆紀錄後最多等幾秒就寫入並 fsync，期間內的紀錄共用一次 fsync
+    max_batch: 一次最多寫入幾筆紀錄
+    queue_size: 佇列容量，寫入跟不上時多出的紀錄會被丟棄而不會拖慢請求
+    '''
+    def __init__(self, directory: str, max_segment_bytes: int = 64 * 1024 * 1024, max_segment_age: float = 3600,
+                 flush_interval: float = 1.0, max_batch: int = 1000, queue_size: int = 10000) -> None:
+        self._directory = directory
+        self._max_segment_bytes = max_segment_bytes
+        self._max_segment_age = max_segment_age
+        self._flush_interval = flush_interval
+        self._max_batch = max(1, max_batch)
+        self._queue: Queue = Queue(maxsize=queue_size)
+        self._thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+
+        self._file = None
+        self._path: str | None = None
+        self._size = 0
+        self._closes_at = 0.0
+        self._sequence = 0
+
+        self._enqueued = 0
+        self._dropped = 0
+        self._written = 0
+        self._batches = 0
+        self._segments = 0
+        self._write_errors = 0
+        self._bytes = 0
+
+    @property
+    def directory(self) -> str:
+        return self._directory
+
+    @property
+    def stats(self) -> dict[str, int]:
+        return {
+            "enqueued": self._enqueued,
+            "dropped": self._dropped,
+            "written": self._written,
+            "fsyncs": self._batches,
+            "segments": self._segments,
+            "bytes": self._bytes,
+            "write_errors": self._write_errors,
+            "depth": self._queue.qsize(),
+        }
+
+    def append(self, record: dict[str, Any]) -> bool:
+        '''
+        Return True if the record is enqueued else False (queue is full)
+        '''
+        if self._thread is None:
+            self.start()
+        try:
+            self._queue.put_nowait(record)
+        except Full:
+            with self._lock:
+                self._dropped += 1
+            return False
+        with self._lock:
+            self._enqueued += 1
+        return True
+
+    def start(self) -> None:
+        # 與 EventDispatcher 相同，gunicorn fork 之後第一次需要時才建立執行緒
+        with self._lock:
+            if self._thread is not None:
+                return
+            os.makedirs(self._directory, exist_ok=True)
+            self._close_stale_segments()
+            self._thread = threading.Thread(target=self._run, name="answer-log", daemon=True)
+            self._thread.start()
+
+    def close(self, timeout: float | None = None) -> None:
+        '''
+        寫完佇列中剩下的紀錄後關閉目前的區段檔
+        '''
+        with self._lock:
+            if self._thread is None:
+                return
+            self._queue.put(None)
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self) -> None:
+        while True:
+            try:
+                record = self._queue.get(timeout=self._segment_remaining())
+            except Empty:
+                # 區段檔開啟太久且期間沒有新紀錄
+                self._close_segment()
+                continue
+            if record is None:
+                break
+            batch = [record]
+            stopping = False
+            deadline = time.monotonic() + self._flush_interval
+            while len(batch) < self._max_batch:
+                remaining = deadline - time.monotonic()
+                try:
+                    record = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except Empty:
+                    break
+                if record is None:
+                    stopping = True
+                    break
+                batch.append(record)
+            self._write(batch)
+            if stopping:
+                break
+        self._close_segment()
+
+    def _write(self, batch: list[dict[str, Any]]) -> None:
+        lines = []
+        for record in batch:
+            try:
+                lines.append(json.dumps(record, ensure_ascii=False, separators=(",", ":"), default=str))
+            except (TypeError, ValueError):
+                self._write_errors += 1
+        if not lines:
+            return
+        data = ("\n".join(lines) + "\n").encode()
+        try:
+            if self._file is None:
+                self._open_segment()
+            self._file.write(data)
+            self._file.flush()
+            # 整批紀錄只 fsync 一次
+            os.fsync(self._file.fileno())
+        except OSError:
+            self._write_errors += len(lines)
+            logging.exception("Unable to write answer log segment %s", self._path)
+            self._close_segment()
+            return
+        self._written += len(lines)
+        self._batches += 1
+        self._size += len(data)
+        self._bytes += len(data)
+        if self._size >= self._max_segment_bytes or self._segment_remaining() == 0:
+            self._close_segment()
+
+    def _segment_remaining(self) -> float | None:
+        '''
+        Return seconds until the open segment reaches max_segment_age, None if there is no deadline
+        '''
+        if self._file is None or self._max_segment_age <= 0:
+            return None
+        return max(0.0, self._closes_at - time.monotonic())
+
+    def _open_segment(self) -> None:
+        self._sequence += 1
+        name = f"answers-{int(time.time() * 1000):013d}-{os.getpid()}-{self._sequence:04d}"
+        self._path = os.path.join(self._directory, name + OPEN_SUFFIX)
+        self._file = open(self._path, "ab")
+        self._size = 0
+        self._closes_at = time.monotonic() + self._max_segment_age
+        self._segments += 1
+
+    def _close_segment(self) -> None:
+        if self._file is None:
+            return
+        try:
+            self._file.close()
+            os.replace(self._path, self._path[:-len(OPEN_SUFFIX)] + CLOSED_SUFFIX)
+        except OSError:
+            logging.exception("Unable to close answer log segment %s", self._path)
+        self._file = None
+        self._path = None
+
+    def _close_stale_segments(self) -> None:
+        '''
+        上次異常結束而沒有關閉的區段檔，若寫入的 process 已不存在就改名為已關閉，
+        最後一行可能寫到一半，匯出時會略過
+        '''
+        for path in glob.glob(os.path.join(self._directory, "answers-*" + OPEN_SUFFIX)):
+            try:
+                pid = int(os.path.basename(path).split("-")[2])
+            except (IndexError, ValueError):
+                continue
+            if pid != os.getpid() and _process_exists(pid):
+                continue
+            try:
+                os.replace(path, path[:-len(OPEN_SUFFIX)] + CLOSED_SUFFIX)
+            except OSError:
+                pass
+
+
+def _process_exists(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
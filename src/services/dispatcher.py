@@ -0,0 +1,126 @@
+from queue import Queue, Full
+from typing import Any, Callable
+
+import threading
+import logging
+import time
+
+
+class EventDispatcher(object):
+    '''
+    將 webhook 事件丟進有上限的佇列，由背景 worker 執行緒處理。
+    同一個 key (user_id) 的事件一定落在同一個 worker 的佇列，
+    因此同一使用者的事件會依序處理，不同使用者則可平行處理。
+    handle 應自行處理並計算失敗 (見 bot.handling_event 與 linebot_failed_events_total)，
+    這裡只記錄漏出來的例外，不讓 worker 結束
+
+    handle: 處理單一事件的函數
+    workers: worker 執行緒數量
+    queue_size: 所有佇列的總容量
+    enqueue_timeout: 佇列已滿時最多等待幾秒，超過則拒絕該事件
+    '''
+    def __init__(self, handle: Callable[[Any], None], workers: int = 4, queue_size: int = 1000, enqueue_timeout: float = 0) -> None:
+        if workers < 1:
+            raise ValueError("workers must be at least 1")
+        self._handle = handle
+        self._workers = workers
+        self._enqueue_timeout = enqueue_timeout
+        shard_size = max(1, queue_size // workers)
+        self._queues: list[Queue] = [Queue(maxsize=shard_size) for _ in range(workers)]
+        self._threads: list[threading.Thread] = []
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._started = False
+
+        self._submitted = 0
+        self._processed = 0
+        self._rejected = 0
+        self._max_depth = 0
+        self._max_wait = 0.0
+        self._total_wait = 0.0
+
+    def start(self) -> None:
+        '''
+        gunicorn 會在載入 app 後 fork，執行緒必須在 fork 之後才建立，
+        因此第一次 submit 時才會呼叫 start。
+        '''
+        with self._lock:
+            if self._started:
+                return
+            for index, queue in enumerate(self._queues):
+                thread = threading.Thread(target=self._run, args=(queue,), name=f"event-worker-{index}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            self._started = True
+
+    def stop(self, timeout: float | None = None) -> None:
+        '''
+        等佇列中剩下的事件處理完後停止所有 worker。
+        '''
+        with self._lock:
+            if not self._started:
+                return
+            for queue in self._queues:
+                queue.put(None)
+            for thread in self._threads:
+                thread.join(timeout)
+            self._threads.clear()
+            self._started = False
+
+    def submit(self, key: str, event: Any) -> bool:
+        '''
+        Return True if the event is enqueued else False (queue is full)
+        '''
+        if not self._started:
+            self.start()
+        queue = self._queues[hash(key) % self._workers]
+        try:
+            if self._enqueue_timeout > 0:
+                queue.put((time.monotonic(), event), timeout=self._enqueue_timeout)
+            else:
+                queue.put_nowait((time.monotonic(), event))
+        except Full:
+            with self._stats_lock:
+                self._rejected += 1
+            return False
+        depth = self.depth
+        with self._stats_lock:
+            self._submitted += 1
+            if depth > self._max_depth:
+                self._max_depth = depth
+        return True
+
+    @property
+    def depth(self) -> int:
+        return sum(queue.qsize() for queue in self._queues)
+
+    @property
+    def stats(self) -> dict[str, int | float]:
+        return {
+            "workers": self._workers,
+            "capacity": sum(queue.maxsize for queue in self._queues),
+            "depth": self.depth,
+            "max_depth": self._max_depth,
+            "submitted": self._submitted,
+            "processed": self._processed,
+            "rejected": self._rejected,
+            "max_wait_seconds": self._max_wait,
+            "avg_wait_seconds": self._total_wait / self._processed if self._processed else 0.0,
+        }
+
+    def _run(self, queue: Queue) -> None:
+        while True:
+            item = queue.get()
+            if item is None:
+                break
+            enqueued_at, event = item
+            wait = time.monotonic() - enqueued_at
+            try:
+                self._handle(event)
+            except Exception:
+                logging.exception("Failed to handle webhook event")
+            with self._stats_lock:
+                self._processed += 1
+                self._total_wait += wait
+                if wait > self._max_wait:
+                    self._max_wait = wait
@@ -0,0 +1,60 @@
+from linebot.http_client import HttpClient, RequestsHttpClient, RequestsHttpResponse
+
+import logging
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .metrics import stage_seconds
+
+
+class PooledRequestsHttpClient(RequestsHttpClient):
+    '''
+    LineBotApi 預設的 RequestsHttpClient 每次呼叫都用 requests.post，
+    每則回覆都要重新建立 TCP 與 TLS 連線。
+    這個 client 改用共用的 requests.Session 保持連線，
+    也可以在收到第一個事件前以 warm_up 先連上 LINE API。
+    '''
+    POOL_SIZE = 10
+
+    def __init__(self, timeout=HttpClient.DEFAULT_TIMEOUT) -> None:
+        super().__init__(timeout)
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.POOL_SIZE)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        response = self._session.get(url, headers=headers, params=params, stream=stream,
+                                     timeout=self.timeout if timeout is None else timeout)
+        return RequestsHttpResponse(response)
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        # 只包含網路往返，reply_message 階段扣掉這段即為 SDK 序列化訊息的時間
+        start = time.perf_counter()
+        response = self._session.post(url, headers=headers, data=data, timeout=self.timeout if timeout is None else timeout)
+        stage_seconds.observe(time.perf_counter() - start, "line_request")
+        return RequestsHttpResponse(response)
+
+    def delete(self, url, headers=None, data=None, timeout=None):
+        response = self._session.delete(url, headers=headers, data=data, timeout=self.timeout if timeout is None else timeout)
+        return RequestsHttpResponse(response)
+
+    def put(self, url, headers=None, data=None, timeout=None):
+        response = self._session.put(url, headers=headers, data=data, timeout=self.timeout if timeout is None else timeout)
+        return RequestsHttpResponse(response)
+
+    def warm_up(self, url: str) -> bool:
+        '''
+        Return True if a connection to url is now in the pool
+        '''
+        try:
+            self._session.head(url, timeout=self.timeout)
+            return True
+        except requests.RequestException as e:
+            logging.warning("Unable to warm up LINE API connection: %s", e)
+            return False
+
+    def close(self) -> None:
+        self._session.close()
@@ -0,0 +1,215 @@
+from typing import Any, Sequence
+
+import glob
+import json
+import logging
+import math
+import os
+import threading
+
+from .prediction_client import Predictor, PredictionError
+
+'''
+在 process 內計算預測結果，不需要經過網路呼叫預測 API。
+模型以兩個檔案表示，放在同一個目錄中:
+    {disease}.json  模型描述，例如
+        {"type": "logistic_regression", "features": ["gender", "age", "bmi", "hba1c", "blood_sugar"],
+         "weights": "diabetes.npy", "threshold": 0.5,
+         "flag": "have_diabetes", "percentage": "diabetes_percentage",
+         "mean": [...], "scale": [...]}
+    {disease}.npy   float64 一維陣列 [截距, 每個特徵的係數...]，以 memory map 讀取
+mean 與 scale 為訓練時的標準化參數 (可省略)，載入時併入係數，計算時只需要一次內積。
+回傳格式與預測 API 相同: {flag: 是否患病, percentage: 機率 (0~100)}
+'''
+
+
+class LogisticModel(object):
+    TYPE = "logistic_regression"
+
+    def __init__(self, disease: str, features: Sequence[str], weights, threshold: float = 0.5,
+                 flag: str | None = None, percentage: str | None = None,
+                 mean: Sequence[float] | None = None, scale: Sequence[float] | None = None) -> None:
+        import numpy as np
+
+        if len(weights) != len(features) + 1:
+            raise ValueError(f"{disease} model expects {len(features) + 1} weights, got {len(weights)}")
+        self._disease = disease
+        self._features = tuple(features)
+        self._threshold = threshold
+        self._flag = flag or f"have_{disease}"
+        self._percentage = percentage or f"{disease}_percentage"
+        intercept = float(weights[0])
+        coef = weights[1:]
+        if mean is not None or scale is not None:
+            # (x - mean) / scale 的線性組合展開成 x 的係數與新的截距
+            mean = np.zeros(len(features)) if mean is None else np.asarray(mean, dtype=np.float64)
+            scale = np.ones(len(features)) if scale is None else np.asarray(scale, dtype=np.float64)
+            coef = np.asarray(coef, dtype=np.float64) / scale
+            intercept -= float(np.dot(coef, mean))
+        # 批次計算用 numpy (沒有標準化時直接使用 memory map 的內容)，單筆計算用 Python float 較快
+        self._coef = coef
+        self._intercept = intercept
+        self._coef_list = [float(value) for value in coef]
+
+    @property
+    def disease(self) -> str:
+        return self._disease
+
+    @property
+    def features(self) -> tuple[str, ...]:
+        return self._features
+
+    def predict(self, features: dict[str, Any]) -> dict[str, Any]:
+        z = self._intercept
+        for name, weight in zip(self._features, self._coef_list):
+            z += weight * float(features[name])
+        # 數值穩定的 sigmoid
+        probability = 1 / (1 + math.exp(-z)) if z >= 0 else math.exp(z) / (1 + math.exp(z))
+        return self._result(probability)
+
+    def probabilities(self, matrix):
+        '''
+        matrix 為 (筆數, 特徵數) 的陣列，欄位順序與 features 相同，回傳每一筆的患病機率 (0~1)
+        '''
+        import numpy as np
+
+        z = np.asarray(matrix, dtype=np.float64) @ self._coef + self._intercept
+        return np.exp(-np.logaddexp(0, -z))
+
+    def predict_many(self, rows: Sequence[dict[str, Any]]) -> list[dict[str, Any]]:
+        '''
+        一次計算多筆，整批只做一次矩陣乘法
+        '''
+        import numpy as np
+
+        if not rows:
+            return []
+        # 逐欄建立矩陣比逐筆建立 list 再轉換快
+        matrix = np.empty((len(rows), len(self._features)), dtype=np.float64)
+        for column, name in enumerate(self._features):
+            matrix[:, column] = np.fromiter((row[name] for row in rows), dtype=np.float64, count=len(rows))
+        probabilities = self.probabilities(matrix)
+        flags = (probabilities >= self._threshold).tolist()
+        percentages = np.round(probabilities * 100, 2).tolist()
+        return [{self._flag: flag, self._percentage: percentage} for flag, percentage in zip(flags, percentages)]
+
+    def _result(self, probability: float) -> dict[str, Any]:
+        return {self._flag: probability >= self._threshold, self._percentage: round(probability * 100, 2)}
+
+    @classmethod
+    def load(cls, path: str) -> "LogisticModel":
+        import numpy as np
+
+        with open(path, encoding="utf-8") as f:
+            description = json.load(f)
+        if description.get("type", cls.TYPE) != cls.TYPE:
+            raise ValueError(f"Unsupported model type: {description.get('type')}")
+        disease = description.get("disease") or os.path.splitext(os.path.basename(path))[0]
+        weights_path = os.path.join(os.path.dirname(path), description.get("weights", f"{disease}.npy"))
+        weights = np.load(weights_path, mmap_mode="r")
+        if weights.ndim != 1 or weights.dtype != np.float64:
+            raise ValueError(f"{weights_path} must be a 1-D float64 array")
+        return cls(disease, description["features"], weights, threshold=description.get("threshold", 0.5),
+                   flag=description.get("flag"), percentage=description.get("percentage"),
+                   mean=description.get("mean"), scale=description.get("scale"))
+
+
+def save_logistic_model(directory: str, disease: str, features: Sequence[str], intercept: float, coef: Sequence[float],
+                        threshold: float = 0.5, mean: Sequence[float] | None = None, scale: Sequence[float] | None = None,
+                        flag: str | None = None, percentage: str | None = None) -> str:
+    '''
+    把訓練好的模型 (例如 sklearn LogisticRegression 的 intercept_[0] 與 coef_[0]) 寫成 LocalPredictor 讀取的格式。
+    Return the path of the model description
+    '''
+    import numpy as np
+
+    os.makedirs(directory, exist_ok=True)
+    weights = np.concatenate([[float(intercept)], np.asarray(coef, dtype=np.float64)])
+    np.save(os.path.join(directory, f"{disease}.npy"), weights)
+    description: dict[str, Any] = {"type": LogisticModel.TYPE, "disease": disease, "features": list(features),
+                                   "weights": f"{disease}.npy", "threshold": threshold}
+    for key, value in (("mean", mean), ("scale", scale), ("flag", flag), ("percentage", percentage)):
+        if value is not None:
+            description[key] = list(value) if key in ("mean", "scale") else value
+    path = os.path.join(directory, f"{disease}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(description, f, ensure_ascii=False, indent=2)
+    return path
+
+
+class LocalPredictor(Predictor):
+    '''
+    有本地模型的疾病直接在 process 內計算，其餘疾病 (或本地計算失敗時) 交給 fallback，
+    fallback 通常為呼叫預測 API 的 predictor，為 None 時拋出 PredictionError。
+    模型在建立時一次載入。
+    '''
+    def __init__(self, model_dir: str, fallback: Predictor | None = None) -> None:
+        self._fallback = fallback
+        self._models: dict[str, LogisticModel] = {}
+        for path in sorted(glob.glob(os.path.join(model_dir, "*.json"))):
+            try:
+                model = LogisticModel.load(path)
+            except (OSError, ValueError, KeyError) as e:
+                logging.warning("Unable to load prediction model %s: %s", path, e)
+                continue
+            self._models[model.disease] = model
+        self._local = 0
+        self._fallbacks = 0
+        self._errors = 0
+        self._lock = threading.Lock()
+
+    @property
+    def diseases(self) -> list[str]:
+        return sorted(self._models)
+
+    @property
+    def fallback(self) -> Predictor | None:
+        return self._fallback
+
+    @property
+    def stats(self) -> dict[str, Any]:
+        return {
+            "models": self.diseases,
+            "local": self._local,
+            "fallback": self._fallbacks,
+            "errors": self._errors,
+        }
+
+    def predict(self, disease: str, features: dict[str, Any]) -> dict[str, Any]:
+        model = self._models.get(disease)
+        if model is not None:
+            try:
+                result = model.predict(features)
+            except (KeyError, TypeError, ValueError) as e:
+                with self._lock:
+                    self._errors += 1
+                if self._fallback is None:
+                    raise PredictionError(f"Local prediction failed: {e}")
+                logging.warning("Local %s prediction failed, using fallback: %s", disease, e)
+            else:
+                with self._lock:
+                    self._local += 1
+                return result
+        if self._fallback is None:
+            raise PredictionError(f"No local model for {disease}")
+        with self._lock:
+            self._fallbacks += 1
+        return self._fallback.predict(disease, features)
+
+    def predict_many(self, disease: str, rows: Sequence[dict[str, Any]]) -> list[dict[str, Any]]:
+        '''
+        大量計算 (例如重新計算 answer log 中的紀錄) 時使用，只支援有本地模型的疾病
+        '''
+        model = self._models.get(disease)
+        if model is None:
+            raise PredictionError(f"No local model for {disease}")
+        try:
+            results = model.predict_many(rows)
+        except (KeyError, TypeError, ValueError) as e:
+            with self._lock:
+                self._errors += 1
+            raise PredictionError(f"Local prediction failed: {e}")
+        with self._lock:
+            self._local += len(results)
+        return results
+
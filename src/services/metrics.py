@@ -0,0 +1,263 @@
+from bisect import bisect_left
+from typing import Any, Callable
+
+import math
+import threading
+
+from .prediction_client import LatencyHistogram
+
+'''
+Prometheus 文字格式的 metrics。
+每個執行緒把計數寫在自己的 shard 裡，更新時不需要任何鎖，
+/metrics 被讀取時才把所有 shard 加總。
+執行緒結束後，它的 shard 會在下一次讀取時併入 retired shard。
+'''
+
+
+class _Shard(object):
+    __slots__ = ("counters", "histograms")
+
+    def __init__(self) -> None:
+        # (metric 名稱, label 值) -> 次數
+        self.counters: dict[tuple[str, tuple], float] = {}
+        # (metric 名稱, label 值) -> [每個 bucket 的次數..., 總和]
+        self.histograms: dict[tuple[str, tuple], list[float]] = {}
+
+    def merge(self, other: "_Shard") -> None:
+        for key, value in list(other.counters.items()):
+            self.counters[key] = self.counters.get(key, 0) + value
+        for key, values in list(other.histograms.items()):
+            merged = self.histograms.get(key)
+            if merged is None:
+                self.histograms[key] = list(values)
+            else:
+                for i, value in enumerate(values):
+                    merged[i] += value
+
+
+class Counter(object):
+    def __init__(self, registry: "MetricsRegistry", name: str, labels: tuple[str, ...]) -> None:
+        self._registry = registry
+        self._name = name
+        self._labels = labels
+
+    def inc(self, *label_values: Any, amount: float = 1) -> None:
+        counters = self._registry._shard().counters
+        key = (self._name, label_values)
+        counters[key] = counters.get(key, 0) + amount
+
+
+class Histogram(object):
+    DEFAULT_BUCKETS = LatencyHistogram.DEFAULT_BUCKETS
+
+    def __init__(self, registry: "MetricsRegistry", name: str, labels: tuple[str, ...], buckets: tuple[float, ...]) -> None:
+        self._registry = registry
+        self._name = name
+        self._labels = labels
+        self._buckets = tuple(sorted(buckets))
+        self._listener: Callable[..., None] | None = None
+
+    @property
+    def buckets(self) -> tuple[float, ...]:
+        return self._buckets
+
+    def set_listener(self, listener: Callable[..., None] | None) -> None:
+        '''
+        每次 observe 之後以相同的參數呼叫 listener (例如把階段耗時記到正在追蹤的事件上)
+        '''
+        self._listener = listener
+
+    def observe(self, value: float, *label_values: Any) -> None:
+        histograms = self._registry._shard().histograms
+        key = (self._name, label_values)
+        values = histograms.get(key)
+        if values is None:
+            # 每個 bucket 一格、超過最大 bucket 一格、總和一格
+            values = histograms[key] = [0] * (len(self._buckets) + 2)
+        values[bisect_left(self._buckets, value)] += 1
+        values[-1] += value
+        if self._listener is not None:
+            self._listener(value, *label_values)
+
+
+class MetricsRegistry(object):
+    '''
+    counter 與 histogram 以 per-thread shard 累計；
+    其他元件既有的 stats dict 與 LatencyHistogram 可以登記進來，讀取時一併輸出
+    '''
+    def __init__(self) -> None:
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards: list[tuple[threading.Thread, _Shard]] = []
+        self._retired = _Shard()
+        self._metrics: dict[str, tuple[str, str, Any]] = {}
+        self._stats: dict[str, tuple[str, Callable[[], dict[str, Any]]]] = {}
+        self._histograms: dict[str, tuple[str, LatencyHistogram]] = {}
+        self._gauges: dict[str, tuple[str, Callable[[], float]]] = {}
+
+    def _shard(self) -> _Shard:
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = _Shard()
+            with self._lock:
+                self._shards.append((threading.current_thread(), shard))
+            return shard
+
+    def counter(self, name: str, help: str, labels: tuple[str, ...] = ()) -> Counter:
+        with self._lock:
+            if name in self._metrics:
+                return self._metrics[name][2]
+            metric = Counter(self, name, labels)
+            self._metrics[name] = ("counter", help, metric)
+            return metric
+
+    def histogram(self, name: str, help: str, labels: tuple[str, ...] = (),
+                  buckets: tuple[float, ...] = Histogram.DEFAULT_BUCKETS) -> Histogram:
+        with self._lock:
+            if name in self._metrics:
+                return self._metrics[name][2]
+            metric = Histogram(self, name, labels, buckets)
+            self._metrics[name] = ("histogram", help, metric)
+            return metric
+
+    def gauge(self, name: str, help: str, read: Callable[[], float]) -> None:
+        '''
+        讀取 /metrics 時才呼叫 read 取得目前的值
+        '''
+        with self._lock:
+            self._gauges[name] = (help, read)
+
+    def register_stats(self, prefix: str, help: str, read: Callable[[], dict[str, Any]]) -> None:
+        '''
+        把元件的 stats dict 以 prefix_<key> 輸出。
+        數值直接輸出，dict 以 key label 展開，字串以 value label 輸出 1，list 輸出長度
+        '''
+        with self._lock:
+            self._stats[prefix] = (help, read)
+
+    def register_histogram(self, name: str, help: str, histogram: LatencyHistogram) -> None:
+        with self._lock:
+            self._histograms[name] = (help, histogram)
+
+    def snapshot(self) -> _Shard:
+        '''
+        Return the sum of every thread's shard
+        '''
+        total = _Shard()
+        with self._lock:
+            alive = []
+            for thread, shard in self._shards:
+                if thread.is_alive():
+                    alive.append((thread, shard))
+                else:
+                    self._retired.merge(shard)
+            self._shards = alive
+            total.merge(self._retired)
+            shards = [shard for _, shard in alive]
+        for shard in shards:
+            total.merge(shard)
+        return total
+
+    def render(self) -> str:
+        snapshot = self.snapshot()
+        lines: list[str] = []
+        with self._lock:
+            metrics = list(self._metrics.items())
+            gauges = list(self._gauges.items())
+            stats = list(self._stats.items())
+            histograms = list(self._histograms.items())
+
+        for name, (kind, help, metric) in metrics:
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "counter":
+                for (sample_name, label_values), value in sorted(snapshot.counters.items(), key=_sort_key):
+                    if sample_name == name:
+                        lines.append(f"{name}{_labels(metric._labels, label_values)} {_number(value)}")
+            else:
+                for (sample_name, label_values), values in sorted(snapshot.histograms.items(), key=_sort_key):
+                    if sample_name == name:
+                        _render_histogram(lines, name, metric.buckets, values[:-1], values[-1],
+                                          metric._labels, label_values)
+
+        for name, (help, histogram) in histograms:
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} histogram")
+            _render_histogram(lines, name, histogram.buckets, histogram.counts, histogram.sum, (), ())
+
+        for name, (help, read) in gauges:
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {_number(read())}")
+
+        for prefix, (help, read) in stats:
+            for key, value in read().items():
+                name = f"{prefix}_{key}"
+                lines.append(f"# HELP {name} {help} ({key})")
+                lines.append(f"# TYPE {name} gauge")
+                if isinstance(value, bool):
+                    lines.append(f"{name} {int(value)}")
+                elif isinstance(value, (int, float)):
+                    lines.append(f"{name} {_number(value)}")
+                elif isinstance(value, dict):
+                    for label, item in sorted(value.items()):
+                        lines.append(f"{name}{_labels(('key',), (label,))} {_number(item)}")
+                elif isinstance(value, str):
+                    lines.append(f"{name}{_labels(('value',), (value,))} 1")
+                elif isinstance(value, (list, tuple, set)):
+                    lines.append(f"{name} {len(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def _sort_key(item) -> tuple:
+    return item[0][0], tuple(map(str, item[0][1]))
+
+
+def _number(value: float) -> str:
+    if isinstance(value, float):
+        if math.isinf(value):
+            return "+Inf" if value > 0 else "-Inf"
+        if math.isnan(value):
+            return "NaN"
+        return repr(value)
+    return str(value)
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _render_histogram(lines: list[str], name: str, buckets: tuple[float, ...], counts: list[float], total: float,
+                      label_names: tuple[str, ...], label_values: tuple) -> None:
+    cumulative = 0
+    for bound, count in zip(buckets, counts):
+        cumulative += count
+        le = 'le="' + _number(float(bound)) + '"'
+        lines.append(f"{name}_bucket{_labels(label_names, label_values, le)} {_number(cumulative)}")
+    cumulative += counts[len(buckets)]
+    le = 'le="+Inf"'
+    lines.append(f"{name}_bucket{_labels(label_names, label_values, le)} {_number(cumulative)}")
+    lines.append(f"{name}_sum{_labels(label_names, label_values)} {_number(total)}")
+    lines.append(f"{name}_count{_labels(label_names, label_values)} {_number(cumulative)}")
+
+
+metrics_registry = MetricsRegistry()
+
+stage_seconds = metrics_registry.histogram("linebot_stage_seconds", "Time spent in each stage of handling a webhook event",
+                                           labels=("stage",))
+session_timeouts = metrics_registry.counter("linebot_session_timeouts_total", "Sessions reset because the user answered too late")
+invalid_answers = metrics_registry.counter("linebot_invalid_answers_total", "Answers rejected by question validation",
+                                           labels=("flow", "question"))
+duplicate_events = metrics_registry.counter("linebot_duplicate_events_total", "Redelivered webhook events skipped by event ID")
+failed_events = metrics_registry.counter("linebot_failed_events_total", "Webhook events whose handling or reply failed",
+                                         labels=("kind",))
+flow_completions = metrics_registry.counter("linebot_flow_completions_total", "Question sets finished, by transition action",
+                                            labels=("flow", "action"))
@@ -0,0 +1,141 @@
+from typing import Any, Sequence
+
+from linebot import LineBotApi
+from linebot.exceptions import LineBotApiError
+from linebot.models import SendMessage
+
+import logging
+import threading
+import uuid
+
+import requests
+
+from .rate_limiter import TokenBucket
+
+
+class MulticastSender(object):
+    '''
+    以 LINE multicast API 把同樣的訊息送給多位使用者，每次呼叫最多 batch_size 位 (LINE 的上限為 500)。
+    每次呼叫前先從 budget 取得 token，超過速率預算時等待而不是丟棄；
+    429、5xx 與連線錯誤時依 Retry-After (沒有時以指數退避) 重試，最多 max_retries 次。
+    同一批的重試帶相同的 X-Line-Retry-Key，LINE 已受理過的批次回應 409，不會重複送出。
+
+    SDK 會把 retry key 留在 LineBotApi.headers 中，之後的每個請求都會帶上，
+    因此 line_bot_api 必須是專用的 instance，且只由一個執行緒使用。
+    close 之後，等待中與之後的批次都會放棄並計為失敗。
+    '''
+    MAX_RECIPIENTS = 500
+    RETRY_KEY_HEADER = "X-Line-Retry-Key"
+
+    def __init__(self, line_bot_api: LineBotApi, budget: TokenBucket, batch_size: int = MAX_RECIPIENTS,
+                 max_retries: int = 5, backoff: float = 1, max_backoff: float = 60) -> None:
+        self._line_bot_api = line_bot_api
+        self._budget = budget
+        self._batch_size = max(1, min(batch_size, self.MAX_RECIPIENTS))
+        self._max_retries = max_retries
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._closed = threading.Event()
+        self._lock = threading.Lock()
+
+        self._calls = 0
+        self._batches = 0
+        self._sent = 0
+        self._failed = 0
+        self._retries = 0
+        self._rate_limited = 0
+        self._budget_wait = 0.0
+
+    @property
+    def batch_size(self) -> int:
+        return self._batch_size
+
+    @property
+    def stats(self) -> dict[str, Any]:
+        return {
+            "calls": self._calls,
+            "batches": self._batches,
+            "sent": self._sent,
+            "failed": self._failed,
+            "retries": self._retries,
+            "rate_limited": self._rate_limited,
+            "budget_wait_seconds": round(self._budget_wait, 3),
+        }
+
+    def send(self, user_ids: Sequence[str], messages: list[SendMessage]) -> tuple[int, int]:
+        '''
+        Return (number of users sent to, number of users that failed)
+        '''
+        sent = failed = 0
+        for i in range(0, len(user_ids), self._batch_size):
+            batch = list(user_ids[i:i + self._batch_size])
+            if self._send_batch(batch, messages):
+                sent += len(batch)
+            else:
+                failed += len(batch)
+        with self._lock:
+            self._sent += sent
+            self._failed += failed
+        return sent, failed
+
+    def close(self) -> None:
+        self._closed.set()
+
+    def _send_batch(self, user_ids: list[str], messages: list[SendMessage]) -> bool:
+        retry_key = str(uuid.uuid4())
+        with self._lock:
+            self._batches += 1
+        for attempt in range(self._max_retries + 1):
+            if self._closed.is_set() or not self._acquire():
+                return False
+            with self._lock:
+                self._calls += 1
+            try:
+                self._line_bot_api.multicast(user_ids, messages, retry_key=retry_key)
+                return True
+            except LineBotApiError as e:
+                if e.status_code == 409 and e.accepted_request_id:
+                    # 先前逾時的嘗試其實已被受理
+                    return True
+                if e.status_code != 429 and e.status_code < 500:
+                    logging.warning("Multicast to %d users rejected: %s", len(user_ids), e)
+                    return False
+                if e.status_code == 429:
+                    with self._lock:
+                        self._rate_limited += 1
+                delay = self._retry_after(e.headers)
+            except requests.RequestException as e:
+                logging.warning("Multicast to %d users failed: %s", len(user_ids), e)
+                delay = None
+            finally:
+                self._line_bot_api.headers.pop(self.RETRY_KEY_HEADER, None)
+            if attempt == self._max_retries:
+                break
+            with self._lock:
+                self._retries += 1
+            if self._closed.wait(delay if delay is not None else min(self._max_backoff, self._backoff * 2 ** attempt)):
+                return False
+        logging.warning("Multicast to %d users failed after %d retries", len(user_ids), self._max_retries)
+        return False
+
+    def _acquire(self) -> bool:
+        '''
+        等到速率預算中有 token，Return False if asked to stop while waiting
+        '''
+        while not self._budget.allow():
+            seconds = self._budget.wait_time()
+            with self._lock:
+                self._budget_wait += seconds
+            if self._closed.wait(seconds):
+                return False
+        return True
+
+    @staticmethod
+    def _retry_after(headers: dict[str, str] | None) -> float | None:
+        for key, value in (headers or {}).items():
+            if key.lower() == "retry-after":
+                try:
+                    return max(0.0, float(value))
+                except ValueError:
+                    return None
+        return None
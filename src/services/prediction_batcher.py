@@ -0,0 +1,145 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any
+
+import threading
+import time
+
+from .prediction_client import Predictor, PredictionClient, PredictionError
+
+
+class BatchingPredictor(Predictor):
+    '''
+    把短時間內的多筆預測合併成一次批次請求。
+    每種疾病各自累積，滿 max_batch_size 筆或第一筆等待超過 window 秒就送出。
+    批次請求送到 /predict/{disease}/batch，內容為欄位導向格式:
+        {"columns": ["gender", "age", ...], "data": {"gender": [0, 1], "age": [40, 52], ...}}
+    可直接以 pandas.DataFrame(payload["data"]) 讀取。
+    回應可為 {"results": [{...}, {...}]}，或同樣欄位導向的 {"have_diabetes": [...], ...}。
+    後端不支援批次 (404/405) 時，該疾病改回逐筆呼叫。
+    '''
+    _FALLBACK = object()
+
+    def __init__(self, client: PredictionClient, max_batch_size: int = 32, window: float = 0.005, flush_workers: int = 4) -> None:
+        self._client = client
+        self._max_batch_size = max_batch_size
+        self._window = window
+        self._pending: dict[str, list[tuple[dict[str, Any], Future]]] = {}
+        self._first_at: dict[str, float] = {}
+        self._unsupported: set[str] = set()
+        self._condition = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=flush_workers, thread_name_prefix="prediction-batch")
+        self._thread: threading.Thread | None = None
+
+        self._batches = 0
+        self._batched_rows = 0
+        self._fallback_rows = 0
+
+    @property
+    def stats(self) -> dict[str, Any]:
+        return {
+            "batches": self._batches,
+            "batched_rows": self._batched_rows,
+            "fallback_rows": self._fallback_rows,
+            "unsupported": sorted(self._unsupported),
+        }
+
+    def predict(self, disease: str, features: dict[str, Any]) -> dict[str, Any]:
+        if disease in self._unsupported:
+            with self._condition:
+                self._fallback_rows += 1
+            return self._client.predict(disease, features)
+
+        future: Future = Future()
+        with self._condition:
+            if self._thread is None:
+                # 與 EventDispatcher 相同，執行緒在 gunicorn fork 之後才建立
+                self._thread = threading.Thread(target=self._run, name="prediction-batcher", daemon=True)
+                self._thread.start()
+            rows = self._pending.setdefault(disease, [])
+            if not rows:
+                self._first_at[disease] = time.monotonic()
+            rows.append((features, future))
+            if len(rows) >= self._max_batch_size or len(rows) == 1:
+                self._condition.notify()
+
+        result = future.result()
+        if result is self._FALLBACK:
+            with self._condition:
+                self._fallback_rows += 1
+            return self._client.predict(disease, features)
+        return result
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                batches = self._take_ready(time.monotonic())
+                while not batches:
+                    if self._first_at:
+                        timeout = min(self._first_at.values()) + self._window - time.monotonic()
+                        self._condition.wait(max(timeout, 0))
+                    else:
+                        self._condition.wait()
+                    batches = self._take_ready(time.monotonic())
+            for disease, rows in batches:
+                self._executor.submit(self._flush, disease, rows)
+
+    def _take_ready(self, now: float) -> list[tuple[str, list[tuple[dict[str, Any], Future]]]]:
+        ready = []
+        for disease, rows in list(self._pending.items()):
+            if len(rows) >= self._max_batch_size or now - self._first_at[disease] >= self._window:
+                ready.append((disease, rows[:self._max_batch_size]))
+                rest = rows[self._max_batch_size:]
+                if rest:
+                    self._pending[disease] = rest
+                    self._first_at[disease] = now
+                else:
+                    del self._pending[disease]
+                    del self._first_at[disease]
+        return ready
+
+    def _flush(self, disease: str, rows: list[tuple[dict[str, Any], Future]]) -> None:
+        if len(rows) == 1 or disease in self._unsupported:
+            # 單筆不需要批次格式，交回呼叫者自行逐筆呼叫
+            for _, future in rows:
+                future.set_result(self._FALLBACK)
+            return
+
+        columns = list(rows[0][0].keys())
+        payload = {
+            "columns": columns,
+            "data": {column: [features.get(column) for features, _ in rows] for column in columns},
+        }
+        try:
+            response = self._client.post(f"/predict/{disease}/batch", payload)
+            results = self._split(response, len(rows))
+        except PredictionError as e:
+            if e.status_code in (404, 405):
+                self._unsupported.add(disease)
+                for _, future in rows:
+                    future.set_result(self._FALLBACK)
+                return
+            for _, future in rows:
+                future.set_exception(e)
+            return
+        except Exception as e:
+            for _, future in rows:
+                future.set_exception(PredictionError(f"Batch prediction failed: {e}"))
+            return
+
+        with self._condition:
+            self._batches += 1
+            self._batched_rows += len(rows)
+        for (_, future), result in zip(rows, results):
+            future.set_result(result)
+
+    @staticmethod
+    def _split(response: Any, size: int) -> list[dict[str, Any]]:
+        if isinstance(response, dict) and isinstance(response.get("results"), list):
+            results = response["results"]
+        elif isinstance(response, dict) and all(isinstance(values, list) and len(values) == size for values in response.values()):
+            results = [{key: values[i] for key, values in response.items()} for i in range(size)]
+        else:
+            raise PredictionError("Unexpected batch prediction response")
+        if len(results) != size:
+            raise PredictionError("Batch prediction returned a different number of results")
+        return results
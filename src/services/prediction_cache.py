@@ -0,0 +1,126 @@
+from collections import OrderedDict
+from typing import Any, Callable
+
+import json
+import threading
+import time
+
+from .prediction_client import Predictor
+
+
+class _Flight(object):
+    '''
+    正在進行中的預測請求，相同請求的其他呼叫者會等待它的結果
+    '''
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result: dict[str, Any] | None = None
+        self.error: BaseException | None = None
+
+
+class CachingPredictor(Predictor):
+    '''
+    以正規化後的回答作為 key 快取預測結果。
+    超過 ttl 秒的結果視為失效，數量超過 max_size 時移除最久未使用的結果。
+    single_flight 開啟時，相同的請求同時進來只會呼叫一次後端。
+    只有成功的結果會被快取；有 validate 時，validate(disease, result) 回傳 False 的結果
+    (例如缺少結果欄位、無法格式化的 2xx 回應) 照樣回傳給呼叫者，但不會被快取。
+    '''
+    def __init__(self, predictor: Predictor, max_size: int = 10000, ttl: float = 3600, single_flight: bool = True,
+                 validate: Callable[[str, dict[str, Any]], bool] | None = None) -> None:
+        self._predictor = predictor
+        self._validate = validate
+        self._max_size = max_size
+        self._ttl = ttl
+        self._single_flight = single_flight
+        self._entries: OrderedDict[str, tuple[float, dict[str, Any]]] = OrderedDict()
+        self._flights: dict[str, _Flight] = {}
+        self._lock = threading.Lock()
+
+        self._hits = 0
+        self._misses = 0
+        self._coalesced = 0
+        self._evictions = 0
+        self._rejected = 0
+
+    @property
+    def predictor(self) -> Predictor:
+        return self._predictor
+
+    @property
+    def stats(self) -> dict[str, int]:
+        return {
+            "size": len(self._entries),
+            "hits": self._hits,
+            "misses": self._misses,
+            "coalesced": self._coalesced,
+            "evictions": self._evictions,
+            "rejected": self._rejected,
+        }
+
+    @staticmethod
+    def make_key(disease: str, features: dict[str, Any]) -> str:
+        # 40 與 40.0 視為相同的回答
+        normalized = {key: float(value) if isinstance(value, (int, float)) and not isinstance(value, bool) else value
+                      for key, value in features.items()}
+        return disease + ":" + json.dumps(normalized, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+
+    def predict(self, disease: str, features: dict[str, Any]) -> dict[str, Any]:
+        key = self.make_key(disease, features)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(key)
+                    self._hits += 1
+                    return dict(entry[1])
+                del self._entries[key]
+            self._misses += 1
+            flight = self._flights.get(key) if self._single_flight else None
+            if flight is not None:
+                self._coalesced += 1
+                leader = False
+            else:
+                flight = _Flight()
+                leader = True
+                if self._single_flight:
+                    self._flights[key] = flight
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return dict(flight.result)
+
+        try:
+            flight.result = self._predictor.predict(disease, features)
+        except BaseException as e:
+            flight.error = e
+            raise
+        else:
+            if self._validate is None or self._validate(disease, flight.result):
+                self._store(key, flight.result)
+            else:
+                with self._lock:
+                    self._rejected += 1
+            return dict(flight.result)
+        finally:
+            if self._single_flight:
+                with self._lock:
+                    self._flights.pop(key, None)
+            flight.done.set()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def _store(self, key: str, result: dict[str, Any]) -> None:
+        if self._max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self._ttl, result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+                self._evictions += 1
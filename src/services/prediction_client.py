@@ -0,0 +1,247 @@
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from typing import Any
+
+import logging
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class PredictionError(Exception):
+    def __init__(self, message: str, status_code: int | None = None) -> None:
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class CircuitOpenError(PredictionError):
+    pass
+
+
+class Predictor(ABC):
+    '''
+    疾病預測的介面，disease 為 API 路徑 /predict/{disease} 中的疾病名稱，
+    features 為問題集的回答，回傳預測 API 的回應內容。
+    失敗時一律拋出 PredictionError。
+    '''
+    @abstractmethod
+    def predict(self, disease: str, features: dict[str, Any]) -> dict[str, Any]:
+        pass
+
+
+class LatencyHistogram(object):
+    '''
+    固定 bucket 的延遲直方圖 (單位: 秒)
+    '''
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        self._buckets = tuple(sorted(buckets))
+        self._counts = [0] * (len(self._buckets) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float) -> None:
+        index = bisect_left(self._buckets, seconds)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += seconds
+
+    @property
+    def buckets(self) -> tuple[float, ...]:
+        return self._buckets
+
+    @property
+    def counts(self) -> list[int]:
+        '''
+        每個 bucket 的次數 (非累加)，最後一個為超過最大 bucket 的次數
+        '''
+        with self._lock:
+            return list(self._counts)
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    @property
+    def sum(self) -> float:
+        return self._sum
+
+
+class CircuitBreaker(object):
+    '''
+    連續失敗 failure_threshold 次後進入 open 狀態，直接拒絕呼叫；
+    經過 reset_timeout 秒後進入 half-open，只放行一次嘗試，成功才恢復 closed。
+    '''
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30) -> None:
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._failures = 0
+        self._state = self.CLOSED
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        return self._state
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.OPEN and time.monotonic() - self._opened_at >= self._reset_timeout:
+                self._state = self.HALF_OPEN
+                return True
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._state = self.CLOSED
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._state == self.HALF_OPEN or self._failures >= self._failure_threshold:
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+
+
+class PredictionClient(Predictor):
+    '''
+    呼叫遠端預測 API 的 client。
+    使用共用的 requests.Session 保持連線，並限制連線與讀取時間；
+    連線錯誤 (包含回應中途斷線)、逾時與 5xx 會以指數退避加上隨機抖動重試，
+    連續失敗過多時由 circuit breaker 直接拒絕，避免拖住 worker。
+    '''
+    def __init__(self, base_url: str, connect_timeout: float = 2, read_timeout: float = 10, retries: int = 2,
+                 backoff: float = 0.2, pool_size: int = 10, breaker: CircuitBreaker | None = None) -> None:
+        self._base_url = base_url.removesuffix("/")
+        self._timeout = (connect_timeout, read_timeout)
+        self._retries = retries
+        self._backoff = backoff
+        self._breaker = breaker if breaker is not None else CircuitBreaker()
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        self._session.headers.update({'Content-type': 'application/json'})
+
+        self._latency = LatencyHistogram()
+        self._errors: dict[str, int] = {}
+        self._requests = 0
+        self._lock = threading.Lock()
+
+    @property
+    def base_url(self) -> str:
+        return self._base_url
+
+    @property
+    def breaker(self) -> CircuitBreaker:
+        return self._breaker
+
+    @property
+    def latency(self) -> LatencyHistogram:
+        return self._latency
+
+    @property
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            errors = dict(self._errors)
+        return {
+            "requests": self._requests,
+            "errors": errors,
+            "circuit_state": self._breaker.state,
+            "latency_count": self._latency.count,
+            "latency_sum_seconds": self._latency.sum,
+        }
+
+    def predict(self, disease: str, features: dict[str, Any]) -> dict[str, Any]:
+        return self.post(f"/predict/{disease}", features)
+
+    def post(self, path: str, payload: Any) -> Any:
+        if not self._breaker.allow():
+            self._count_error("circuit_open")
+            raise CircuitOpenError("Prediction backend is unavailable")
+
+        # allow() 放行的每個呼叫都必須記錄成功或失敗，
+        # 否則 half-open 時唯一的試探以其他錯誤結束，breaker 會一直停在 half-open
+        healthy = False
+        try:
+            response = self._send(self._base_url + path, payload)
+            # 後端有回應 (包含 4xx 與不是 JSON 的內容) 就不是後端故障
+            healthy = True
+            return self._parse(response)
+        finally:
+            if healthy:
+                self._breaker.record_success()
+            else:
+                self._breaker.record_failure()
+
+    def _send(self, url: str, payload: Any) -> requests.Response:
+        '''
+        Return the first response below 500, retrying on connection errors, timeouts and 5xx
+        '''
+        for attempt in range(self._retries + 1):
+            start = time.perf_counter()
+            try:
+                response = self._session.post(url, json=payload, timeout=self._timeout)
+            except requests.Timeout as e:
+                error = ("timeout", e)
+            except requests.ConnectionError as e:
+                error = ("connection", e)
+            except requests.RequestException as e:
+                # 例如回應內容在 Content-Length 之前就斷線 (ChunkedEncodingError)
+                error = ("request_error", e)
+            else:
+                if response.status_code < 500:
+                    self._latency.observe(time.perf_counter() - start)
+                    with self._lock:
+                        self._requests += 1
+                    return response
+                error = ("http_5xx", requests.HTTPError(f"{response.status_code} from {url}", response=response))
+            self._latency.observe(time.perf_counter() - start)
+            with self._lock:
+                self._requests += 1
+            self._count_error(error[0])
+            if attempt < self._retries:
+                time.sleep(random.uniform(0, self._backoff * 2 ** attempt))
+
+        raise PredictionError(f"Prediction request failed: {error[1]}") from error[1]
+
+    def warm_up(self) -> bool:
+        '''
+        先對預測 API 發出一個請求，讓連線留在連線池中。
+        Return True if the backend answered with any status
+        '''
+        try:
+            self._session.head(self._base_url + "/", timeout=self._timeout)
+            return True
+        except requests.RequestException as e:
+            logging.warning("Unable to warm up prediction API connection: %s", e)
+            return False
+
+    def close(self) -> None:
+        self._session.close()
+
+    def _parse(self, response: requests.Response) -> Any:
+        # 4xx 代表請求內容有誤，不是後端故障，不計入 circuit breaker
+        if response.status_code >= 400:
+            self._count_error("http_4xx")
+            raise PredictionError(f"{response.status_code} from {response.url}", status_code=response.status_code)
+        try:
+            return response.json()
+        except ValueError as e:
+            self._count_error("invalid_response")
+            raise PredictionError("Prediction response is not JSON") from e
+
+    def _count_error(self, kind: str) -> None:
+        with self._lock:
+            self._errors[kind] = self._errors.get(kind, 0) + 1
@@ -0,0 +1,85 @@
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Any, Callable
+
+import logging
+import threading
+import time
+
+from .prediction_client import Predictor
+
+
+class PredictionFanout(object):
+    '''
+    同時呼叫多種疾病的預測，每個呼叫各有自己的期限 (秒，從呼叫 predict_all 開始計算)。
+    總等待時間為最晚到期或最慢完成的那一個，而不是每個呼叫的時間相加；
+    逾期或失敗的疾病結果為 None，仍在進行中的呼叫會在背景執行完畢後丟棄。
+    predictor 可為 Predictor 或回傳 Predictor 的函數 (第一次呼叫時才建立)。
+    '''
+    def __init__(self, predictor: Predictor | Callable[[], Predictor], max_workers: int = 8,
+                 default_deadline: float = 5) -> None:
+        self._predictor = predictor
+        self._default_deadline = default_deadline
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prediction-fanout")
+        self._lock = threading.Lock()
+
+        self._requests = 0
+        self._completed = 0
+        self._timed_out = 0
+        self._failed = 0
+
+    @property
+    def default_deadline(self) -> float:
+        return self._default_deadline
+
+    @property
+    def stats(self) -> dict[str, int]:
+        return {
+            "requests": self._requests,
+            "completed": self._completed,
+            "timed_out": self._timed_out,
+            "failed": self._failed,
+        }
+
+    def _resolve(self) -> Predictor:
+        if not isinstance(self._predictor, Predictor):
+            self._predictor = self._predictor()
+        return self._predictor
+
+    def predict_all(self, calls: list[tuple[str, dict[str, Any], float | None]]) -> dict[str, dict[str, Any] | None]:
+        '''
+        calls: (疾病, features, 期限) 的串列，期限為 None 時使用 default_deadline
+        Return the response of each disease, None if it failed or missed its deadline
+        '''
+        predictor = self._resolve()
+        start = time.monotonic()
+        pending = []
+        for disease, features, deadline in calls:
+            future = self._executor.submit(predictor.predict, disease, features)
+            pending.append((start + (self._default_deadline if deadline is None else deadline), disease, future))
+
+        results: dict[str, dict[str, Any] | None] = {}
+        completed = timed_out = failed = 0
+        # 依期限先後等待，等待前一個的時間也算在後面的期限之內
+        for expires_at, disease, future in sorted(pending, key=lambda item: item[0]):
+            try:
+                results[disease] = future.result(timeout=max(0.0, expires_at - time.monotonic()))
+                completed += 1
+            except FutureTimeoutError:
+                # 還在佇列中的呼叫直接取消，已開始的呼叫無法中斷
+                future.cancel()
+                results[disease] = None
+                timed_out += 1
+                logging.warning("Prediction for %s missed its deadline", disease)
+            except Exception as e:
+                results[disease] = None
+                failed += 1
+                logging.warning("Prediction for %s failed: %s", disease, e)
+        with self._lock:
+            self._requests += 1
+            self._completed += completed
+            self._timed_out += timed_out
+            self._failed += failed
+        return {disease: results[disease] for _, disease, _ in pending}
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
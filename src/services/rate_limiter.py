@@ -0,0 +1,229 @@
+from collections import OrderedDict
+from typing import Any, Callable
+
+import heapq
+import logging
+import threading
+import time
+
+
+class TokenBucket(object):
+    '''
+    每秒補充 rate 個 token，最多累積 burst 個，每個事件消耗一個
+    '''
+    def __init__(self, rate: float, burst: float) -> None:
+        if rate <= 0 or burst < 1:
+            raise ValueError("rate must be positive and burst at least 1")
+        self._rate = rate
+        self._burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def allow(self, now: float | None = None) -> bool:
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._tokens = min(self._burst, self._tokens + (now - self._updated) * self._rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            return False
+
+    def wait_time(self, now: float | None = None) -> float:
+        '''
+        Return the seconds until one token is available
+        '''
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            tokens = min(self._burst, self._tokens + (now - self._updated) * self._rate)
+            return max(0.0, (1 - tokens) / self._rate)
+
+
+class KeyedRateLimiter(object):
+    '''
+    每個 key (user_id) 各自一個 token bucket，每個 key 只佔用 [tokens, 更新時間] 兩個數字。
+    閒置超過 idle_timeout 秒的 key 會被移除，
+    idle_timeout 預設為 bucket 從空補滿所需的時間，此後移除與保留沒有差別。
+    '''
+    def __init__(self, rate: float, burst: float, idle_timeout: float | None = None) -> None:
+        if rate <= 0 or burst < 1:
+            raise ValueError("rate must be positive and burst at least 1")
+        self._rate = rate
+        self._burst = burst
+        self._idle_timeout = idle_timeout if idle_timeout is not None else burst / rate
+        # 依最後使用時間排序，最前面的 key 最久沒有使用
+        self._buckets: OrderedDict[str, list[float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def allow(self, key: str, now: float | None = None) -> bool:
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._expire(now)
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [float(self._burst), now]
+            else:
+                bucket[0] = min(self._burst, bucket[0] + (now - bucket[1]) * self._rate)
+                bucket[1] = now
+                self._buckets.move_to_end(key)
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return True
+            return False
+
+    def wait_time(self, key: str, now: float | None = None) -> float:
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                return 0.0
+            tokens = min(self._burst, bucket[0] + (now - bucket[1]) * self._rate)
+            return max(0.0, (1 - tokens) / self._rate)
+
+    def _expire(self, now: float) -> None:
+        while self._buckets:
+            key, bucket = next(iter(self._buckets.items()))
+            if now - bucket[1] < self._idle_timeout:
+                return
+            del self._buckets[key]
+
+
+class FloodControl(object):
+    '''
+    在事件交給處理函數之前，依使用者與全域的 token bucket 決定是否處理。
+    drop: 超過限制的事件直接丟棄
+    coalesce: 每位使用者只保留最後一個超過限制的事件，
+              等該使用者 (與全域) 有 token 時由背景執行緒交給 handle 處理，較早的事件被合併掉
+    '''
+    DROP = "drop"
+    COALESCE = "coalesce"
+    POLICIES = (DROP, COALESCE)
+
+    def __init__(self, user_limiter: KeyedRateLimiter | None = None, global_limiter: TokenBucket | None = None,
+                 policy: str = DROP, handle: Callable[[str, Any], None] | None = None) -> None:
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown flood control policy: {policy}")
+        if policy == self.COALESCE and handle is None:
+            raise ValueError("coalesce policy requires handle")
+        self._user_limiter = user_limiter
+        self._global_limiter = global_limiter
+        self._policy = policy
+        self._handle = handle
+
+        self._pending: dict[str, Any] = {}
+        self._deadlines: list[tuple[float, str]] = []
+        self._condition = threading.Condition()
+        self._check_lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+
+        self._admitted = 0
+        self._limited = {"user": 0, "global": 0}
+        self._dropped = 0
+        self._coalesced = 0
+        self._deferred = 0
+
+    @property
+    def policy(self) -> str:
+        return self._policy
+
+    @property
+    def stats(self) -> dict[str, Any]:
+        with self._condition:
+            return {
+                "admitted": self._admitted,
+                "limited": dict(self._limited),
+                "dropped": self._dropped,
+                "coalesced": self._coalesced,
+                "deferred": self._deferred,
+                "pending": len(self._pending),
+                "tracked_users": len(self._user_limiter) if self._user_limiter is not None else 0,
+            }
+
+    def admit(self, key: str, event: Any) -> bool:
+        '''
+        Return True if the event should be handled now.
+        coalesce 模式下回傳 False 的事件可能稍後由 handle 處理
+        '''
+        now = time.monotonic()
+        scope = self._check(key, now)
+        with self._condition:
+            if scope is None:
+                self._admitted += 1
+                # 較早被擱置的事件已經過時，改處理這個較新的事件
+                if self._pending.pop(key, None) is not None:
+                    self._coalesced += 1
+                return True
+            self._limited[scope] += 1
+            if self._policy == self.DROP:
+                self._dropped += 1
+                return False
+            if key in self._pending:
+                self._coalesced += 1
+            else:
+                heapq.heappush(self._deadlines, (now + self._wait_time(key, now), key))
+            self._pending[key] = event
+            self._condition.notify()
+        self._start()
+        return False
+
+    def _check(self, key: str, now: float) -> str | None:
+        '''
+        Return the scope of the limit the event exceeds, or None
+        '''
+        # 兩種限制都允許時才各消耗一個 token，被全域限制擋下的事件不會用掉使用者的額度；
+        # 檢查與消耗之間不能有其他事件插入
+        with self._check_lock:
+            if self._user_limiter is not None and self._user_limiter.wait_time(key, now) > 0:
+                return "user"
+            if self._global_limiter is not None and self._global_limiter.wait_time(now) > 0:
+                return "global"
+            if self._user_limiter is not None:
+                self._user_limiter.allow(key, now)
+            if self._global_limiter is not None:
+                self._global_limiter.allow(now)
+        return None
+
+    def _wait_time(self, key: str, now: float) -> float:
+        wait = 0.0
+        if self._user_limiter is not None:
+            wait = self._user_limiter.wait_time(key, now)
+        if self._global_limiter is not None:
+            wait = max(wait, self._global_limiter.wait_time(now))
+        # 至少等一小段時間，避免 token 剛好不足時忙碌重試
+        return max(wait, 0.01)
+
+    def _start(self) -> None:
+        # 與 EventDispatcher 相同，gunicorn fork 之後第一次需要時才建立執行緒
+        with self._condition:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="flood-control", daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                while not self._deadlines or self._deadlines[0][0] > time.monotonic():
+                    timeout = self._deadlines[0][0] - time.monotonic() if self._deadlines else None
+                    self._condition.wait(timeout)
+                _, key = heapq.heappop(self._deadlines)
+                if key not in self._pending:
+                    continue
+            now = time.monotonic()
+            scope = self._check(key, now)
+            with self._condition:
+                if scope is not None:
+                    heapq.heappush(self._deadlines, (now + self._wait_time(key, now), key))
+                    continue
+                event = self._pending.pop(key, None)
+                if event is None:
+                    continue
+                self._deferred += 1
+            try:
+                self._handle(key, event)
+            except Exception:
+                logging.exception("Failed to handle deferred event")
@@ -0,0 +1,47 @@
+'''
+把 EventTracer ring buffer 中慢事件的 call stack 合併成一個 folded 檔，
+同一個 stack 的次數相加，可直接交給 flamegraph.pl、speedscope、inferno 等工具。
+
+    cd src && python -m services.trace_export /tmp/linebot-traces --min-ms 2000 > slow.folded
+    flamegraph.pl slow.folded > slow.svg
+'''
+import argparse
+import glob
+import json
+import logging
+import os
+import sys
+
+
+def merge_folded(directory: str, min_ms: float = 0) -> dict[str, int]:
+    '''
+    Return the stacks of every trace in the ring buffer slower than min_ms, summed
+    '''
+    merged: dict[str, int] = {}
+    for path in sorted(glob.glob(os.path.join(directory, "trace-*.json"))):
+        try:
+            with open(path, encoding="utf-8") as f:
+                duration = json.load(f)["duration_ms"]
+            if duration < min_ms:
+                continue
+            with open(path[:-5] + ".folded", encoding="utf-8") as f:
+                for line in f:
+                    stack, _, count = line.rstrip("\n").rpartition(" ")
+                    if stack:
+                        merged[stack] = merged.get(stack, 0) + int(count)
+        except (OSError, ValueError, KeyError):
+            logging.warning("Skipped unreadable trace %s", path)
+    return merged
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("directory", help="EventTracer 的 ring buffer 目錄")
+    parser.add_argument("--min-ms", type=float, default=0, help="只合併總耗時超過幾毫秒的事件")
+    args = parser.parse_args()
+    for stack, count in sorted(merge_folded(args.directory, args.min_ms).items()):
+        sys.stdout.write(f"{stack} {count}\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+'''
+抽樣的事件追蹤: 每個事件以 sample_rate 的機率被追蹤，
+追蹤中的事件記錄各階段 (stage_seconds 的 stage) 的開始時間與耗時，
+並由背景執行緒每 interval 秒讀取處理該事件的執行緒的 call stack。
+總耗時超過 threshold 的事件寫進 directory 中固定 ring_size 格的 ring buffer，新的覆蓋最舊的:
+    trace-0000.json    事件種類、開始時間、總耗時與各階段的 span
+    trace-0000.folded  抽樣到的 call stack，每行為 "最外層;...;最內層 次數"，
+                       可直接交給 flamegraph.pl、speedscope、inferno 等工具畫出 flame graph
+沒有被抽到的事件只多一次亂數判斷，執行緒也只有在有事件被追蹤時才會讀取 call stack。
+合併多個事件的 stack 見 services.trace_export。
+'''
+from typing import Any
+
+import glob
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+
+
+class Trace(object):
+    '''
+    一個被追蹤的事件，span 的時間為相對於事件開始的秒數
+    '''
+    __slots__ = ("kind", "started_at", "_start", "spans", "stacks", "samples", "duration")
+
+    def __init__(self, kind: str) -> None:
+        self.kind = kind
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+        self.spans: list[tuple[str, float, float]] = []
+        self.stacks: dict[str, int] = {}
+        self.samples = 0
+        self.duration = 0.0
+
+    def add_span(self, stage: str, seconds: float) -> None:
+        '''
+        記錄剛結束、耗時 seconds 秒的階段
+        '''
+        self.spans.append((stage, time.perf_counter() - seconds - self._start, seconds))
+
+    def finish(self) -> float:
+        self.duration = time.perf_counter() - self._start
+        return self.duration
+
+    def to_dict(self, interval: float) -> dict[str, Any]:
+        return {
+            "kind": self.kind,
+            "started_at": self.started_at,
+            "duration_ms": round(self.duration * 1000, 3),
+            "spans": [{"stage": stage, "start_ms": round(start * 1000, 3), "duration_ms": round(seconds * 1000, 3)}
+                      for stage, start, seconds in self.spans],
+            "samples": self.samples,
+            "sample_interval_ms": interval * 1000,
+        }
+
+
+class _NoTrace(object):
+    '''
+    沒有被抽到的事件共用的 context manager
+    '''
+    __slots__ = ()
+
+    def __enter__(self) -> None:
+        return None
+
+    def __exit__(self, *exc_info) -> None:
+        return None
+
+
+_NO_TRACE = _NoTrace()
+
+
+class _TraceScope(object):
+    __slots__ = ("_tracer", "_trace")
+
+    def __init__(self, tracer: "EventTracer", trace: Trace) -> None:
+        self._tracer = tracer
+        self._trace = trace
+
+    def __enter__(self) -> Trace:
+        self._tracer.attach(self._trace)
+        return self._trace
+
+    def __exit__(self, *exc_info) -> None:
+        self._tracer.detach()
+        self._tracer.finish(self._trace)
+
+
+class _AttachScope(object):
+    __slots__ = ("_tracer", "_trace")
+
+    def __init__(self, tracer: "EventTracer", trace: Trace) -> None:
+        self._tracer = tracer
+        self._trace = trace
+
+    def __enter__(self) -> Trace:
+        self._tracer.attach(self._trace)
+        return self._trace
+
+    def __exit__(self, *exc_info) -> None:
+        self._tracer.detach()
+
+
+class EventTracer(object):
+    '''
+    sample_rate: 被追蹤的事件比例 (0~1)，0 時完全停用
+    threshold: 總耗時超過幾秒的事件才寫進 ring buffer
+    directory: ring buffer 的目錄
+    ring_size: ring buffer 保留的事件數
+    interval: 讀取 call stack 的間隔秒數
+    同一個事件在同一個執行緒中處理時使用 event(kind)；
+    跨執行緒時 (例如 ASGI 把對話邏輯交給執行緒池) 以 start 建立，在處理的執行緒中以 attached(trace) 包住，最後呼叫 finish
+    '''
+    def __init__(self, sample_rate: float = 0, threshold: float = 1, directory: str = "", ring_size: int = 100,
+                 interval: float = 0.005) -> None:
+        self._sample_rate = sample_rate if directory else 0
+        self._threshold = threshold
+        self._directory = directory
+        self._ring_size = max(1, ring_size)
+        self._interval = interval
+        self._local = threading.local()
+        # 執行緒 ID -> 該執行緒目前處理的事件
+        self._active: dict[int, Trace] = {}
+        self._condition = threading.Condition()
+        self._thread: threading.Thread | None = None
+        self._next_slot: int | None = None
+        self._labels: dict[Any, str] = {}
+
+        self._sampled = 0
+        self._slow = 0
+        self._written = 0
+        self._write_errors = 0
+        self._samples = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self._sample_rate > 0
+
+    @property
+    def stats(self) -> dict[str, Any]:
+        return {
+            "sample_rate": self._sample_rate,
+            "sampled": self._sampled,
+            "slow": self._slow,
+            "written": self._written,
+            "write_errors": self._write_errors,
+            "stack_samples": self._samples,
+            "active": len(self._active),
+        }
+
+    def start(self, kind: str) -> Trace | None:
+        '''
+        Return a new trace if this event is sampled, otherwise None
+        '''
+        if self._sample_rate <= 0 or random.random() >= self._sample_rate:
+            return None
+        with self._condition:
+            self._sampled += 1
+        return Trace(kind)
+
+    def event(self, kind: str):
+        '''
+        with tracer.event("text"): ...
+        沒有被抽到時回傳不做任何事的 context manager
+        '''
+        trace = self.start(kind)
+        if trace is None:
+            return _NO_TRACE
+        return _TraceScope(self, trace)
+
+    def attached(self, trace: Trace | None):
+        '''
+        在目前的執行緒中處理 trace 的事件，期間的階段與 call stack 都記在 trace 上
+        '''
+        if trace is None:
+            return _NO_TRACE
+        return _AttachScope(self, trace)
+
+    def attach(self, trace: Trace) -> None:
+        self._local.trace = trace
+        with self._condition:
+            self._active[threading.get_ident()] = trace
+            if self._thread is None:
+                # 與 EventDispatcher 相同，執行緒在 gunicorn fork 之後才建立
+                self._thread = threading.Thread(target=self._run, name="event-tracer", daemon=True)
+                self._thread.start()
+            self._condition.notify()
+
+    def detach(self) -> None:
+        self._local.trace = None
+        with self._condition:
+            self._active.pop(threading.get_ident(), None)
+
+    def record_stage(self, seconds: float, stage: str, *label_values: Any) -> None:
+        '''
+        stage_seconds 的 listener，把階段記到目前執行緒正在追蹤的事件上
+        '''
+        trace = getattr(self._local, "trace", None)
+        if trace is not None:
+            trace.add_span(stage, seconds)
+
+    def finish(self, trace: Trace) -> None:
+        duration = trace.finish()
+        if duration < self._threshold:
+            return
+        with self._condition:
+            self._slow += 1
+            stacks = dict(trace.stacks)
+        try:
+            self._write(trace, stacks)
+        except OSError:
+            with self._condition:
+                self._write_errors += 1
+            logging.exception("Unable to write slow event trace to %s", self._directory)
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                while not self._active:
+                    self._condition.wait()
+                active = list(self._active.items())
+            frames = sys._current_frames()
+            sampled = []
+            for thread_id, trace in active:
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    sampled.append((trace, self._fold(frame)))
+            del frames
+            with self._condition:
+                for trace, stack in sampled:
+                    trace.stacks[stack] = trace.stacks.get(stack, 0) + 1
+                    trace.samples += 1
+                self._samples += len(sampled)
+            time.sleep(self._interval)
+
+    def _fold(self, frame) -> str:
+        labels = []
+        while frame is not None:
+            code = frame.f_code
+            label = self._labels.get(code)
+            if label is None:
+                path = code.co_filename.replace("\\", "/").rsplit("/", 2)
+                label = self._labels[code] = f"{'/'.join(path[-2:])}:{getattr(code, 'co_qualname', code.co_name)}"
+            labels.append(label)
+            frame = frame.f_back
+        labels.reverse()
+        return ";".join(labels).replace(" ", "_")
+
+    def _slot(self) -> int:
+        '''
+        第一次寫入時從 ring buffer 中最新的一格之後繼續，重新啟動後不會先覆蓋最新的事件
+        '''
+        if self._next_slot is None:
+            newest = None
+            for path in glob.glob(os.path.join(self._directory, "trace-*.json")):
+                try:
+                    slot = int(os.path.basename(path)[6:-5])
+                    mtime = os.path.getmtime(path)
+                except (ValueError, OSError):
+                    continue
+                if slot < self._ring_size and (newest is None or mtime > newest[0]):
+                    newest = (mtime, slot)
+            self._next_slot = 0 if newest is None else (newest[1] + 1) % self._ring_size
+        slot = self._next_slot
+        self._next_slot = (slot + 1) % self._ring_size
+        return slot
+
+    def _write(self, trace: Trace, stacks: dict[str, int]) -> None:
+        os.makedirs(self._directory, exist_ok=True)
+        with self._condition:
+            slot = self._slot()
+        base = os.path.join(self._directory, f"trace-{slot:04d}")
+        tmp_suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(base + ".folded" + tmp_suffix, "w", encoding="utf-8") as f:
+            for stack, count in stacks.items():
+                f.write(f"{stack} {count}\n")
+        with open(base + ".json" + tmp_suffix, "w", encoding="utf-8") as f:
+            json.dump(trace.to_dict(self._interval), f, ensure_ascii=False)
+        # json 最後換上，讀取時以 json 為準
+        os.replace(base + ".folded" + tmp_suffix, base + ".folded")
+        os.replace(base + ".json" + tmp_suffix, base + ".json")
+        with self._condition:
+            self._written += 1
@@ -0,0 +1,158 @@
+from typing import Any, Callable
+
+import base64
+import binascii
+import hashlib
+import hmac
+import json
+import threading
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+'''
+webhook 請求的解析，取代 linebot 的 WebhookParser:
+直接以原始 bytes 驗證簽名，不需要先解碼成字串；
+只讀出對話邏輯會用到的欄位，不處理的事件 (follow、貼圖、圖片等) 在建立任何物件之前就略過。
+有安裝 orjson 時以 orjson 解析 JSON。
+'''
+
+
+_json_loads: Callable[[bytes], Any] = orjson.loads if orjson is not None else json.loads
+
+
+class WebhookError(Exception):
+    def __init__(self, message: str, status_code: int = 400) -> None:
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class WebhookEvent(object):
+    '''
+    對話邏輯會處理的事件: 文字訊息 (TEXT) 或按鈕回傳 (POSTBACK)
+    '''
+    TEXT = "text"
+    POSTBACK = "postback"
+
+    __slots__ = ("kind", "user_id", "reply_token", "text", "postback_data", "webhook_event_id")
+
+    def __init__(self, kind: str, user_id: str, reply_token: str, text: str = "", postback_data: str = "",
+                 webhook_event_id: str | None = None) -> None:
+        self.kind = kind
+        self.user_id = user_id
+        self.reply_token = reply_token
+        self.text = text
+        self.postback_data = postback_data
+        self.webhook_event_id = webhook_event_id
+
+    def __repr__(self) -> str:
+        return f"WebhookEvent({self.kind}, {self.user_id}, {self.webhook_event_id})"
+
+
+class WebhookIngestor(object):
+    '''
+    channel_secret: 驗證 X-Line-Signature 用的 channel secret
+    max_body_bytes: 請求內容的大小上限，超過時回應 413
+    簽名缺少或錯誤、內容不是預期的 JSON 時拋出 WebhookError (400)
+    '''
+    def __init__(self, channel_secret: str, max_body_bytes: int = 1024 * 1024) -> None:
+        self._secret = channel_secret.encode()
+        self._max_body_bytes = max_body_bytes
+        self._lock = threading.Lock()
+
+        self._requests = 0
+        self._rejected: dict[str, int] = {}
+        self._events = 0
+        self._skipped = 0
+
+    @property
+    def max_body_bytes(self) -> int:
+        return self._max_body_bytes
+
+    @property
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            rejected = dict(self._rejected)
+        return {
+            "requests": self._requests,
+            "rejected": rejected,
+            "events": self._events,
+            "skipped_events": self._skipped,
+            "json_parser": "orjson" if orjson is not None else "json",
+        }
+
+    def parse(self, body: bytes, signature: str | None) -> list[WebhookEvent]:
+        with self._lock:
+            self._requests += 1
+        if len(body) > self._max_body_bytes:
+            raise self._reject("too_large", 413)
+        if not signature:
+            raise self._reject("missing_signature")
+        try:
+            expected = base64.b64decode(signature, validate=True)
+        except (binascii.Error, ValueError):
+            raise self._reject("malformed_signature")
+        if not hmac.compare_digest(hmac.new(self._secret, body, hashlib.sha256).digest(), expected):
+            raise self._reject("invalid_signature")
+        try:
+            payload = _json_loads(body)
+            raw_events = payload["events"]
+        except (ValueError, TypeError, KeyError):
+            raise self._reject("malformed_body")
+        if not isinstance(raw_events, list):
+            raise self._reject("malformed_body")
+
+        events = []
+        skipped = 0
+        for raw in raw_events:
+            event = self._event(raw)
+            if event is None:
+                skipped += 1
+            else:
+                events.append(event)
+        with self._lock:
+            self._events += len(events)
+            self._skipped += skipped
+        return events
+
+    @staticmethod
+    def _event(raw: Any) -> WebhookEvent | None:
+        '''
+        Return None for events the bot does not handle
+        '''
+        if not isinstance(raw, dict):
+            return None
+        kind = raw.get("type")
+        if kind == "message":
+            message = raw.get("message")
+            if not isinstance(message, dict) or message.get("type") != "text":
+                return None
+            text = message.get("text")
+            postback_data = ""
+        elif kind == "postback":
+            postback = raw.get("postback")
+            if not isinstance(postback, dict):
+                return None
+            text = ""
+            postback_data = postback.get("data")
+        else:
+            return None
+        source = raw.get("source")
+        user_id = source.get("userId") if isinstance(source, dict) else None
+        reply_token = raw.get("replyToken")
+        if not user_id or not reply_token:
+            return None
+        # event ID 用作去重的 key，不是字串時視為沒有 ID
+        event_id = raw.get("webhookEventId")
+        if not isinstance(event_id, str):
+            event_id = None
+        return WebhookEvent(WebhookEvent.TEXT if kind == "message" else WebhookEvent.POSTBACK, str(user_id),
+                            str(reply_token), text=str(text or ""), postback_data=str(postback_data or ""),
+                            webhook_event_id=event_id)
+
+    def _reject(self, reason: str, status_code: int = 400) -> WebhookError:
+        with self._lock:
+            self._rejected[reason] = self._rejected.get(reason, 0) + 1
+        return WebhookError(reason, status_code)
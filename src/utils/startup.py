@@ -0,0 +1,112 @@
+from typing import Any
+
+import builtins
+import logging
+import os
+import sys
+import threading
+import time
+
+'''
+冷啟動時間的量測。
+STARTUP_REPORT=1 時會攔截 import，記錄每個第一次載入的模組花了多少時間。
+必須在其他 import 之前啟用，所以直接讀取環境變數而不經過 vars。
+'''
+
+
+def process_uptime() -> float | None:
+    '''
+    Return the seconds since this process was started, or None if unknown
+    '''
+    try:
+        with open("/proc/self/stat") as f:
+            # 第二個欄位 (程式名稱) 可能含有空白，從右括號之後開始切
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open("/proc/uptime") as f:
+            system_uptime = float(f.read().split()[0])
+        return system_uptime - int(fields[19]) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class StartupReport(object):
+    '''
+    記錄從 process 啟動到各個時間點 (import 完成、app 建立、第一個 webhook 處理完) 的秒數，
+    以及各個 import 花費的時間
+    '''
+    def __init__(self) -> None:
+        uptime = process_uptime()
+        self._started_at = time.perf_counter() - (uptime if uptime is not None else 0.0)
+        self._milestones: dict[str, float] = {}
+        self._imports: list[tuple[str, int, float]] = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._original_import = None
+
+    @property
+    def milestones(self) -> dict[str, float]:
+        return dict(self._milestones)
+
+    def mark(self, name: str) -> bool:
+        '''
+        記錄 name 這個時間點，同一個名稱只記第一次。
+        Return True if this is the first time name is marked
+        '''
+        with self._lock:
+            if name in self._milestones:
+                return False
+            self._milestones[name] = time.perf_counter() - self._started_at
+            return True
+
+    def install_import_hook(self) -> None:
+        if self._original_import is not None:
+            return
+        self._original_import = builtins.__import__
+        builtins.__import__ = self._timed_import
+
+    def remove_import_hook(self) -> None:
+        if self._original_import is None:
+            return
+        builtins.__import__ = self._original_import
+        self._original_import = None
+
+    def _timed_import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        original = self._original_import
+        if level != 0 or name in sys.modules:
+            return original(name, globals, locals, fromlist, level)
+        depth = getattr(self._local, "depth", 0)
+        self._local.depth = depth + 1
+        start = time.perf_counter()
+        try:
+            return original(name, globals, locals, fromlist, level)
+        finally:
+            self._local.depth = depth
+            with self._lock:
+                self._imports.append((name, depth, time.perf_counter() - start))
+
+    def imports(self, max_depth: int = 0, top: int = 20) -> list[dict[str, Any]]:
+        '''
+        Return the slowest imports at most max_depth levels below the importing code
+        '''
+        with self._lock:
+            imports = [item for item in self._imports if item[1] <= max_depth]
+        imports.sort(key=lambda item: item[2], reverse=True)
+        return [{"module": name, "depth": depth, "seconds": round(seconds, 6)} for name, depth, seconds in imports[:top]]
+
+    def as_dict(self) -> dict[str, Any]:
+        return {
+            "milestones": {name: round(seconds, 6) for name, seconds in self._milestones.items()},
+            "imports": self.imports(),
+        }
+
+    def log(self) -> None:
+        report = self.as_dict()
+        logging.info("Startup milestones (seconds since process start): %s", report["milestones"])
+        for item in report["imports"]:
+            logging.info("Startup import %-40s %.1f ms", item["module"], item["seconds"] * 1000)
+
+
+startup_report = StartupReport()
+report_enabled = os.getenv("STARTUP_REPORT", "0") == "1"
+if report_enabled:
+    startup_report.install_import_hook()
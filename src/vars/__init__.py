@@ -1 +1,20 @@
-from .env import base_api_url, access_token, secret
\ No newline at end of file
+from .env import base_api_url, access_token, secret, line_api_endpoint
+from .env import webhook_max_body_bytes
+from .env import dispatch_mode, dispatch_workers, dispatch_queue_size, dispatch_enqueue_timeout
+from .env import session_store_backend, session_store_path, user_timeout, max_sessions
+from .env import session_snapshot_path
+from .env import event_dedup_window, event_dedup_size
+from .env import rate_limit_user_rate, rate_limit_user_burst, rate_limit_global_rate, rate_limit_global_burst, rate_limit_policy
+from .env import answer_log_dir, answer_log_segment_bytes, answer_log_segment_seconds, answer_log_flush_interval, answer_log_queue_size
+from .env import predict_connect_timeout, predict_read_timeout, predict_retries, predict_pool_size
+from .env import predict_breaker_threshold, predict_breaker_reset
+from .env import predict_cache_size, predict_cache_ttl, predict_cache_single_flight
+from .env import predict_batch_size, predict_batch_window
+from .env import predict_fanout_deadline, predict_fanout_workers
+from .env import predict_model_dir, predict_remote_fallback
+from .env import reminder_interval, reminder_rate, reminder_burst, reminder_max_retries, reminder_retry_backoff
+from .env import reminder_page_size, reminder_timeout_nudge, reminder_rescreen_after, reminder_rescreen_text, reminder_store_path
+from .env import trace_sample_rate, trace_slow_threshold, trace_dir, trace_ring_size, trace_profile_interval
+from .env import async_line_pool_size, async_handler_threads
+from .env import flow_definitions_dir, flow_cache_path
+from .env import startup_warm_up
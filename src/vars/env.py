@@ -1,10 +1,115 @@
 from dotenv import load_dotenv
 
 import os
+import tempfile
 
 
 load_dotenv()
 
 access_token = os.getenv("LINE_ACCESS_TOKEN")
 secret = os.getenv("LINE_SECRET")
-base_api_url = os.getenv("BASE_API_URL").removesuffix("/")
\ No newline at end of file
+base_api_url = os.getenv("BASE_API_URL").removesuffix("/")
+line_api_endpoint = os.getenv("LINE_API_ENDPOINT", "https://api.line.me").removesuffix("/")
+
+# webhook 請求內容的大小上限，超過時回應 413
+webhook_max_body_bytes = int(os.getenv("WEBHOOK_MAX_BODY_BYTES", str(1024 * 1024)))
+
+# sync: 在請求執行緒中處理事件; async: 事件丟進佇列後立即回應 LINE
+dispatch_mode = os.getenv("DISPATCH_MODE", "sync").lower()
+dispatch_workers = int(os.getenv("DISPATCH_WORKERS", "4"))
+dispatch_queue_size = int(os.getenv("DISPATCH_QUEUE_SIZE", "1000"))
+dispatch_enqueue_timeout = float(os.getenv("DISPATCH_ENQUEUE_TIMEOUT", "0"))
+
+# memory: 只存在目前的 process; sqlite: 存在檔案中，可跨 worker 共用
+session_store_backend = os.getenv("SESSION_STORE", "memory").lower()
+session_store_path = os.getenv("SESSION_STORE_PATH", "sessions.sqlite3")
+user_timeout = float(os.getenv("USER_TIMEOUT", "300"))
+max_sessions = int(os.getenv("SESSION_MAX_USERS", "100000"))
+# memory 模式下結束前把使用者狀態寫到 SESSION_SNAPSHOT_PATH，下次啟動時讀回；未設定 (預設) 時停用。
+# 機器重開後檔案仍要存在 (暫存目錄在 Fly 上重新部署就會清空)，必須指向 volume 中的路徑，見 fly.toml 的 [mounts]
+session_snapshot_path = os.getenv("SESSION_SNAPSHOT_PATH", "")
+
+# LINE 重送 webhook 時，EVENT_DEDUP_WINDOW 秒內處理過的 event ID 會被略過
+event_dedup_window = float(os.getenv("EVENT_DEDUP_WINDOW", "3600"))
+event_dedup_size = int(os.getenv("EVENT_DEDUP_SIZE", "100000"))
+
+# 流量控制: 每位使用者每秒 RATE_LIMIT_USER_RATE 個事件、最多連續 RATE_LIMIT_USER_BURST 個，
+# 全域同理；rate 設為 0 時不限制。RATE_LIMIT_POLICY 為 drop 或 coalesce
+rate_limit_user_rate = float(os.getenv("RATE_LIMIT_USER_RATE", "0"))
+rate_limit_user_burst = float(os.getenv("RATE_LIMIT_USER_BURST", "10"))
+rate_limit_global_rate = float(os.getenv("RATE_LIMIT_GLOBAL_RATE", "0"))
+rate_limit_global_burst = float(os.getenv("RATE_LIMIT_GLOBAL_BURST", "200"))
+rate_limit_policy = os.getenv("RATE_LIMIT_POLICY", "drop").lower()
+
+# 完成問卷的回答與預測結果寫到 ANSWER_LOG_DIR 供資料分析，設為空字串 (預設) 時不保存。
+# 區段檔超過 ANSWER_LOG_SEGMENT_MB 或開啟超過 ANSWER_LOG_SEGMENT_SECONDS 秒 (預設一小時，0 為不限) 後換新檔案，
+# ANSWER_LOG_FLUSH_INTERVAL 秒內的紀錄共用一次 fsync
+answer_log_dir = os.getenv("ANSWER_LOG_DIR", "")
+answer_log_segment_bytes = int(float(os.getenv("ANSWER_LOG_SEGMENT_MB", "64")) * 1024 * 1024)
+answer_log_segment_seconds = float(os.getenv("ANSWER_LOG_SEGMENT_SECONDS", "3600"))
+answer_log_flush_interval = float(os.getenv("ANSWER_LOG_FLUSH_INTERVAL", "1"))
+answer_log_queue_size = int(os.getenv("ANSWER_LOG_QUEUE_SIZE", "10000"))
+
+# 預測 API client 設定
+predict_connect_timeout = float(os.getenv("PREDICT_CONNECT_TIMEOUT", "2"))
+predict_read_timeout = float(os.getenv("PREDICT_READ_TIMEOUT", "10"))
+predict_retries = int(os.getenv("PREDICT_RETRIES", "2"))
+predict_pool_size = int(os.getenv("PREDICT_POOL_SIZE", "10"))
+predict_breaker_threshold = int(os.getenv("PREDICT_BREAKER_THRESHOLD", "5"))
+predict_breaker_reset = float(os.getenv("PREDICT_BREAKER_RESET", "30"))
+
+# 預測結果快取，PREDICT_CACHE_SIZE=0 時停用
+predict_cache_size = int(os.getenv("PREDICT_CACHE_SIZE", "10000"))
+predict_cache_ttl = float(os.getenv("PREDICT_CACHE_TTL", "3600"))
+predict_cache_single_flight = os.getenv("PREDICT_CACHE_SINGLE_FLIGHT", "1") == "1"
+
+# 本地模型: PREDICT_MODEL_DIR 中有模型的疾病直接在 process 內計算，設為空字串 (預設) 時停用；
+# 其餘疾病或本地計算失敗時，PREDICT_REMOTE_FALLBACK=1 才改呼叫預測 API
+predict_model_dir = os.getenv("PREDICT_MODEL_DIR", "")
+predict_remote_fallback = os.getenv("PREDICT_REMOTE_FALLBACK", "1") == "1"
+
+# 預測微批次，PREDICT_BATCH_SIZE 小於 2 時停用
+predict_batch_size = int(os.getenv("PREDICT_BATCH_SIZE", "0"))
+predict_batch_window = float(os.getenv("PREDICT_BATCH_WINDOW_MS", "5")) / 1000
+
+# 綜合篩檢時同時呼叫各疾病的預測 API，每個 API 最多等待 PREDICT_FANOUT_DEADLINE 秒
+# (流程定義中 predict transition 的 "deadline" 可個別覆寫)，逾時的疾病不列入回覆
+predict_fanout_deadline = float(os.getenv("PREDICT_FANOUT_DEADLINE", "5"))
+predict_fanout_workers = int(os.getenv("PREDICT_FANOUT_WORKERS", "16"))
+
+# 主動通知: 每 REMINDER_INTERVAL 秒 (0 為停用) 在背景掃描一輪使用者，以 multicast 每次最多 500 人送出，
+# 每秒最多 REMINDER_RATE 次 multicast 呼叫 (可累積 REMINDER_BURST 次)，429 與 5xx 時最多重試 REMINDER_MAX_RETRIES 次。
+# REMINDER_TIMEOUT_NUDGE=1 時通知回答到一半就超時的使用者；
+# REMINDER_RESCREEN_AFTER 大於 0 時，完成預測超過該秒數的使用者收到 REMINDER_RESCREEN_TEXT 與初始問題，
+# 完成預測的使用者記在 REMINDER_STORE_PATH (SQLite)，與使用者超時無關；重新部署後仍要存在，在 Fly 上指向 volume
+# (只有仍在 session store 中的使用者會收到，必須小於 USER_TIMEOUT)
+reminder_interval = float(os.getenv("REMINDER_INTERVAL", "0"))
+reminder_rate = float(os.getenv("REMINDER_RATE", "10"))
+reminder_burst = int(os.getenv("REMINDER_BURST", "10"))
+reminder_max_retries = int(os.getenv("REMINDER_MAX_RETRIES", "5"))
+reminder_retry_backoff = float(os.getenv("REMINDER_RETRY_BACKOFF", "1"))
+reminder_page_size = int(os.getenv("REMINDER_PAGE_SIZE", "500"))
+reminder_timeout_nudge = os.getenv("REMINDER_TIMEOUT_NUDGE", "1") == "1"
+reminder_rescreen_after = float(os.getenv("REMINDER_RESCREEN_AFTER", "0"))
+reminder_rescreen_text = os.getenv("REMINDER_RESCREEN_TEXT", "好久不見! 要不要再做一次健康風險評估呢?")
+reminder_store_path = os.getenv("REMINDER_STORE_PATH", "completions.sqlite3")
+
+# 抽樣追蹤: TRACE_SAMPLE_RATE 比例的事件記錄各階段耗時並抽樣 call stack (0 為停用)，
+# 超過 TRACE_SLOW_MS 毫秒的事件寫進 TRACE_DIR 中最多 TRACE_RING_SIZE 筆的 ring buffer
+trace_sample_rate = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+trace_slow_threshold = float(os.getenv("TRACE_SLOW_MS", "1000")) / 1000
+trace_dir = os.getenv("TRACE_DIR", os.path.join(tempfile.gettempdir(), "linebot-traces"))
+trace_ring_size = int(os.getenv("TRACE_RING_SIZE", "200"))
+trace_profile_interval = float(os.getenv("TRACE_PROFILE_INTERVAL_MS", "5")) / 1000
+
+# ASGI (asgi.py) 服務模式設定
+async_line_pool_size = int(os.getenv("ASYNC_LINE_POOL_SIZE", "100"))
+async_handler_threads = int(os.getenv("ASYNC_HANDLER_THREADS", "8"))
+
+# 問題集的宣告式定義與編譯結果快取，FLOW_CACHE_PATH 設為空字串 (預設) 時不快取。
+# 快取以 pickle 儲存，應放在只有服務使用者能寫入的目錄 (Docker image 中為 /opt/linebot)，不要放在共用的 /tmp
+flow_definitions_dir = os.getenv("FLOW_DEFINITIONS_DIR", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "flows"))
+flow_cache_path = os.getenv("FLOW_CACHE_PATH", "")
+
+# 冷啟動: 啟動時在背景預先連上 LINE API 與預測 API
+startup_warm_up = os.getenv("STARTUP_WARM_UP", "1") == "1"